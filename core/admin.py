@@ -2,7 +2,7 @@ from django.contrib import admin
 from django.template.defaultfilters import filesizeformat
 from django.utils.translation import ugettext_lazy as _
 from mptt.admin import MPTTModelAdmin
-from core.models import Folder, File, Permission
+from core.models import Folder, File, Permission, Quota
 
 admin.site.site_title = _('Drive admin')
 admin.site.site_header = _('Drive admin')
@@ -16,12 +16,18 @@ class FolderAdmin(MPTTModelAdmin):
     slug_link.admin_order_field = 'slug'
     slug_link.allow_tags = True
 
+    def total_size_human(self, obj):
+        return filesizeformat(obj.total_size)
+    total_size_human.short_description = 'Total size'
+    total_size_human.admin_order_field = 'total_size'
+
     mptt_level_indent = 10
-    list_display = ('name', 'owner', 'slug_link', 'created')
+    list_display = ('name', 'owner', 'slug_link', 'total_file_count', 'total_size_human', 'created')
     search_fields = ('name', 'owner__username', 'slug')
     list_filter = ('created', 'modified')
     date_hierarchy = 'created'
-    readonly_fields = ('slug',)
+    readonly_fields = ('slug', 'file_count', 'folder_count', 'size', 'total_file_count', 'total_folder_count',
+                       'total_size_human')
 
 
 @admin.register(File)
@@ -43,7 +49,7 @@ class FileAdmin(admin.ModelAdmin):
     date_hierarchy = 'created'
     ordering = ('-created', 'name')
     exclude = ('size',)
-    readonly_fields = ('original_filename', 'size_human', 'slug')
+    readonly_fields = ('original_filename', 'size_human', 'checksum', 'slug')
 
 
 @admin.register(Permission)
@@ -64,3 +70,22 @@ class PermissionAdmin(admin.ModelAdmin):
     search_fields = ('user__username',)
     list_filter = ('content_type', 'category', 'everybody')
     readonly_fields = ('content_object_link',)
+
+
+@admin.register(Quota)
+class QuotaAdmin(admin.ModelAdmin):
+    def usage_human(self, obj):
+        return filesizeformat(obj.usage)
+    usage_human.short_description = 'Usage'
+    usage_human.admin_order_field = 'usage'
+
+    def limit_human(self, obj):
+        limit = obj.get_limit()
+        return '-' if limit is None else filesizeformat(limit)
+    limit_human.short_description = 'Limit'
+    limit_human.admin_order_field = 'limit'
+
+    list_display = ('user', 'usage_human', 'limit_human')
+    search_fields = ('user__username',)
+    raw_id_fields = ('user',)
+    readonly_fields = ('usage_human',)
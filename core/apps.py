@@ -6,3 +6,7 @@ class CoreConfig(AppConfig):
 
     def ready(self):
         import core.signals  # noqa
+        from core.conf import settings
+        if settings.DRIVE_CACHALOT_STATS and 'cachalot' in settings.INSTALLED_APPS:
+            from core import cachestats
+            cachestats.install()
@@ -0,0 +1,264 @@
+"""Synthetic drives and timings of the main pages and operations (see the benchmark management command).
+
+generate() creates users whose drives have a given depth and fan-out, files in every folder and
+permissions shared with other users and with everybody. Every drive is a nested set of its own, so
+creating and moving folders costs time in proportion to the size of the owner's drive; deep or wide
+drives (--depth, --fanout) show how far that goes in the folder_create and folder_move scenarios. measure() times requests and calls on
+these drives and counts their queries, and compare() lists the ones that got worse than a stored
+baseline. The drives come from a seeded generator, so runs with the same parameters build the same
+trees. Unless asked to keep them, everything runs in one transaction that is rolled back and with
+a temporary media root, so neither the database nor the storage keeps anything.
+"""
+import hashlib
+import random
+import statistics
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import ExitStack
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.db.models import Max
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from core import search
+from core.cache import invalidate_tree
+from core.conf import settings
+from core.models import Folder, File, Permission, Access
+from core.utils import QUERY_CHUNK_SIZE, assign_slugs, chunks, generate_random_hex
+
+CONTENT = b'benchmark\n'
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+class Drives:
+    """Generated users with the folder and file the scenarios work on.
+
+    `folder` is the deepest folder of the first branch of the first user's drive. That branch is
+    shared with the second user (`viewer`, None with a single user). `file` is a file in `folder`.
+    """
+
+    def __init__(self, users, folder, file, content):
+        self.users = users
+        self.owner = users[0]
+        self.viewer = users[1] if len(users) > 1 else None
+        self.folder = folder
+        self.file = file
+        self.content = content
+
+
+def _create(model, objects):
+    """bulk_create folders or files and set their primary keys."""
+    assign_slugs(objects)
+    model.objects.bulk_create(objects, batch_size=QUERY_CHUNK_SIZE)
+    ids = {}
+    for chunk in chunks([obj.slug for obj in objects]):
+        ids.update(model.objects.filter(slug__in=chunk).values_list('slug', 'id'))
+    for obj in objects:
+        obj.pk = ids[obj.slug]
+    search.index_bulk(model, ids)
+    return objects
+
+
+def generate(users=10, depth=3, fanout=4, files=5, share_density=0.05, public_density=0.01, seed=0,
+             prefix='benchmark'):
+    """Create `users` users with drives of `depth` levels of `fanout` folders and `files` files in every folder.
+
+    Every folder and file below a root is shared with a random other user with probability
+    `share_density` and with everybody with probability `public_density`.
+    """
+    if users < 1 or depth < 1 or fanout < 1 or files < 1:
+        raise BenchmarkError('At least one user, level, folder per level and file per folder are needed.')
+    rng = random.Random(seed)
+    content = default_storage.save('%s.txt' % prefix, ContentFile(CONTENT))
+    checksum = hashlib.sha256(CONTENT).hexdigest()
+    created_users = []
+    for number in range(users):
+        user = get_user_model()(username='%s-%d' % (prefix, number))
+        user.set_unusable_password()
+        user.save()
+        created_users.append(user)
+
+    shareable = []
+    for user in created_users:
+        root = Folder.objects.get_user_root(user)
+        folders, parents = [], [root]
+        for level in range(1, depth + 1):
+            # Numbered with a single rebuild once the drive is complete, like imported folders.
+            parents = _create(Folder, [
+                Folder(name='folder-%d' % number, parent_id=parent.pk, owner=user, tree_id=root.tree_id, level=level,
+                       lft=0, rght=0) for parent in parents for number in range(fanout)])
+            folders.extend(parents)
+        Folder.objects.rebuild_tree(root.tree_id)
+        shareable.extend(folders)
+        shareable.extend(_create(File, [
+            File(folder_id=folder.pk, owner=user, file=content, name='file-%d.txt' % number,
+                 original_filename='file-%d.txt' % number, size=len(CONTENT), checksum=checksum)
+            for folder in [root] + folders for number in range(files)]))
+        Folder.objects.reconcile_aggregates(Folder.objects.get(pk=root.pk))
+
+    folder = Folder.objects.get_user_root(created_users[0])
+    for level in range(depth):
+        folder = folder.get_children().order_by('name').first()
+    branch = folder.get_ancestors().get(level=1)
+    permissions = []
+    if len(created_users) > 1:
+        permissions.append(Permission(content_type=ContentType.objects.get_for_model(Folder), object_id=branch.pk,
+                                      user=created_users[1], category=Permission.CATEGORIES.view))
+    for obj in shareable:
+        content_type = ContentType.objects.get_for_model(obj)
+        if len(created_users) > 1 and rng.random() < share_density:
+            user = rng.choice([user for user in created_users if user.pk != obj.owner_id])
+            category = rng.choice([Permission.CATEGORIES.view, Permission.CATEGORIES.edit])
+            permissions.append(Permission(content_type=content_type, object_id=obj.pk, user=user, category=category))
+        if rng.random() < public_density:
+            permissions.append(Permission(content_type=content_type, object_id=obj.pk, everybody=True,
+                                          category=Permission.CATEGORIES.view))
+    last_id = Permission.objects.aggregate(id=Max('id'))['id'] or 0
+    Permission.objects.bulk_create(permissions, batch_size=QUERY_CHUNK_SIZE)
+    # bulk_create sends no post_save, so access entries are added here.
+    for chunk in chunks(Permission.objects.filter(id__gt=last_id).order_by('id')):
+        Access.objects.sync_permissions(chunk)
+    return Drives(created_users, folder, folder.files.order_by('name').first(), content)
+
+
+def _client(user):
+    client = Client()
+    client.force_login(user)
+    return client
+
+
+def _request(method, *args, expect=200, **kwargs):
+    def action(client):
+        response = getattr(client, method)(*args, **kwargs)
+        if response.status_code != expect:
+            raise BenchmarkError('%s %s answered %d instead of %d.' % (
+                method.upper(), args[0], response.status_code, expect))
+        return response
+    return action
+
+
+def _new_folder(drives):
+    """A folder with a few files to delete, created outside of the timed part."""
+    folder = Folder.objects.create(name='delete-%s' % generate_random_hex(), parent=drives.folder, owner=drives.owner)
+    for number in range(3):
+        File.objects.create(folder=folder, owner=drives.owner, file=drives.content, name='file-%d.txt' % number,
+                            size=len(CONTENT), checksum=hashlib.sha256(CONTENT).hexdigest())
+    return folder
+
+
+def _new_file(drives):
+    return File.objects.create(folder=drives.folder, owner=drives.owner, file=drives.content, name='delete.txt',
+                               size=len(CONTENT), checksum=hashlib.sha256(CONTENT).hexdigest())
+
+
+def _upload(client, drives):
+    start = _request('post', reverse('core:upload-start', args=[drives.folder.slug]), expect=201,
+                     data={'filename': 'upload.txt', 'size': len(CONTENT)})(client).json()
+    _request('put', start['url'], CONTENT, content_type='application/octet-stream',
+             HTTP_CONTENT_RANGE='bytes 0-%d/%d' % (len(CONTENT) - 1, len(CONTENT)))(client)
+    _request('post', reverse('core:upload-finalize', args=[start['token']]), expect=201)(client)
+
+
+def scenarios(drives):
+    """(name, action, setup) of every measured path; `action` gets what `setup` returned, if there is a setup."""
+    owner = _client(drives.owner)
+    viewer = _client(drives.viewer) if drives.viewer else None
+    folder, file = drives.folder, drives.file
+    root = Folder.objects.get_user_root(drives.owner)
+    result = [
+        ('home', lambda: _request('get', reverse('core:home'))(owner), None),
+        ('folder_detail', lambda: _request('get', folder.get_absolute_url())(owner), None),
+        ('file_detail', lambda: _request('get', file.get_absolute_url())(owner), None),
+        ('has_permission', lambda: File.objects.get(pk=file.pk).has_permission(
+            drives.viewer or AnonymousUser(), Permission.CATEGORIES.view), None),
+        # The add and edit forms used to list every folder of the drive as parent choices.
+        ('folder_form', lambda: _request('get', reverse('core:folder-add', args=[folder.slug]))(owner), None),
+        ('folder_picker', lambda: _request('get', reverse('core:folder-picker'), {'q': 'folder-1'})(owner), None),
+        ('file_upload', lambda upload: _request('post', reverse('core:file-add', args=[folder.slug]), expect=302,
+                                                data={'folder': folder.pk, 'file': upload})(owner),
+         lambda: SimpleUploadedFile('upload.txt', CONTENT)),
+        ('resumable_upload', lambda: _upload(owner, drives), None),
+        # Inserts and moves renumber the nested set of the owner's drive, so these grow with its size.
+        ('folder_create', lambda: _request('post', reverse('core:folder-add', args=[folder.slug]), expect=302, data={
+            'parent': folder.pk, 'name': 'create-%s' % generate_random_hex()})(owner), None),
+        ('folder_move', lambda target: _request('post', reverse('core:folder-edit', args=[target.slug]), expect=302,
+                                                data={'parent': root.pk, 'name': target.name})(owner),
+         lambda: _new_folder(drives)),
+        ('folder_delete', lambda target: _request('post', reverse('core:folder-delete', args=[target.slug]),
+                                                  expect=302)(owner), lambda: _new_folder(drives)),
+        ('file_delete', lambda target: _request('post', reverse('core:file-delete', args=[target.slug]),
+                                                expect=302)(owner), lambda: _new_file(drives)),
+    ]
+    if viewer:
+        result[3:3] = [
+            ('shared', lambda: _request('get', reverse('core:shared'))(viewer), None),
+            ('folder_detail_shared', lambda: _request('get', folder.get_absolute_url())(viewer), None),
+        ]
+    return result
+
+
+def measure(drives, repeat=5):
+    """Time every scenario `repeat` times: median and fastest run in milliseconds and the most queries of a run."""
+    results = OrderedDict()
+    for name, action, setup in scenarios(drives):
+        times, queries = [], []
+        for run in range(repeat):
+            argument = setup() if setup else None
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                action(argument) if setup else action()
+                times.append(time.perf_counter() - start)
+            queries.append(len(context))
+        results[name] = OrderedDict([
+            ('median_ms', round(statistics.median(times) * 1000, 3)),
+            ('min_ms', round(min(times) * 1000, 3)),
+            ('queries', max(queries)),
+        ])
+    return results
+
+
+def run(repeat=5, keep=False, **parameters):
+    """Generate drives (see generate) and measure them; the drives are rolled back unless `keep` is set."""
+    with ExitStack() as stack:
+        if not keep:
+            stack.enter_context(override_settings(MEDIA_ROOT=stack.enter_context(tempfile.TemporaryDirectory())))
+        # The test client talks to the application as 'testserver'.
+        stack.enter_context(override_settings(ALLOWED_HOSTS=list(settings.ALLOWED_HOSTS) + ['testserver']))
+        with transaction.atomic():
+            drives = generate(**parameters)
+            results = measure(drives, repeat)
+            transaction.set_rollback(not keep)
+    if not keep:
+        # Cached roots and ancestor chains of the rolled back trees must not outlive them.
+        for user in drives.users:
+            invalidate_tree(user.pk)
+    return OrderedDict([
+        ('parameters', dict(parameters, repeat=repeat)),
+        ('database', connection.vendor),
+        ('results', results),
+    ])
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Scenarios that run more queries than in `baseline` or whose median is more than `tolerance` (a fraction)
+    slower, as messages."""
+    regressions = []
+    for name, result in results['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        if result['queries'] > before['queries']:
+            regressions.append('%s: %d queries instead of %d' % (name, result['queries'], before['queries']))
+        if result['median_ms'] > before['median_ms'] * (1 + tolerance):
+            regressions.append('%s: %.1f ms instead of %.1f ms' % (name, result['median_ms'], before['median_ms']))
+    return regressions
@@ -0,0 +1,305 @@
+"""Move, copy, delete and share many folders and files at once (see core.views.BulkView).
+
+Permissions of a whole selection are resolved with one permission cache load. Each operation
+runs in one transaction with set-based queries. Every selected folder is moved, copied or deleted
+with its subtree by shifting the nested set once (a constant number of queries per folder), and
+new children are placed in name order like FolderManager.rebuild_tree numbers them.
+"""
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import PermissionDenied
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Sum
+from core import search
+from core.cache import invalidate_tree
+from core.models import AGGREGATE_FIELDS, Folder, File, Permission, Access, Upload, Quota
+from core.permissions import PermissionCache
+from core.utils import QUERY_CHUNK_SIZE, assign_slugs, chunks
+
+
+class BulkError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class Selection:
+    """Folders and files picked by slug."""
+
+    def __init__(self, user, folder_slugs=(), file_slugs=(), permission_cache=None):
+        self.user = user
+        self.permission_cache = permission_cache or PermissionCache()
+        self.folders = self._load(Folder.objects.all(), set(folder_slugs))
+        self.files = self._load(File.objects.select_related('folder'), set(file_slugs))
+        if not self.folders and not self.files:
+            raise BulkError('Nothing selected.')
+        if any(folder.level == 0 for folder in self.folders):
+            raise BulkError('Root folders cannot be changed.')
+
+    def _load(self, queryset, slugs):
+        objects = [obj for chunk in chunks(slugs) for obj in queryset.filter(slug__in=chunk)]
+        if len(objects) != len(slugs):
+            raise BulkError('Folder or file not found.', status=404)
+        return objects
+
+    def check(self, permission_category):
+        """Raise PermissionDenied unless the user has the permission on every selected object."""
+        objects = self.folders + self.files
+        self.permission_cache.prime(self.user, objects)
+        if not all(self.permission_cache.has_permission(self.user, obj, permission_category) for obj in objects):
+            raise PermissionDenied
+
+    def top_level(self):
+        """Selected folders and files without the ones inside another selected folder."""
+        folders = []
+        for folder in sorted(self.folders, key=lambda f: (f.tree_id, f.lft)):
+            if not (folders and folders[-1].tree_id == folder.tree_id and folder.rght < folders[-1].rght):
+                folders.append(folder)
+        positions = [(f.tree_id, f.lft) for f in folders]
+
+        def covered(folder):
+            index = bisect_right(positions, (folder.tree_id, folder.lft)) - 1
+            return index >= 0 and folders[index].tree_id == folder.tree_id and folder.rght <= folders[index].rght
+
+        return folders, [file for file in self.files if not covered(file.folder)]
+
+
+def _following_sibling(target, name, exclude=None):
+    """The child of `target` a new child named `name` goes before, to keep children in name order (like
+    FolderManager.rebuild_tree); None to add it last."""
+    return target.children.filter(name__gt=name).exclude(pk=exclude).order_by('name', 'lft').first()
+
+
+def _update_aggregates(folders, files, sign):
+    """Add (sign 1) or take off (sign -1) folders with their subtrees and files to the counters of their parents."""
+    changes = defaultdict(lambda: [0] * len(AGGREGATE_FIELDS))
+    for folder in folders:
+        change = changes[folder.parent_id]
+        change[1] += sign
+        change[3] += sign * folder.total_file_count
+        change[4] += sign * (folder.total_folder_count + 1)
+        change[5] += sign * folder.total_size
+    for file in files:
+        change = changes[file.folder_id]
+        change[0] += sign
+        change[2] += sign * file.size
+        change[3] += sign
+        change[5] += sign * file.size
+    for folder_id, (files, folders, size, *total) in changes.items():
+        Folder.objects.add_to_aggregates(folder_id, files, folders, size, total)
+
+
+def _check_target(selection, target):
+    if not selection.permission_cache.has_permission(selection.user, target, Permission.CATEGORIES.edit):
+        raise PermissionDenied
+    for folder in selection.folders:
+        if folder.tree_id == target.tree_id and folder.lft <= target.lft and target.rght <= folder.rght:
+            raise BulkError('A folder cannot be moved or copied into itself.')
+
+
+def move(selection, target):
+    selection.check(Permission.CATEGORIES.edit)
+    _check_target(selection, target)
+    folders, files = selection.top_level()
+    try:
+        with transaction.atomic():
+            _update_aggregates(folders, files, -1)
+            tree_ids = {target.tree_id} | {folder.tree_id for folder in folders}
+            for folder in folders:
+                # Every move shifts the nested set, so positions are read again right before the next one.
+                folder._mptt_refresh()
+                target._mptt_refresh()
+                sibling = _following_sibling(target, folder.name, exclude=folder.pk)
+                if sibling is None:
+                    Folder.objects._move_node(folder, target, 'last-child', save=False)
+                else:
+                    Folder.objects._move_node(folder, sibling, 'left', save=False)
+                folder.parent = target
+            for chunk in chunks(files):
+                File.objects.filter(pk__in=[f.pk for f in chunk]).update(folder=target)
+            for file in files:
+                file.folder = target
+            Access.objects.sync_owners(folders)
+            for tree_id in tree_ids:
+                invalidate_tree(tree_id)
+            _update_aggregates(folders, files, 1)
+    except IntegrityError:
+        raise BulkError('A folder with the same name exists in the target folder.', status=409)
+    return len(folders), len(files)
+
+
+def _unique_name(name, taken):
+    candidate, number = name, 1
+    while candidate in taken:
+        number += 1
+        candidate = '%s (%d)' % (name, number)
+    taken.add(candidate)
+    return candidate
+
+
+def copy(selection, target):
+    """Copy folders (with their subtrees) and files into `target`; the copies belong to the user.
+
+    File copies share the stored content of their originals.
+    """
+    selection.check(Permission.CATEGORIES.view)
+    _check_target(selection, target)
+    top_folders, top_files = selection.top_level()
+    size = sum(f.total_size for f in top_folders) + sum(f.size for f in top_files)
+    if not Quota.objects.get_for_user(selection.user).allows(size):
+        raise BulkError('The copies do not fit into the storage quota.', status=413)
+    taken = set(target.children.values_list('name', flat=True))
+    with transaction.atomic():
+        # Each copied subtree gets a gap of its size in the target's nested set and keeps the numbering of its
+        # source within it. Source folder id -> (name, lft, rght, level) of the copy.
+        positions = {}
+        sources = []
+        for top in top_folders:
+            # Read again: creating the gap for an earlier copy may have shifted this subtree.
+            subtree = list(Folder.objects.get(pk=top.pk).get_descendants(include_self=True))
+            name = _unique_name(top.name, taken)
+            sibling = _following_sibling(target, name)
+            space_target = (sibling.lft if sibling else Folder.objects.get(pk=target.pk).rght) - 1
+            Folder.objects._create_space(subtree[0].rght - subtree[0].lft + 1, space_target, target.tree_id)
+            shift, level_shift = space_target + 1 - subtree[0].lft, target.level + 1 - top.level
+            for folder in subtree:
+                positions[folder.pk] = (name if folder.pk == top.pk else folder.name, folder.lft + shift,
+                                        folder.rght + shift, folder.level + level_shift)
+            sources.extend(subtree)
+        # Old folder id -> copy, created one depth at a time so parents exist before children.
+        copies = {}
+        for level in sorted({f.level for f in sources}):
+            created = []
+            for folder in sources:
+                if folder.level != level:
+                    continue
+                name, lft, rght, copy_level = positions[folder.pk]
+                copies[folder.pk] = Folder(
+                    name=name, description=folder.description, owner=selection.user,
+                    parent=copies.get(folder.parent_id, target), tree_id=target.tree_id, lft=lft, rght=rght,
+                    level=copy_level, **{field: getattr(folder, field) for field in AGGREGATE_FIELDS})
+                created.append(copies[folder.pk])
+            assign_slugs(created)
+            Folder.objects.bulk_create(created, batch_size=QUERY_CHUNK_SIZE)
+            ids = {}
+            for chunk in chunks([f.slug for f in created]):
+                ids.update(Folder.objects.filter(slug__in=chunk).values_list('slug', 'id'))
+            for folder in created:
+                folder.pk = ids[folder.slug]
+            search.index_bulk(Folder, ids)
+        Access.objects.sync_owners([copies[f.pk] for f in top_folders])
+
+        files = [(file, target) for file in top_files]
+        for chunk in chunks(copies):
+            files.extend((file, copies[file.folder_id]) for file in File.objects.filter(folder_id__in=chunk))
+        new_files = [File(folder=folder, owner=selection.user, file=file.file.name, name=file.name,
+                          original_filename=file.original_filename, size=file.size, checksum=file.checksum,
+                          description=file.description) for file, folder in files]
+        assign_slugs(new_files)
+        File.objects.bulk_create(new_files, batch_size=QUERY_CHUNK_SIZE)
+        search.index_bulk(File, [f.slug for f in new_files])
+        invalidate_tree(target.tree_id)
+        # The copies start with the counters of their originals; only the target is left to update.
+        _update_aggregates([copies[f.pk] for f in top_folders], new_files[:len(top_files)], 1)
+        Quota.objects.add_usage(selection.user.pk, size)
+    return len(copies), len(new_files)
+
+
+def _delete_rows(files, folders=None, using=None):
+    """Delete a files queryset, optionally with a subtree of folders, and all rows referencing them.
+
+    Returns the number of deleted rows per model label, like Model.delete.
+    """
+    content_types = ContentType.objects.get_for_models(Folder, File)
+    using = using or Access.objects.db
+    deleted = Counter()
+
+    def raw_delete(queryset):
+        deleted[queryset.model._meta.label] += queryset._raw_delete(using)
+
+    if folders is None:
+        raw_delete(Access.objects.filter(file__in=files))
+    else:
+        raw_delete(Access.objects.filter(Q(folder__in=folders) | Q(file__in=files)))
+        raw_delete(Permission.objects.filter(content_type=content_types[Folder], object_id__in=folders.values('pk')))
+        raw_delete(Upload.objects.filter(folder__in=folders))
+    raw_delete(Permission.objects.filter(content_type=content_types[File], object_id__in=files.values('pk')))
+    raw_delete(files)
+    if folders is not None:
+        raw_delete(folders)
+    return deleted
+
+
+def delete_files(files):
+    """Delete files without per-row signals; unreferenced contents are left to the storage sweeper."""
+    with transaction.atomic():
+        _update_aggregates([], files, -1)
+        usage = defaultdict(int)
+        for file in files:
+            usage[file.owner_id] += file.size
+        for owner_id, size in usage.items():
+            Quota.objects.add_usage(owner_id, -size)
+        search.unindex(*files)
+        for chunk in chunks(files):
+            _delete_rows(File.objects.filter(pk__in=[f.pk for f in chunk]))
+
+
+def delete_subtrees(folders, using=None):
+    """Delete folders with everything below them in a constant number of queries per folder.
+
+    Subtrees are deleted by tree range without loading or signalling rows. Stored contents and
+    partial uploads are left to the storage sweeper (see core.sweeper). Returns the number of
+    deleted rows and the numbers per model label, like Model.delete.
+    """
+    deleted = Counter()
+    with transaction.atomic(using=using):
+        # Right to left, so closing a gap never shifts a folder that is still to be deleted.
+        for folder in sorted(folders, key=lambda f: (f.tree_id, -f.lft)):
+            _update_aggregates([folder], [], -1)
+            search.unindex_subtree(folder)
+            subtree = Folder.objects.filter(tree_id=folder.tree_id, lft__gte=folder.lft, rght__lte=folder.rght)
+            usage = File.objects.filter(folder__in=subtree).order_by().values('owner').annotate(size=Sum('size'))
+            for row in usage:
+                Quota.objects.add_usage(row['owner'], -row['size'])
+            deleted.update(_delete_rows(File.objects.filter(folder__in=subtree), subtree, using))
+            Folder.objects._close_gap(folder.rght - folder.lft + 1, folder.rght, folder.tree_id)
+        for tree_id in {folder.tree_id for folder in folders}:
+            invalidate_tree(tree_id)
+    return sum(deleted.values()), dict(deleted)
+
+
+def delete(selection):
+    selection.check(Permission.CATEGORIES.edit)
+    folders, files = selection.top_level()
+    with transaction.atomic():
+        delete_files(files)
+        delete_subtrees(folders)
+    return len(folders), len(files)
+
+
+def share(selection, category, user=None, everybody=False):
+    """Grant `user` (or everybody) a permission on every selected object the user owns."""
+    if not all(obj.can_share(selection.user) for obj in selection.folders + selection.files):
+        raise PermissionDenied
+    if bool(user) == bool(everybody):
+        raise BulkError('Either a user or everybody has to be selected.')
+    principal = {'user': user, 'everybody': everybody, 'category': category}
+    created = 0
+    with transaction.atomic():
+        for model, objects in ((Folder, selection.folders), (File, selection.files)):
+            content_type = ContentType.objects.get_for_model(model)
+            existing = set()
+            for chunk in chunks(objects):
+                existing.update(Permission.objects.filter(
+                    content_type=content_type, object_id__in=[o.pk for o in chunk], **principal
+                ).values_list('object_id', flat=True))
+            new = [obj.pk for obj in objects if obj.pk not in existing]
+            Permission.objects.bulk_create([Permission(content_type=content_type, object_id=pk, **principal)
+                                            for pk in new], batch_size=QUERY_CHUNK_SIZE)
+            # bulk_create sends no post_save, so access entries are added here.
+            for chunk in chunks(new):
+                Access.objects.sync_permissions(list(Permission.objects.filter(
+                    content_type=content_type, object_id__in=chunk, **principal)))
+            created += len(new)
+    return created
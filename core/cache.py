@@ -0,0 +1,79 @@
+import logging
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.template.loader import render_to_string
+from django.utils.translation import get_language
+from core import metrics
+from core.conf import settings
+from core.utils import generate_random_hex
+
+logger = logging.getLogger(__name__)
+
+# Used whenever the configured cache (usually Redis) cannot be reached.
+local_cache = LocMemCache('drive-fallback', {})
+
+
+def _call(method, *args):
+    try:
+        result = getattr(caches[settings.DRIVE_CACHE], method)(*args)
+    except Exception as e:
+        logger.warning('Cache %s failed, falling back to in-process cache: %s', method, e)
+        result = getattr(local_cache, method)(*args)
+    if method == 'get':
+        metrics.count('cache_misses' if result is None else 'cache_hits')
+    return result
+
+
+def get_tree_version(tree_id):
+    """Token that changes whenever a folder of the tree is created, renamed, moved or deleted."""
+    key = 'drive:tree:%s' % tree_id
+    version = _call('get', key)
+    if version is None:
+        _call('add', key, generate_random_hex(length=8), None)
+        version = _call('get', key)
+    return version
+
+
+def invalidate_tree(tree_id):
+    _call('set', 'drive:tree:%s' % tree_id, generate_random_hex(length=8), None)
+
+
+def get_user_root_values(user_id, load):
+    """Field values of a user's root folder; `load()` reads them again once the tree changed.
+
+    A root's own fields only change together with its tree (its version is bumped by every folder
+    save, move and delete in it), except for the counters, which may lag behind.
+    """
+    key = 'drive:root:%s' % user_id
+    entry = _call('get', key)
+    if entry is not None:
+        tree_id, version, values = entry
+        if get_tree_version(tree_id) == version:
+            return values
+    values = load()
+    if values is not None:
+        _call('set', key, (values['tree_id'], get_tree_version(values['tree_id']), values),
+              settings.DRIVE_CACHE_TIMEOUT)
+    return values
+
+
+def get_ancestor_chain(folder):
+    """(id, slug, name) of all ancestors of the folder, starting with the tree root."""
+    key = 'drive:ancestors:%s:%s:%s' % (folder.tree_id, get_tree_version(folder.tree_id), folder.lft)
+    chain = _call('get', key)
+    if chain is None:
+        chain = list(folder.get_ancestors().values_list('id', 'slug', 'name'))
+        _call('set', key, chain, settings.DRIVE_CACHE_TIMEOUT)
+    return chain
+
+
+def render_breadcrumbs(folder, include_self=False):
+    """Rendered breadcrumbs.html for the ancestors of the folder (and the folder itself)."""
+    key = 'drive:breadcrumbs:%s:%s:%s:%d:%s' % (
+        folder.tree_id, get_tree_version(folder.tree_id), folder.pk, include_self, get_language())
+    html = _call('get', key)
+    if html is None:
+        folders = folder.get_user_ancestors() + ([folder] if include_self else [])
+        html = render_to_string('core/includes/breadcrumbs.html', {'folders': folders})
+        _call('set', key, html, settings.DRIVE_CACHE_TIMEOUT)
+    return html
@@ -0,0 +1,139 @@
+"""Per-table hit, miss and invalidation counters of the cachalot query cache (see the cachalot_stats command).
+
+Enabled with DRIVE_CACHALOT_STATS. Counts are buffered in each process and added to the shared cache
+(DRIVE_CACHE) every DRIVE_CACHALOT_STATS_FLUSH events, so all workers of a deployment count together
+without a cache round trip per query.
+"""
+import logging
+import threading
+from collections import Counter
+from django.core.cache import caches
+from django.db import connections
+from cachalot import monkey_patch
+from cachalot.signals import post_invalidation
+from cachalot.utils import _get_table_cache_key
+from core.conf import settings
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('hits', 'misses', 'invalidations')
+
+_counts = Counter()
+_pending = 0
+_lock = threading.Lock()
+# Cachalot only passes hashed table keys around; table cache key -> table name.
+_tables = {}
+# Called on every query cache lookup; see add_listener.
+_listeners = []
+_hooked = False
+
+
+def _key(kind, table):
+    return 'drive:cachalot:%s:%s' % (kind, table)
+
+
+def get_tables():
+    return sorted({table for alias in connections for table in connections[alias].introspection.table_names()})
+
+
+def _table_names(table_cache_keys):
+    if any(key not in _tables for key in table_cache_keys):
+        for alias in connections:
+            for table in connections[alias].introspection.table_names():
+                _tables[_get_table_cache_key(alias, table)] = table
+    return [_tables.get(key, '?') for key in table_cache_keys]
+
+
+def record(kind, tables):
+    global _pending
+    with _lock:
+        for table in tables:
+            _counts[kind, table] += 1
+        _pending += 1
+        full = _pending >= settings.DRIVE_CACHALOT_STATS_FLUSH
+    if full:
+        flush()
+
+
+def flush():
+    """Add the counts of this process to the shared counters."""
+    global _pending
+    with _lock:
+        counts = dict(_counts)
+        _counts.clear()
+        _pending = 0
+    cache = caches[settings.DRIVE_CACHE]
+    try:
+        for (kind, table), count in counts.items():
+            cache.add(_key(kind, table), 0, None)
+            cache.incr(_key(kind, table), count)
+    except Exception as e:
+        logger.warning('Cachalot stats could not be flushed: %s', e)
+
+
+def get_stats():
+    """{table: {kind: count}} of the tables with any traffic."""
+    flush()
+    tables = get_tables()
+    values = caches[settings.DRIVE_CACHE].get_many([_key(kind, table) for kind in KINDS for table in tables])
+    stats = {}
+    for table in tables:
+        counts = {kind: values.get(_key(kind, table), 0) for kind in KINDS}
+        if any(counts.values()):
+            stats[table] = counts
+    return stats
+
+
+def reset():
+    with _lock:
+        _counts.clear()
+    caches[settings.DRIVE_CACHE].delete_many([_key(kind, table) for kind in KINDS for table in get_tables()])
+
+
+def _count_invalidation(sender, **kwargs):
+    record('invalidations', [sender])
+
+
+def _count_lookup(hit, table_cache_keys):
+    record('hits' if hit else 'misses', _table_names(table_cache_keys))
+
+
+def add_listener(listener):
+    """Call `listener(hit, table_cache_keys)` after every lookup of the query cache from now on.
+
+    A single wrapper of cachalot's lookup function serves all listeners (this and core.metrics). The
+    function is private to cachalot (pinned in req.txt); without it nothing is counted and False is returned.
+    """
+    global _hooked
+    with _lock:
+        if listener not in _listeners:
+            _listeners.append(listener)
+        if _hooked:
+            return True
+        original = getattr(monkey_patch, '_get_result_or_execute_query', None)
+        if original is None:
+            logger.warning('This cachalot version has no _get_result_or_execute_query; '
+                           'query cache lookups are not counted.')
+            return False
+
+        def counted(execute_query_func, cache, cache_key, table_cache_keys):
+            executed = []
+
+            def execute():
+                executed.append(True)
+                return execute_query_func()
+
+            result = original(execute, cache, cache_key, table_cache_keys)
+            for call in _listeners:
+                call(not executed, table_cache_keys)
+            return result
+
+        monkey_patch._get_result_or_execute_query = counted
+        _hooked = True
+        return True
+
+
+def install():
+    """Count cache lookups and invalidations of cachalot from now on."""
+    add_listener(_count_lookup)
+    post_invalidation.connect(_count_invalidation, dispatch_uid='drive_cachalot_stats')
@@ -0,0 +1,59 @@
+import os
+from django.conf import settings  # noqa
+from appconf import AppConf
+
+
+class DriveConf(AppConf):
+    # Number of folder items per page and the upper limit clients may request.
+    PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+    # Cache alias for ancestor chains and breadcrumbs, and how long entries live (seconds).
+    CACHE = 'default'
+    CACHE_TIMEOUT = 60 * 60 * 24
+    # Downloads are streamed in chunks of this many bytes, or handed over to the web server with
+    # SENDFILE = 'x-sendfile' (Apache, lighttpd) or 'x-accel-redirect' (nginx internal location
+    # SENDFILE_URL mapped to MEDIA_ROOT).
+    DOWNLOAD_CHUNK_SIZE = 64 * 1024
+    SENDFILE = None
+    SENDFILE_URL = '/protected/'
+    # Types shown in the browser with ?inline; anything else (HTML, SVG, ...) could run scripts in the
+    # site's origin and is always downloaded.
+    INLINE_TYPES = ('image/png', 'image/jpeg', 'image/gif', 'image/webp', 'image/bmp', 'application/pdf', 'text/plain')
+    # Read buffer for chunks of resumable uploads.
+    UPLOAD_CHUNK_SIZE = 64 * 1024
+    # Unfinished uploads are dropped by the storage sweeper after this many seconds without a chunk;
+    # the sweeper leaves anything younger than SWEEP_GRACE seconds alone.
+    UPLOAD_EXPIRY = 60 * 60 * 24 * 7
+    SWEEP_GRACE = 60 * 60
+    # Thumbnails (longest side in pixels) and first-page previews of documents, generated by
+    # PREVIEW_WORKERS background threads into PREVIEW_ROOT (defaults to MEDIA_ROOT/previews).
+    # Documents need pdftoppm (poppler) and, for office formats, LibreOffice.
+    THUMBNAIL_SIZES = {'small': 64, 'medium': 256, 'large': 1024}
+    PREVIEW_ROOT = None
+    PREVIEW_WORKERS = 2
+    PREVIEW_TIMEOUT = 60
+    # Bytes a user may store unless their quota sets another limit; None for no limit.
+    QUOTA = None
+    # Per-table hit, miss and invalidation counts of the query cache (cachalot), added to CACHE every
+    # CACHALOT_STATS_FLUSH lookups; see the cachalot_stats command.
+    CACHALOT_STATS = False
+    CACHALOT_STATS_FLUSH = 100
+    # Per-request metrics of core.middleware.MetricsMiddleware: requests slower than METRICS_SLOW seconds are
+    # logged, and histograms with these bucket bounds are added to CACHE every METRICS_FLUSH requests and
+    # served in the Prometheus text format (see core.views.MetricsView) to staff users, to requests with
+    # "Authorization: Bearer <METRICS_TOKEN>" and to METRICS_IPS. Behind a proxy every request comes from
+    # the proxy's address, so list addresses only when the application is reached directly.
+    METRICS_SLOW = 1.0
+    METRICS_DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    METRICS_QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+    METRICS_FLUSH = 100
+    METRICS_TOKEN = ''
+    METRICS_IPS = ()
+    # Characters of extracted document text kept in the search index.
+    SEARCH_MAX_CONTENT = 1000000
+
+    def configure_preview_root(self, value):
+        return value or os.path.join(settings.MEDIA_ROOT, 'previews')
+
+    class Meta:
+        prefix = 'drive'
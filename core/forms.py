@@ -1,27 +1,56 @@
 from django import forms
 from django.utils.translation import ugettext_lazy as _
-from core.models import Folder, File, Permission
+from core.models import Folder, File, Permission, Quota
+from core.permissions import PermissionCache
+
+
+def in_subtree(folder, root):
+    """Whether `folder` is `root` or below it, by tree position alone."""
+    return folder.tree_id == root.tree_id and root.lft <= folder.lft and folder.rght <= root.rght
+
+
+def can_add_to(form, folder):
+    """Whether the form's user may put things into `folder`: anywhere in their own drive, by tree position, or into
+    a shared folder they can edit."""
+    return in_subtree(folder, form.root) or \
+        form.permission_cache.has_permission(form.user, folder, Permission.CATEGORIES.edit)
+
+
+class FolderPickerWidget(forms.Widget):
+    """Folder id with a tree picker that loads one level or search result at a time (see core/js/folder-picker.js).
+
+    Only the selected folder is read to render it; folders are never enumerated.
+    """
+    template_name = 'core/widgets/folder_picker.html'
+
+    def __init__(self, root, exclude=None, attrs=None):
+        super().__init__(attrs)
+        self.root = root
+        self.exclude = exclude
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        selected = None
+        if value and str(value) != str(self.root.pk):
+            selected = Folder.objects.filter(pk=value).only('name').first()
+        context['widget'].update({'root': self.root, 'exclude': self.exclude, 'selected': selected})
+        return context
 
 
 class FolderForm(forms.ModelForm):
-    def __init__(self, user, *args, **kwargs):
+    def __init__(self, user, *args, permission_cache=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.user = user
-        self.fields['parent'].choices = self._get_folder_choices(user, self.instance)
-
-    def _get_folder_choices(self, user, instance):
-        root = Folder.objects.get_user_root(user)
-        descendants = root.get_descendants()
-        if instance:
-            descendants = descendants.exclude(id=instance.id)
-        folders = [(f.id, '%s %s' % ('---'*(f.level - root.level), f.name)) for f in descendants]
-        return [(root.id, _('Home'))] + folders
+        self.permission_cache = permission_cache or PermissionCache()
+        self.root = Folder.objects.get_user_root(user)
+        self.fields['parent'].widget = FolderPickerWidget(
+            self.root, exclude=self.instance if self.instance.pk else None)
 
     def clean_parent(self):
         parent = self.cleaned_data.get('parent')
-        if parent and parent == self.instance:
+        if parent and self.instance.pk and in_subtree(parent, self.instance):
             raise forms.ValidationError(_('Invalid parent.'))
-        if parent and not parent.has_permission(self.user, Permission.CATEGORIES.edit):
+        if parent and not can_add_to(self, parent):
             raise forms.ValidationError(_('Invalid parent.'))
         return parent
 
@@ -31,23 +60,28 @@ class FolderForm(forms.ModelForm):
 
 
 class FileForm(forms.ModelForm):
-    def __init__(self, user, *args, **kwargs):
+    def __init__(self, user, *args, permission_cache=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.user = user
-        self.fields['folder'].choices = self._get_folder_choices(user, self.instance)
-
-    def _get_folder_choices(self, user, instance):
-        root = Folder.objects.get_user_root(user)
-        descendants = root.get_descendants()
-        folders = [(f.id, '%s %s' % ('---'*(f.level - root.level), f.name)) for f in descendants]
-        return [(root.id, _('Home'))] + folders
+        self.permission_cache = permission_cache or PermissionCache()
+        self.root = Folder.objects.get_user_root(user)
+        self.fields['folder'].widget = FolderPickerWidget(self.root)
 
     def clean_folder(self):
         folder = self.cleaned_data.get('folder')
-        if folder and not folder.has_permission(self.user, Permission.CATEGORIES.edit):
+        if folder and not can_add_to(self, folder):
             raise forms.ValidationError(_('Invalid folder.'))
         return folder
 
+    def clean_file(self):
+        file = self.cleaned_data.get('file')
+        if file and 'file' in self.changed_data:
+            # A replaced file is counted against its owner, minus the content it replaces.
+            owner = self.instance.owner if self.instance.pk else self.user
+            if not Quota.objects.get_for_user(owner).allows(file.size - (self.instance.size or 0)):
+                raise forms.ValidationError(_('The file does not fit into the storage quota.'))
+        return file
+
     class Meta:
         model = File
         fields = ('folder', 'file', 'name', 'description')
@@ -0,0 +1,133 @@
+"""Bulk import of a local directory tree (see the ingest management command).
+
+Folders are inserted level by level with bulk_create and numbered with a single tree rebuild at
+the end. File contents are hashed and copied into the storage by a process pool and committed in
+batches, and folder counters are recounted once when everything is in. Existing folders and files
+(by name) are skipped, so an interrupted import is resumed by running it again.
+"""
+import hashlib
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from django.core.files import File as DjangoFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.utils.timezone import now
+from core import search
+from core.conf import settings
+from core.models import Folder, File, Access, Quota
+from core.utils import QUERY_CHUNK_SIZE, assign_slugs, chunks, generate_random_hex
+
+
+def store_file(path):
+    """(size, checksum, storage name) of a local file copied into the default storage; runs in a worker process."""
+    hasher = hashlib.sha256()
+    extension = os.path.splitext(path)[1]
+    if hasattr(default_storage, 'adopt'):
+        # Content addressed storage: hash while copying, then move the copy onto its blob.
+        tmp = os.path.join(default_storage.prefix, 'tmp', generate_random_hex(length=20))
+        os.makedirs(os.path.dirname(default_storage.path(tmp)), exist_ok=True)
+        with open(path, 'rb') as source, open(default_storage.path(tmp), 'wb') as target:
+            for chunk in iter(lambda: source.read(settings.DRIVE_UPLOAD_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+                target.write(chunk)
+        name = default_storage.adopt(tmp, default_storage.blob_name(hasher.hexdigest(), extension))
+    else:
+        with open(path, 'rb') as source:
+            for chunk in iter(lambda: source.read(settings.DRIVE_UPLOAD_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+            source.seek(0)
+            basename = os.path.splitext(os.path.basename(path))[0]
+            name = default_storage.save(os.path.join('files', now().date().strftime('%Y/%m/%d'), '%s_%s%s' % (
+                basename, generate_random_hex(length=10), extension)), DjangoFile(source))
+    return os.path.getsize(path), hasher.hexdigest(), name
+
+
+class Ingest:
+    def __init__(self, root, parent, owner, batch_size=1000, workers=None, log=None):
+        self.root = os.path.abspath(root)
+        self.parent = parent
+        self.owner = owner
+        self.batch_size = batch_size
+        self.workers = workers
+        self.log = log or (lambda message: None)
+        self.folders = {self.root: parent.pk}
+        self.created_folders = 0
+        self.created_files = 0
+        self.skipped_files = 0
+
+    def run(self):
+        files = {}
+        levels = defaultdict(list)
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            files[dirpath] = sorted(filenames)
+            for dirname in dirnames:
+                levels[dirpath.count(os.sep) - self.root.count(os.sep) + 1].append(os.path.join(dirpath, dirname))
+        for depth in sorted(levels):
+            for paths in chunks(levels[depth]):
+                self.create_folders(paths, depth)
+        # New folders were inserted unnumbered; number them before anything else is read.
+        Folder.objects.rebuild_tree(self.parent.tree_id)
+        self.log('%d folders created.' % self.created_folders)
+
+        # Worker processes must not inherit the open database connection.
+        connection.close()
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            pending = []
+            for dirpath in sorted(files):
+                existing = set(File.objects.filter(folder_id=self.folders[dirpath])
+                               .values_list('original_filename', flat=True))
+                for filename in files[dirpath]:
+                    if filename[:255] in existing:
+                        self.skipped_files += 1
+                    else:
+                        pending.append((self.folders[dirpath], filename, os.path.join(dirpath, filename)))
+                    if len(pending) >= self.batch_size:
+                        self.create_files(executor, pending)
+                        pending = []
+            if pending:
+                self.create_files(executor, pending)
+        # Counted once for the whole import; a resumed import recounts what an interrupted one left.
+        Folder.objects.reconcile_aggregates(Folder.objects.get(pk=self.parent.pk))
+        return self
+
+    def create_folders(self, paths, depth):
+        """Insert the folders of a chunk of directories at one depth, reusing existing ones."""
+        parent_ids = {self.folders[os.path.dirname(path)] for path in paths}
+        existing = {(parent_id, name): pk for parent_id, name, pk in
+                    Folder.objects.filter(parent_id__in=parent_ids).values_list('parent_id', 'name', 'id')}
+        new = {}
+        for path in paths:
+            parent_id, name = self.folders[os.path.dirname(path)], os.path.basename(path)[:255]
+            if (parent_id, name) in existing:
+                self.folders[path] = existing[parent_id, name]
+            else:
+                # Tree fields are filled in by rebuild_tree once all folders exist.
+                new[path] = Folder(name=name, parent_id=parent_id, owner=self.owner, tree_id=self.parent.tree_id,
+                                   level=self.parent.level + depth, lft=0, rght=0)
+        if not new:
+            return
+        assign_slugs(new.values())
+        with transaction.atomic():
+            Folder.objects.bulk_create(new.values())
+            ids = dict(Folder.objects.filter(slug__in=[f.slug for f in new.values()]).values_list('slug', 'id'))
+            for path, folder in new.items():
+                folder.pk = self.folders[path] = ids[folder.slug]
+                if depth == 1:
+                    Access.objects.sync_owner(folder)
+            search.index_bulk(Folder, ids)
+        self.created_folders += len(new)
+
+    def create_files(self, executor, pending):
+        stored = executor.map(store_file, [path for folder_id, filename, path in pending], chunksize=16)
+        files = [File(folder_id=folder_id, owner=self.owner, file=name, size=size, checksum=checksum,
+                      name=filename[:255], original_filename=filename[:255])
+                 for (folder_id, filename, path), (size, checksum, name) in zip(pending, stored)]
+        assign_slugs(files)
+        with transaction.atomic():
+            File.objects.bulk_create(files, batch_size=QUERY_CHUNK_SIZE)
+            search.index_bulk(File, [f.slug for f in files])
+            Quota.objects.add_usage(self.owner.pk, sum(f.size for f in files))
+        self.created_files += len(files)
+        self.log('%d files imported, %d skipped.' % (self.created_files, self.skipped_files))
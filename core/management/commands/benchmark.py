@@ -0,0 +1,56 @@
+import json
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from core import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Generate synthetic drives and time the main pages and operations on them. The drives are rolled back '
+            'unless --keep is given.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10, help='Number of users with a drive.')
+        parser.add_argument('--depth', type=int, default=3, help='Folder levels below every root.')
+        parser.add_argument('--fanout', type=int, default=4, help='Subfolders of every folder above the last level.')
+        parser.add_argument('--files', type=int, default=5, help='Files in every folder.')
+        parser.add_argument('--share-density', type=float, default=0.05,
+                            help='Share of folders and files shared with another user.')
+        parser.add_argument('--public-density', type=float, default=0.01,
+                            help='Share of folders and files shared with everybody.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the random shares.')
+        parser.add_argument('--prefix', default='benchmark', help='Prefix of the generated user names.')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs of every scenario.')
+        parser.add_argument('--keep', action='store_true', help='Commit the generated drives.')
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+        parser.add_argument('--baseline', help='Fail on scenarios that got worse than in these JSON results.')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed slowdown against the baseline as a fraction (default: 0.2).')
+
+    def handle(self, *args, **options):
+        if get_user_model().objects.filter(username__startswith=options['prefix'] + '-').exists():
+            raise CommandError('Users named "%s-..." already exist; pick another --prefix.' % options['prefix'])
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+        parameters = {name: options[name] for name in (
+            'users', 'depth', 'fanout', 'files', 'share_density', 'public_density', 'seed', 'prefix')}
+        try:
+            results = benchmark.run(repeat=options['repeat'], keep=options['keep'], **parameters)
+        except benchmark.BenchmarkError as e:
+            raise CommandError(e)
+
+        self.stdout.write('%-22s %10s %10s %8s' % ('scenario', 'median ms', 'min ms', 'queries'))
+        for name, result in results['results'].items():
+            self.stdout.write('%-22s %10.1f %10.1f %8d' % (name, result['median_ms'], result['min_ms'],
+                                                           result['queries']))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+        if baseline is not None:
+            if baseline['parameters'] != results['parameters']:
+                self.stderr.write('The baseline was measured with other parameters: %s' % baseline['parameters'])
+            regressions = benchmark.compare(results, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError('Worse than the baseline:\n' + '\n'.join(regressions))
+            self.stdout.write('No regressions against the baseline.')
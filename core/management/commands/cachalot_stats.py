@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from core import cachestats
+from core.conf import settings
+
+
+class Command(BaseCommand):
+    help = 'Show per-table hits, misses and invalidations of the query cache (needs DRIVE_CACHALOT_STATS).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Set all counters back to zero.')
+
+    def handle(self, *args, **options):
+        if not settings.DRIVE_CACHALOT_STATS:
+            raise CommandError('DRIVE_CACHALOT_STATS is not enabled.')
+        if options['reset']:
+            cachestats.reset()
+            self.stdout.write('Counters reset.')
+            return
+        stats = cachestats.get_stats()
+        self.stdout.write('%-30s %10s %10s %8s %14s' % ('table', 'hits', 'misses', 'hit rate', 'invalidations'))
+        for table, counts in sorted(stats.items(), key=lambda item: -sum(item[1].values())):
+            lookups = counts['hits'] + counts['misses']
+            self.stdout.write('%-30s %10d %10d %7.1f%% %14d' % (
+                table, counts['hits'], counts['misses'], 100.0 * counts['hits'] / lookups if lookups else 0,
+                counts['invalidations']))
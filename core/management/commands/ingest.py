@@ -0,0 +1,31 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from core.ingest import Ingest
+from core.models import Folder
+
+
+class Command(BaseCommand):
+    help = 'Import a local directory tree into the drive of a user. Run it again to resume an interrupted import.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Directory to import.')
+        parser.add_argument('username', help='Owner of the imported folders and files.')
+        parser.add_argument('--folder', help='Slug of the target folder (default: root folder of the user).')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Files committed per transaction.')
+        parser.add_argument('--workers', type=int, default=None, help='Hashing processes (default: CPU count).')
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user_model().objects.get_by_natural_key(options['username'])
+        except get_user_model().DoesNotExist:
+            raise CommandError('User "%s" does not exist.' % options['username'])
+        if options['folder']:
+            parent = Folder.objects.filter(slug=options['folder']).first()
+            if parent is None:
+                raise CommandError('Folder "%s" does not exist.' % options['folder'])
+        else:
+            parent = Folder.objects.get_user_root(user)
+        ingest = Ingest(options['path'], parent, user, batch_size=options['batch_size'], workers=options['workers'],
+                        log=self.stdout.write if options['verbosity'] else None).run()
+        self.stdout.write('Imported %d folders and %d files (%d files already existed).' % (
+            ingest.created_folders, ingest.created_files, ingest.skipped_files))
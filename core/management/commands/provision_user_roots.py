@@ -0,0 +1,31 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from core.models import Folder, Access
+from core.utils import QUERY_CHUNK_SIZE, assign_slugs, chunks
+
+
+class Command(BaseCommand):
+    help = 'Create the root folders of users that have none yet (users created from now on get one right away).'
+
+    def handle(self, *args, **options):
+        existing = Folder.objects.filter(level=0, tree_id=F('owner_id'))
+        users = get_user_model().objects.exclude(pk__in=existing.values('owner_id'))
+        created = 0
+        with transaction.atomic():
+            for chunk in chunks(list(users.order_by('pk'))):
+                for tree_id in set(Folder.objects.filter(tree_id__in=[user.pk for user in chunk])
+                                   .values_list('tree_id', flat=True)):
+                    Folder.objects._move_tree_away(tree_id)
+                # Every root is a tree of its own (see FolderManager.create_user_root), already numbered.
+                roots = [Folder(name=str(user.pk), parent=None, owner=user, tree_id=user.pk, level=0, lft=1, rght=2)
+                         for user in chunk]
+                assign_slugs(roots)
+                Folder.objects.bulk_create(roots, batch_size=QUERY_CHUNK_SIZE)
+                ids = dict(Folder.objects.filter(slug__in=[f.slug for f in roots]).values_list('slug', 'id'))
+                for root in roots:
+                    root.pk = ids[root.slug]
+                Access.objects.sync_owners(roots)
+                created += len(roots)
+        self.stdout.write('Created %d user root folders.' % created)
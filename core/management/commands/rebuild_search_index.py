@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from core import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index of folders and files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-contents', action='store_false', dest='contents',
+                            help='Only index names and descriptions, skip text extraction of documents.')
+
+    def handle(self, *args, **options):
+        if not search.is_supported():
+            self.stderr.write('The database has no full-text index, nothing to do.')
+            return
+        count = search.rebuild(contents=options['contents'])
+        self.stdout.write('Indexed %d folders and files.' % count)
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from core.models import Folder, Quota
+
+
+class Command(BaseCommand):
+    help = 'Recount the file, folder and size counters of all folders and the usage of all quotas, ' \
+           'and fix the ones that drifted.'
+
+    def handle(self, *args, **options):
+        fixed = sum(Folder.objects.reconcile_aggregates(root) for root in Folder.objects.root_nodes())
+        self.stdout.write('Fixed the counters of %d folders.' % fixed)
+        self.stdout.write('Fixed the usage of %d quotas.' % Quota.objects.reconcile())
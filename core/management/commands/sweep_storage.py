@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from core import sweeper
+
+
+class Command(BaseCommand):
+    help = 'Delete stored files, partial uploads and previews nothing refers to any more.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only count what would be deleted.')
+
+    def handle(self, *args, **options):
+        for kind, count in sweeper.sweep(dry_run=options['dry_run']).items():
+            self.stdout.write('%s: %d' % (kind, count))
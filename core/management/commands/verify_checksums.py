@@ -0,0 +1,38 @@
+from collections import Counter
+from itertools import groupby
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from core.models import File
+from core.utils import file_checksum
+
+
+class Command(BaseCommand):
+    help = 'Recompute the checksums of stored files and report contents that changed or went missing.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fill', action='store_true', help='Store the checksum of files that have none yet.')
+
+    def handle(self, *args, **options):
+        counts = Counter()
+        rows = File.objects.order_by('file').values_list('file', 'checksum').iterator()
+        # Files sharing stored content are verified with a single read.
+        for name, group in groupby(rows, key=lambda row: row[0]):
+            expected = {checksum for name, checksum in group}
+            try:
+                with default_storage.open(name, 'rb') as content:
+                    actual = file_checksum(content)
+            except OSError:
+                counts['missing'] += 1
+                self.stderr.write('Missing: %s' % name)
+                continue
+            if expected - {'', actual}:
+                counts['corrupt'] += 1
+                self.stderr.write('Checksum mismatch: %s' % name)
+            elif '' in expected and options['fill']:
+                counts['filled'] += File.objects.filter(file=name, checksum='').update(checksum=actual)
+            else:
+                counts['ok'] += 1
+        for kind in ('ok', 'filled', 'missing', 'corrupt'):
+            self.stdout.write('%s: %d' % (kind, counts[kind]))
+        if counts['missing'] or counts['corrupt']:
+            raise CommandError('%d stored files failed verification.' % (counts['missing'] + counts['corrupt']))
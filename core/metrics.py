@@ -0,0 +1,239 @@
+"""Per-request performance counters, aggregated per view for Prometheus (see core.middleware.MetricsMiddleware).
+
+While a request is handled, its queries and their time, lookups of the query cache (cachalot) and
+of the app caches (core.cache), permission checks and bytes read from and written to the storage
+are counted for it. Requests slower than DRIVE_METRICS_SLOW seconds are logged as one JSON line.
+Durations and query counts go into per-view histograms and everything else into per-view totals.
+Streamed responses (downloads) take as long as the client needs to receive them, so they are only
+counted in the totals and neither in the histograms nor in the slow request log.
+Like core.cachestats, these are buffered in each process and added to the shared cache (DRIVE_CACHE)
+every DRIVE_METRICS_FLUSH requests, so the metrics endpoint shows all workers together.
+"""
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from django.core.cache import caches
+from django.core.files.storage import FileSystemStorage
+from django.db.backends import utils
+from core.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Counted per request by count(); times are in seconds.
+COUNTERS = ('queries', 'query_time', 'cachalot_hits', 'cachalot_misses', 'cache_hits', 'cache_misses',
+            'permission_checks', 'storage_read_bytes', 'storage_written_bytes')
+# Exported totals: counter -> (metric name, help, scale of the stored integer).
+TOTALS = (
+    ('query_time', 'drive_query_seconds_total', 'Time spent in database queries.', 1000000),
+    ('cachalot_hits', 'drive_cachalot_hits_total', 'Queries answered by the query cache.', 1),
+    ('cachalot_misses', 'drive_cachalot_misses_total', 'Cachable queries sent to the database.', 1),
+    ('cache_hits', 'drive_cache_hits_total', 'Lookups found in the app caches.', 1),
+    ('cache_misses', 'drive_cache_misses_total', 'Lookups missing in the app caches.', 1),
+    ('permission_checks', 'drive_permission_checks_total', 'Permission checks.', 1),
+    ('storage_read_bytes', 'drive_storage_read_bytes_total', 'Bytes read from the storage.', 1),
+    ('storage_written_bytes', 'drive_storage_written_bytes_total', 'Bytes written to the storage.', 1),
+    ('streamed_requests', 'drive_streamed_requests_total', 'Streamed responses (not in the histograms).', 1),
+)
+# Histograms: observed value -> (metric name, help, setting with the bucket bounds, scale of the stored sum).
+HISTOGRAMS = (
+    ('duration', 'drive_request_duration_seconds', 'Time to handle a request.', 'DRIVE_METRICS_DURATION_BUCKETS',
+     1000000),
+    ('queries', 'drive_request_queries', 'Database queries of a request.', 'DRIVE_METRICS_QUERY_BUCKETS', 1),
+)
+
+_local = threading.local()
+_series = Counter()
+_pending = 0
+_lock = threading.Lock()
+_installed = False
+
+
+def start():
+    """Count for the request handled by this thread from now on; returns its counters."""
+    _local.counters = Counter()
+    _local.start = time.perf_counter()
+    return _local.counters
+
+
+def count(name, amount=1):
+    counters = getattr(_local, 'counters', None)
+    if counters is not None:
+        counters[name] += amount
+
+
+def finish(counters, view, method, path, status, streamed=False):
+    """Stop counting for the request of `counters` and record it; returns its duration.
+
+    Nothing is recorded when this thread moved on to another request in the meantime.
+    """
+    if counters is None or getattr(_local, 'counters', None) is not counters:
+        return None
+    _local.counters = None
+    duration = time.perf_counter() - _local.start
+    if streamed:
+        counters['streamed_requests'] += 1
+    elif duration >= settings.DRIVE_METRICS_SLOW:
+        logger.warning(json.dumps(dict(
+            {'event': 'slow_request', 'view': view, 'method': method, 'path': path, 'status': status,
+             'duration': round(duration, 4)},
+            **{name: round(counters[name], 4) for name in COUNTERS})))
+    record(view, duration, counters)
+    return duration
+
+
+def _observe(series, view, name, value, buckets):
+    for bound in buckets:
+        if value <= bound:
+            series[view, '%s_bucket:%s' % (name, bound)] += 1
+
+
+def record(view, duration, counters):
+    global _pending
+    with _lock:
+        if not counters['streamed_requests']:
+            _series[view, 'requests'] += 1
+            observed = {'duration': duration, 'queries': counters['queries']}
+            for name, metric, help_text, buckets, scale in HISTOGRAMS:
+                _observe(_series, view, name, observed[name], getattr(settings, buckets))
+                _series[view, name + '_sum'] += int(observed[name] * scale)
+        for name, metric, help_text, scale in TOTALS:
+            _series[view, name] += int(counters[name] * scale)
+        _pending += 1
+        full = _pending >= settings.DRIVE_METRICS_FLUSH
+    if full:
+        flush()
+
+
+def _key(view, series):
+    return 'drive:metrics:%s:%s' % (view, series)
+
+
+def flush():
+    """Add the series of this process to the shared ones."""
+    global _pending
+    with _lock:
+        series = dict(_series)
+        _series.clear()
+        _pending = 0
+    if not series:
+        return
+    cache = caches[settings.DRIVE_CACHE]
+    try:
+        # A lost update of the view list is repaired by the next flush of the same views.
+        views = cache.get('drive:metrics:views', set())
+        if not {view for view, name in series} <= views:
+            cache.set('drive:metrics:views', views | {view for view, name in series}, None)
+        for (view, name), value in series.items():
+            cache.add(_key(view, name), 0, None)
+            cache.incr(_key(view, name), value)
+    except Exception as e:
+        logger.warning('Metrics could not be flushed: %s', e)
+
+
+def _series_names():
+    names = ['requests'] + [name for name, metric, help_text, scale in TOTALS]
+    for name, metric, help_text, buckets, scale in HISTOGRAMS:
+        names += [name + '_sum'] + ['%s_bucket:%s' % (name, bound) for bound in getattr(settings, buckets)]
+    return names
+
+
+def _label(view):
+    return 'view="%s"' % view.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render():
+    """All series in the Prometheus text exposition format."""
+    flush()
+    cache = caches[settings.DRIVE_CACHE]
+    views = sorted(cache.get('drive:metrics:views', set()))
+    values = cache.get_many([_key(view, name) for view in views for name in _series_names()])
+
+    def value(view, name, scale=1):
+        number = values.get(_key(view, name), 0)
+        return number / scale if scale > 1 else number
+
+    lines = []
+    for name, metric, help_text, buckets, scale in HISTOGRAMS:
+        lines += ['# HELP %s %s' % (metric, help_text), '# TYPE %s histogram' % metric]
+        for view in views:
+            label = _label(view)
+            for bound in getattr(settings, buckets):
+                lines.append('%s_bucket{%s,le="%s"} %d' % (
+                    metric, label, bound, value(view, '%s_bucket:%s' % (name, bound))))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (metric, label, value(view, 'requests')))
+            lines.append('%s_sum{%s} %s' % (metric, label, value(view, name + '_sum', scale)))
+            lines.append('%s_count{%s} %d' % (metric, label, value(view, 'requests')))
+    for name, metric, help_text, scale in TOTALS:
+        lines += ['# HELP %s %s' % (metric, help_text), '# TYPE %s counter' % metric]
+        for view in views:
+            lines.append('%s{%s} %s' % (metric, _label(view), value(view, name, scale)))
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    with _lock:
+        _series.clear()
+    cache = caches[settings.DRIVE_CACHE]
+    views = cache.get('drive:metrics:views', set())
+    cache.delete_many([_key(view, name) for view in views for name in _series_names()] + ['drive:metrics:views'])
+
+
+class CountingFile:
+    """Proxy of a file opened from the storage that counts the bytes read from it."""
+
+    def __init__(self, file):
+        self._file = file
+
+    def read(self, *args):
+        data = self._file.read(*args)
+        count('storage_read_bytes', len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+def _counted_query(method):
+    def counted(self, *args, **kwargs):
+        if getattr(_local, 'counters', None) is None:
+            return method(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            count('queries')
+            count('query_time', time.perf_counter() - start)
+    return counted
+
+
+def _count_cachalot(hit, table_cache_keys):
+    count('cachalot_hits' if hit else 'cachalot_misses')
+
+
+def install():
+    """Count queries, query cache lookups and storage traffic of requests from now on (once per process)."""
+    global _installed
+    if _installed:
+        return
+    _installed = True
+    utils.CursorWrapper.execute = _counted_query(utils.CursorWrapper.execute)
+    utils.CursorWrapper.executemany = _counted_query(utils.CursorWrapper.executemany)
+
+    open_file, save = FileSystemStorage._open, FileSystemStorage._save
+
+    def counted_open(self, name, mode='rb'):
+        file = open_file(self, name, mode)
+        file.file = CountingFile(file.file)
+        return file
+
+    def counted_save(self, name, content):
+        count('storage_written_bytes', getattr(content, 'size', None) or 0)
+        return save(self, name, content)
+
+    FileSystemStorage._open, FileSystemStorage._save = counted_open, counted_save
+
+    if 'cachalot' in settings.INSTALLED_APPS:
+        from core import cachestats
+        cachestats.add_listener(_count_cachalot)
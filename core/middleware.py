@@ -0,0 +1,32 @@
+from functools import partial
+from core import metrics
+
+
+class MetricsMiddleware:
+    """Counts queries, cache lookups, permission checks and storage traffic of every request per view.
+
+    See core.metrics. Streamed responses are counted until their last chunk has been sent and recorded apart.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        metrics.install()
+
+    def __call__(self, request):
+        counters = metrics.start()
+        response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        finish = partial(metrics.finish, counters, match.view_name if match else 'unresolved', request.method,
+                         request.path, response.status_code)
+        if response.streaming:
+            response.streaming_content = self.finish_after(response.streaming_content, partial(finish, streamed=True))
+        else:
+            finish()
+        return response
+
+    @staticmethod
+    def finish_after(content, finish):
+        try:
+            yield from content
+        finally:
+            finish()
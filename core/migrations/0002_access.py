@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.14 on 2026-10-18 09:47
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_access(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Folder = apps.get_model('core', 'Folder')
+    Permission = apps.get_model('core', 'Permission')
+    Access = apps.get_model('core', 'Access')
+    folder_ct = ContentType.objects.filter(app_label='core', model='folder').first()
+    entries = []
+    for permission in Permission.objects.iterator():
+        is_folder = folder_ct is not None and permission.content_type_id == folder_ct.id
+        entries.append(Access(
+            permission=permission,
+            folder_id=permission.object_id if is_folder else None,
+            file_id=None if is_folder else permission.object_id,
+            user_id=permission.user_id,
+            everybody=permission.everybody,
+            category=permission.category,
+        ))
+    for folder in Folder.objects.exclude(owner=None).select_related('parent').iterator():
+        if folder.owner_id != (folder.parent.owner_id if folder.parent else None):
+            entries.extend(Access(folder=folder, user_id=folder.owner_id, category=category) for category in 'rw')
+    Access.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Access',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('everybody', models.BooleanField(default=False)),
+                ('category', models.CharField(choices=[('r', 'View'), ('w', 'Edit')], max_length=10)),
+                ('file', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.File')),
+                ('folder', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Folder')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='permission',
+            index_together=set([('content_type', 'object_id')]),
+        ),
+        migrations.AddField(
+            model_name='access',
+            name='permission',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Permission'),
+        ),
+        migrations.AddField(
+            model_name='access',
+            name='user',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterIndexTogether(
+            name='access',
+            index_together=set([('user', 'category'), ('everybody', 'category')]),
+        ),
+        migrations.RunPython(populate_access, migrations.RunPython.noop),
+    ]
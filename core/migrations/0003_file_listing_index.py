@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.14 on 2026-10-18 09:49
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_access'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='file',
+            index_together=set([('folder', 'name', 'original_filename', 'id')]),
+        ),
+    ]
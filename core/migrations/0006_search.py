@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.14 on 2026-10-18 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    # FTS5 is SQLite only; other databases are searched with LIKE queries (see core.search).
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute("CREATE VIRTUAL TABLE core_search USING fts5("
+                          "name, description, content, tokenize = 'unicode61 remove_diacritics 1')")
+    schema_editor.execute("INSERT INTO core_search (rowid, name, description, content) "
+                          "SELECT id * 2, name, COALESCE(description, ''), '' FROM core_folder WHERE level > 1")
+    schema_editor.execute("INSERT INTO core_search (rowid, name, description, content) "
+                          "SELECT id * 2 + 1, name || ' ' || original_filename, COALESCE(description, ''), '' "
+                          "FROM core_file")
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE core_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_file_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.14 on 2026-10-18 14:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def count_aggregates(apps, schema_editor):
+    # Direct counters first, then totals as sums over the nested set range; the Users container stays at zero.
+    schema_editor.execute(
+        "UPDATE core_folder SET "
+        "file_count = (SELECT COUNT(*) FROM core_file WHERE core_file.folder_id = core_folder.id), "
+        "size = (SELECT COALESCE(SUM(size), 0) FROM core_file WHERE core_file.folder_id = core_folder.id), "
+        "folder_count = (SELECT COUNT(*) FROM core_folder child WHERE child.parent_id = core_folder.id) "
+        "WHERE level > 0")
+    schema_editor.execute(
+        "UPDATE core_folder SET "
+        "total_file_count = (SELECT SUM(d.file_count) FROM core_folder d WHERE d.tree_id = core_folder.tree_id "
+        "AND d.lft BETWEEN core_folder.lft AND core_folder.rght), "
+        "total_size = (SELECT SUM(d.size) FROM core_folder d WHERE d.tree_id = core_folder.tree_id "
+        "AND d.lft BETWEEN core_folder.lft AND core_folder.rght), "
+        "total_folder_count = (rght - lft - 1) / 2 "
+        "WHERE level > 0")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='folder',
+            name='file_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='files'),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='folder_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='folders'),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='size',
+            field=models.BigIntegerField(default=0, editable=False, verbose_name='size'),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='total_file_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='files in total'),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='total_folder_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='folders in total'),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='total_size',
+            field=models.BigIntegerField(default=0, editable=False, verbose_name='total size'),
+        ),
+        migrations.RunPython(count_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.14 on 2026-10-18 15:21
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0007_folder_aggregates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Quota',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('limit', models.BigIntegerField(blank=True, help_text='Bytes; empty for the default limit (DRIVE_QUOTA).', null=True, verbose_name='limit')),
+                ('usage', models.BigIntegerField(default=0, editable=False, verbose_name='usage')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='quota', to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'quota',
+                'verbose_name_plural': 'quotas',
+            },
+        ),
+    ]
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.14 on 2026-10-18 18:20
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import F, Max
+
+
+def split_user_trees(apps, schema_editor):
+    # Every user root under the Users container becomes a tree of its own, numbered by the user id, and
+    # every other tree gets a negative id, like the trees created from now on (see FolderManager).
+    # User trees are first given negative ids, so they never meet a tree that still has to be renumbered.
+    # Anything else found in a container becomes a tree of its own under a fresh id.
+    Folder = apps.get_model('core', 'Folder')
+    old_ids = set(Folder.objects.order_by().values_list('tree_id', flat=True).distinct())
+    next_id = (Folder.objects.aggregate(ids=Max('tree_id'))['ids'] or 0) + 1
+    for container in Folder.objects.filter(parent=None, owner=None, name='Users'):
+        for child in Folder.objects.filter(parent=container).order_by('lft'):
+            if child.owner_id is not None and child.name == str(child.owner_id):
+                if Folder.objects.filter(tree_id=-child.owner_id).exists():
+                    raise RuntimeError('User %s has more than one root folder (%s).' % (child.owner_id, child.pk))
+                tree_id = -child.owner_id
+            else:
+                tree_id, next_id = next_id, next_id + 1
+            Folder.objects.filter(tree_id=container.tree_id, lft__gte=child.lft, rght__lte=child.rght).update(
+                tree_id=tree_id, lft=F('lft') - (child.lft - 1), rght=F('rght') - (child.lft - 1),
+                level=F('level') - 1)
+            Folder.objects.filter(pk=child.pk).update(parent=None)
+        container.delete()
+    Folder.objects.update(tree_id=F('tree_id') * -1)
+    invalidate_trees(Folder, old_ids)
+
+
+def join_user_trees(apps, schema_editor):
+    Folder = apps.get_model('core', 'Folder')
+    old_ids = set(Folder.objects.order_by().values_list('tree_id', flat=True).distinct())
+    roots = list(Folder.objects.filter(parent=None, tree_id__gt=0).order_by('name'))
+    # Tree 0 is never used: user trees are numbered from 1 and the other trees from -1 downwards.
+    container = Folder.objects.create(name='Users', parent=None, owner=None, slug='users',
+                                      tree_id=0, lft=1, rght=2, level=0)
+    right = 2
+    for root in roots:
+        Folder.objects.filter(tree_id=root.tree_id).update(
+            tree_id=0, lft=F('lft') + (right - 1), rght=F('rght') + (right - 1), level=F('level') + 1)
+        Folder.objects.filter(pk=root.pk).update(parent=container)
+        right += root.rght - root.lft + 1
+    Folder.objects.filter(pk=container.pk).update(rght=right)
+    Folder.objects.filter(tree_id__lt=0).update(tree_id=F('tree_id') * -1)
+    offset = (Folder.objects.aggregate(ids=Max('tree_id'))['ids'] or 0) + 1
+    Folder.objects.filter(tree_id=0).update(tree_id=offset)
+    invalidate_trees(Folder, old_ids)
+
+
+def invalidate_trees(Folder, old_ids):
+    # Cached ancestor chains and roots are keyed by tree id, and the ids now mean other trees.
+    from core.cache import invalidate_tree
+    new_ids = set(Folder.objects.order_by().values_list('tree_id', flat=True).distinct())
+    for tree_id in old_ids | new_ids:
+        invalidate_tree(tree_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_file_size_64bit'),
+    ]
+
+    operations = [
+        migrations.RunPython(split_user_trees, join_user_trees),
+    ]
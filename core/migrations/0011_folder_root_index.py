@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.14 on 2026-10-18 21:05
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def create_root_index(apps, schema_editor):
+    # One root per tree, so concurrent creations of a user root fail instead of sharing the tree
+    # (see FolderManager.create_user_root). MySQL has no partial indexes and relies on a row lock.
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute('CREATE UNIQUE INDEX core_folder_tree_root ON core_folder (tree_id) WHERE level = 0')
+
+
+def drop_root_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute('DROP INDEX core_folder_tree_root')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_user_trees'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_root_index, drop_root_index),
+    ]
@@ -1,27 +1,216 @@
 import os
+from collections import defaultdict
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Case, Count, F, Min, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 from model_utils import Choices
 from mptt.managers import TreeManager
 from mptt.models import MPTTModel, TreeForeignKey
-from core.utils import generate_random_hex
+from core import metrics
+from core.cache import get_ancestor_chain, get_user_root_values, invalidate_tree
+from core.conf import settings
+from core.utils import QUERY_CHUNK_SIZE, chunks, generate_random_hex, generate_slug
 
+# Direct counters cover the files and subfolders in a folder, totals everything below it.
+AGGREGATE_FIELDS = ('file_count', 'folder_count', 'size', 'total_file_count', 'total_folder_count', 'total_size')
 
-class FolderManager(TreeManager, models.Manager):
-    def get_user_root(self, user):
-        """Get user root folder (and create if necessary)."""
-        users_folder, created = self.get_or_create(name='Users', parent=None, owner=None)
-        user_root, created = self.get_or_create(name=str(user.id), parent=users_folder, owner=user)
-        return user_root
+
+class RandomSlugMixin:
+    """Sets a random slug on the first save without looking for an existing one first.
+
+    The unique constraint is the guard: a collision is retried with a new slug.
+    """
+    SLUG_ATTEMPTS = 3
+
+    def save(self, *args, **kwargs):
+        if self.slug:
+            return super().save(*args, **kwargs)
+        tree_fields = {}
+        if isinstance(self, MPTTModel):
+            opts = self._mptt_meta
+            tree_fields = {attname: getattr(self, attname)
+                           for attname in (opts.tree_id_attr, opts.left_attr, opts.right_attr, opts.level_attr)}
+        for attempt in range(self.SLUG_ATTEMPTS):
+            self.slug = generate_slug()
+            try:
+                with transaction.atomic():
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                collision = type(self).objects.filter(slug=self.slug).exists()
+                self.slug = ''
+                if not collision or attempt + 1 == self.SLUG_ATTEMPTS:
+                    raise
+                # The tree update of the failed insert was rolled back, but MPTT left its position on the node.
+                for attname, value in tree_fields.items():
+                    setattr(self, attname, value)
+                if tree_fields and self.parent_id:
+                    self.parent._mptt_refresh()
 
 
-class Folder(MPTTModel):
+class FolderManager(TreeManager, models.Manager):
+    def get_user_root(self, user):
+        """Get user root folder, without queries while its tree is unchanged (created if necessary).
+
+        Roots are created with their users (see core.signals); the counters of a cached root may lag behind.
+        """
+        fields = [field.attname for field in self.model._meta.concrete_fields]
+
+        def load():
+            row = self.filter(tree_id=user.pk, level=0, owner=user).values_list(*fields).first()
+            return dict(zip(fields, row)) if row else None
+
+        values = get_user_root_values(user.pk, load)
+        if values is None:
+            return self.create_user_root(user)
+        return self.model.from_db(self.db, fields, [values[field] for field in fields])
+
+    def create_user_root(self, user):
+        """Root folder of a new user, the root of its own tree numbered by the user id.
+
+        Every user's drive is a separate tree, so changes in one drive never renumber or lock the rows of
+        another. Within a drive, inserts and moves still renumber the nested set, so they cost time in proportion
+        to the size of that drive (see the folder_create and folder_move benchmark scenarios). Other trees get
+        negative ids (see _get_next_tree_id), so the id is free unless the database was changed by hand; such a
+        tree is moved away first. Of concurrent creations of the same root only one gets past the unique index
+        on the tree id of roots (migration 0011); the others load its root. MySQL has no such index, so there
+        the user row is locked instead.
+        """
+        try:
+            with transaction.atomic():
+                get_user_model().objects.select_for_update().filter(pk=user.pk).exists()
+                root = self.filter(tree_id=user.pk, level=0, owner=user).first()
+                if root is None:
+                    self._move_tree_away(user.pk)
+                    # Tree fields set in advance make MPTT store the node as it is instead of taking the next
+                    # tree id.
+                    root = self.create(name=str(user.pk), parent=None, owner=user, tree_id=user.pk, lft=1, rght=2,
+                                       level=0)
+                return root
+        except IntegrityError:
+            # Created concurrently.
+            root = self.filter(tree_id=user.pk, level=0, owner=user).first()
+            if root is None:
+                raise
+            return root
+
+    def _move_tree_away(self, tree_id):
+        """Give a tree found on the id of a user tree (which needs it) a new id."""
+        if self.filter(tree_id=tree_id).update(tree_id=self._get_next_tree_id()):
+            invalidate_tree(tree_id)
+
+    def _get_next_tree_id(self):
+        """Trees other than user drives are numbered downwards from -1, out of the way of the user ids."""
+        lowest = self.aggregate(tree_id=Min('tree_id'))['tree_id'] or 0
+        return min(lowest, 0) - 1
+
+    def _create_tree_space(self, target_tree_id, num_trees=1):
+        # MPTT closes the gap of a tree that became a subtree by renumbering every later tree, which would
+        # move user trees off their ids; the gap is left instead.
+        if num_trees > 0:
+            super()._create_tree_space(target_tree_id, num_trees)
+
+    def rebuild(self):
+        """Like mptt rebuild, but keeps the tree ids (user trees are numbered by their users)."""
+        for tree_id in self.order_by().values_list('tree_id', flat=True).distinct():
+            self.rebuild_tree(tree_id)
+
+    def rebuild_tree(self, tree_id):
+        """Like partial_rebuild, but numbers the tree in memory and only writes the rows that changed."""
+        children = defaultdict(list)
+        for row in self.filter(tree_id=tree_id).values_list('pk', 'parent_id', 'name', 'lft', 'rght', 'level'):
+            children[row[1]].append(row)
+        for siblings in children.values():
+            siblings.sort(key=lambda row: (row[2], row[3]))
+        updates, lefts, counter = [], {}, 0
+        for root in children[None]:
+            counter += 1
+            lefts[root[0]] = counter
+            stack = [(root, 0, iter(children[root[0]]))]
+            while stack:
+                node, level, pending = stack[-1]
+                child = next(pending, None)
+                if child is None:
+                    stack.pop()
+                    counter += 1
+                    if (lefts[node[0]], counter, level) != node[3:]:
+                        updates.append((lefts[node[0]], counter, level, node[0]))
+                else:
+                    counter += 1
+                    lefts[child[0]] = counter
+                    stack.append((child, level + 1, iter(children[child[0]])))
+        with connection.cursor() as cursor:
+            cursor.executemany('UPDATE %s SET lft = %%s, rght = %%s, level = %%s WHERE id = %%s'
+                               % connection.ops.quote_name(self.model._meta.db_table), updates)
+        invalidate_tree(tree_id)
+        return len(updates)
+
+    def add_to_aggregates(self, folder_id, files=0, folders=0, size=0, total=None):
+        """Add to the direct counters of a folder and to the totals of it and its ancestors in one update.
+
+        `total` is the (files, folders, size) change of the totals when it differs from the direct one,
+        i.e. when a whole subtree comes or goes.
+        """
+        total_files, total_folders, total_size = total or (files, folders, size)
+        if not any((files, folders, size, total_files, total_folders, total_size)):
+            return 0
+        position = self.filter(pk=folder_id).values_list('tree_id', 'lft', 'rght').first()
+        if position is None:
+            return 0
+        tree_id, lft, rght = position
+
+        def direct(value):
+            return Case(When(pk=folder_id, then=Value(value)), default=Value(0), output_field=models.BigIntegerField())
+
+        return self.filter(tree_id=tree_id, lft__lte=lft, rght__gte=rght).update(
+            file_count=F('file_count') + direct(files), folder_count=F('folder_count') + direct(folders),
+            size=F('size') + direct(size), total_file_count=F('total_file_count') + total_files,
+            total_folder_count=F('total_folder_count') + total_folders, total_size=F('total_size') + total_size)
+
+    def reconcile_aggregates(self, folder):
+        """Recount the subtree of `folder` from its rows and fix the counters that drifted.
+
+        A changed total of `folder` itself is passed on to its ancestors. Returns the number of fixed folders.
+        """
+        subtree = self.filter(tree_id=folder.tree_id, lft__gte=folder.lft, rght__lte=folder.rght)
+        rows = list(subtree.order_by('-level').values_list('pk', 'parent_id', *AGGREGATE_FIELDS))
+        counters = {row[0]: [0] * len(AGGREGATE_FIELDS) for row in rows}
+        files = File.objects.filter(folder__in=subtree).order_by().values('folder') \
+            .annotate(count=Count('pk'), size=Sum('size')).values_list('folder', 'count', 'size')
+        for folder_id, count, size in files:
+            counters[folder_id][0] = counters[folder_id][3] = count
+            counters[folder_id][2] = counters[folder_id][5] = size or 0
+        # Deepest first, so the totals of a folder are complete before they are added to its parent.
+        for pk, parent_id, *stored in rows:
+            if parent_id in counters:
+                parent, own = counters[parent_id], counters[pk]
+                parent[1] += 1
+                parent[3] += own[3]
+                parent[4] += own[4] + 1
+                parent[5] += own[5]
+        updates, difference = [], None
+        for pk, parent_id, *stored in rows:
+            counted = counters[pk]
+            if counted != stored:
+                updates.append(counted + [pk])
+            if pk == folder.pk:
+                difference = [new - old for new, old in zip(counted[3:], stored[3:])]
+        with connection.cursor() as cursor:
+            cursor.executemany('UPDATE %s SET %s WHERE id = %%s' % (
+                connection.ops.quote_name(self.model._meta.db_table),
+                ', '.join('%s = %%s' % field for field in AGGREGATE_FIELDS)), updates)
+        if folder.parent_id and difference:
+            self.add_to_aggregates(folder.parent_id, total=difference)
+        return len(updates)
+
+
+class Folder(RandomSlugMixin, MPTTModel):
     name = models.CharField(_('name'), max_length=255)
     parent = TreeForeignKey('self', verbose_name=_('parent'), related_name='children', null=True, blank=False,
                             on_delete=models.CASCADE)
@@ -32,12 +221,15 @@ class Folder(MPTTModel):
     created = models.DateTimeField(_('created'), auto_now_add=True)
     modified = models.DateTimeField(_('modified'), auto_now=True)
     permissions = GenericRelation('Permission')
+    file_count = models.PositiveIntegerField(_('files'), default=0, editable=False)
+    folder_count = models.PositiveIntegerField(_('folders'), default=0, editable=False)
+    size = models.BigIntegerField(_('size'), default=0, editable=False)
+    total_file_count = models.PositiveIntegerField(_('files in total'), default=0, editable=False)
+    total_folder_count = models.PositiveIntegerField(_('folders in total'), default=0, editable=False)
+    total_size = models.BigIntegerField(_('total size'), default=0, editable=False)
 
     objects = FolderManager()
 
-    class MPTTMeta:
-        order_insertion_by = ('name',)
-
     class Meta:
         unique_together = (('parent', 'name'),)
         ordering = ('name',)
@@ -49,33 +241,42 @@ class Folder(MPTTModel):
 
     @property
     def is_user_root(self):
-        return str(self.owner.id) == self.name and self.level == 1
+        return self.level == 0 and self.tree_id == self.owner_id
 
     def get_absolute_url(self):
         return reverse('core:folder-detail', args=[str(self.slug)])
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not args and not kwargs.get('update_fields'):
+            # Counters are only changed by relative updates (see FolderManager.add_to_aggregates).
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in AGGREGATE_FIELDS]
+        return super().save(*args, **kwargs)
+
+    def delete(self, using=None, keep_parents=False):
+        """Delete the folder with its subtree in a few queries (see core.bulk.delete_subtrees)."""
+        from core.bulk import delete_subtrees
+        return delete_subtrees([self], using=using)
+
     def get_user_ancestors(self):
-        """Like mptt get_ancestors but without Users root folder."""
-        return self.get_ancestors()[1:]
+        """Like mptt get_ancestors (cached, only id, slug and name are set)."""
+        return [Folder(id=pk, slug=slug, name=name) for pk, slug, name in get_ancestor_chain(self)]
 
     def can_share(self, user):
-        if self.owner == user:
+        if user.is_authenticated and self.owner_id == user.pk:
             return True
 
     def has_permission(self, user, permission_category):
-        if self.owner == user or user.is_superuser:
-            return True
-        elif self.permissions.filter(category=permission_category, everybody=True):
-            return True
-        elif user.is_authenticated and self.permissions.filter(category=permission_category, user=user):
-            return True
-        elif self.parent:
-            return self.parent.has_permission(user, permission_category)
-        else:
-            return False
+        return Access.objects.has_access(user, self, permission_category)
 
 
-class File(models.Model):
+class File(RandomSlugMixin, models.Model):
     def _upload_to(instance, filename):
         instance.original_filename = filename[:255]
         if instance.id:
@@ -85,10 +286,11 @@ class File(models.Model):
         return os.path.join('files/', now().date().strftime('%Y/%m/%d'), secure_filename)
 
     folder = TreeForeignKey(Folder, verbose_name=_('folder'), related_name='files')
-    file = models.FileField(upload_to=_upload_to)
+    file = models.FileField(upload_to=_upload_to, db_index=True)
     name = models.CharField(_('name'), max_length=255, blank=True, default='')
     original_filename = models.CharField(_('original filename'), max_length=255, blank=True, default='')
-    size = models.PositiveIntegerField(_('size'), blank=True, default=0)
+    size = models.BigIntegerField(_('size'), blank=True, default=0)
+    checksum = models.CharField(_('checksum'), max_length=64, blank=True, default='', editable=False)
     owner = models.ForeignKey(get_user_model(), verbose_name=_('owner'), related_name='owned_files')
     description = models.TextField(_('description'), null=True, blank=True)
     slug = models.SlugField(_('slug'), unique=True)
@@ -98,12 +300,19 @@ class File(models.Model):
 
     class Meta:
         ordering = ('name', 'original_filename')
+        index_together = (('folder', 'name', 'original_filename', 'id'),)
         verbose_name = _('file')
         verbose_name_plural = _('files')
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
     @property
     def extension(self):
         """File extension in lower case without the dot."""
@@ -122,22 +331,89 @@ class File(models.Model):
         return reverse('core:file-detail', args=[str(self.slug)])
 
     def get_user_ancestors(self):
-        """Like mptt get_ancestors but without Users root folder."""
-        return self.folder.get_ancestors(include_self=True)[1:]
+        """Like mptt get_ancestors, with the folder of the file."""
+        return self.folder.get_user_ancestors() + [self.folder]
 
     def can_share(self, user):
-        if self.owner == user:
+        if user.is_authenticated and self.owner_id == user.pk:
             return True
 
     def has_permission(self, user, permission_category):
-        if self.owner == user or user.is_superuser:
-            return True
-        elif self.permissions.filter(category=permission_category, everybody=True):
-            return True
-        elif user.is_authenticated and self.permissions.filter(category=permission_category, user=user):
-            return True
-        else:
-            return self.folder.has_permission(user, permission_category)
+        return Access.objects.has_access(user, self, permission_category)
+
+
+class Upload(models.Model):
+    """Resumable upload in progress. Chunks are appended to `path` and the File is created on finalize."""
+    token = models.CharField(_('token'), max_length=32, unique=True)
+    folder = models.ForeignKey(Folder, verbose_name=_('folder'), related_name='+', on_delete=models.CASCADE)
+    owner = models.ForeignKey(get_user_model(), verbose_name=_('owner'), related_name='+', on_delete=models.CASCADE)
+    filename = models.CharField(_('filename'), max_length=255)
+    name = models.CharField(_('name'), max_length=255, blank=True, default='')
+    description = models.TextField(_('description'), null=True, blank=True)
+    path = models.CharField(_('path'), max_length=255)
+    size = models.BigIntegerField(_('size'))
+    offset = models.BigIntegerField(_('offset'), default=0)
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+    modified = models.DateTimeField(_('modified'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('upload')
+        verbose_name_plural = _('uploads')
+
+    def __str__(self):
+        return self.filename
+
+
+class QuotaManager(models.Manager):
+    def get_for_user(self, user):
+        """Quota of a user; the usage of a user without one is counted once here and kept up to date from then on."""
+        try:
+            return self.get(user=user)
+        except self.model.DoesNotExist:
+            usage = File.objects.filter(owner=user).aggregate(usage=Sum('size'))['usage'] or 0
+            try:
+                with transaction.atomic():
+                    return self.create(user=user, usage=usage)
+            except IntegrityError:
+                return self.get(user=user)
+
+    def add_usage(self, user_id, size):
+        """Add to the usage of a user (nothing to do before the usage is first counted)."""
+        if size:
+            self.filter(user_id=user_id).update(usage=F('usage') + size)
+
+    def reconcile(self):
+        """Recount the usage of all quotas from the files; returns the number of fixed quotas."""
+        counted = File.objects.filter(owner=OuterRef('user')).order_by().values('owner') \
+            .annotate(usage=Sum('size')).values('usage')
+        usage = Coalesce(Subquery(counted, output_field=models.BigIntegerField()), 0)
+        return self.annotate(counted=usage).exclude(usage=F('counted')).update(usage=usage)
+
+
+class Quota(models.Model):
+    """Storage limit of a user and the bytes of the files they own."""
+    user = models.OneToOneField(get_user_model(), verbose_name=_('user'), related_name='quota',
+                                on_delete=models.CASCADE)
+    limit = models.BigIntegerField(_('limit'), null=True, blank=True,
+                                   help_text=_('Bytes; empty for the default limit (DRIVE_QUOTA).'))
+    usage = models.BigIntegerField(_('usage'), default=0, editable=False)
+
+    objects = QuotaManager()
+
+    class Meta:
+        verbose_name = _('quota')
+        verbose_name_plural = _('quotas')
+
+    def __str__(self):
+        return str(self.user)
+
+    def get_limit(self):
+        return settings.DRIVE_QUOTA if self.limit is None else self.limit
+
+    def allows(self, size):
+        """Whether `size` more bytes fit."""
+        limit = self.get_limit()
+        return limit is None or self.usage + size <= limit
 
 
 class Permission(models.Model):
@@ -161,6 +437,7 @@ class Permission(models.Model):
 
     class Meta:
         ordering = ('user', 'content_type')
+        index_together = (('content_type', 'object_id'),)
         verbose_name = _('permission')
         verbose_name_plural = _('permissions')
 
@@ -181,5 +458,148 @@ class Permission(models.Model):
         super().save(*args, **kwargs)
 
     def is_owner(self, user):
-        if self.content_object.owner == user:
+        if user.is_authenticated and self.content_object.owner_id == user.pk:
+            return True
+
+
+class AccessManager(models.Manager):
+    def covering(self, obj):
+        """Filter for entries granting access to the object or to any of its ancestor folders."""
+        if isinstance(obj, File):
+            target = Folder.objects.filter(pk=obj.folder_id).order_by()
+            return Q(file=obj.pk) | Q(folder__tree_id=Subquery(target.values('tree_id')),
+                                      folder__lft__lte=Subquery(target.values('lft')),
+                                      folder__rght__gte=Subquery(target.values('rght')))
+        return Q(folder__tree_id=obj.tree_id, folder__lft__lte=obj.lft, folder__rght__gte=obj.rght)
+
+    def for_principal(self, user):
+        """Filter for entries of the user or of everybody."""
+        if user.is_authenticated:
+            return Q(everybody=True) | Q(user=user)
+        return Q(everybody=True)
+
+    def has_access(self, user, obj, permission_category):
+        metrics.count('permission_checks')
+        if user.is_superuser or (user.is_authenticated and obj.owner_id == user.pk):
+            return True
+        return self.filter(self.covering(obj), self.for_principal(user), category=permission_category).exists()
+
+    def shared_with(self, user, permission_category=Permission.CATEGORIES.view):
+        """Entries shared with the user directly or with everybody (ownership excluded)."""
+        return self.filter(self.for_principal(user), permission__isnull=False, category=permission_category)
+
+    def sync_permission(self, permission):
+        self.sync_permissions([permission])
+
+    def sync_permissions(self, permissions):
+        for chunk in chunks(permissions):
+            self.filter(permission__in=chunk).delete()
+        entries = []
+        for permission in permissions:
+            model = ContentType.objects.get_for_id(permission.content_type_id).model_class()
+            entries.append(self.model(
+                permission=permission,
+                folder_id=permission.object_id if model is Folder else None,
+                file_id=permission.object_id if model is File else None,
+                user_id=permission.user_id,
+                everybody=permission.everybody,
+                category=permission.category,
+            ))
+        self.bulk_create(entries, batch_size=QUERY_CHUNK_SIZE)
+
+    def sync_owner(self, folder):
+        """Ownership of a folder needs an entry when the parent folder is owned by somebody else."""
+        entries = self.filter(folder=folder, permission=None)
+        parent_owner_id = folder.parent.owner_id if folder.parent_id else None
+        if folder.owner_id and folder.owner_id != parent_owner_id:
+            if not entries.filter(user=folder.owner_id).exists():
+                entries.delete()
+                self.bulk_create(self.model(folder=folder, user_id=folder.owner_id, category=category)
+                                 for category, label in Permission.CATEGORIES)
+        else:
+            entries.delete()
+
+    def sync_owners(self, folders):
+        """sync_owner for many folders (with their parents loaded) in a few queries."""
+        for chunk in chunks(folders):
+            self.filter(folder__in=chunk, permission=None).delete()
+        entries = [self.model(folder=folder, user_id=folder.owner_id, category=category)
+                   for folder in folders
+                   if folder.owner_id and folder.owner_id != (folder.parent.owner_id if folder.parent_id else None)
+                   for category, label in Permission.CATEGORIES]
+        self.bulk_create(entries, batch_size=QUERY_CHUNK_SIZE)
+
+
+class Access(models.Model):
+    """Materialized access of a user (or everybody) to a folder subtree or to a single file.
+
+    Entries are kept in sync with Permission rows and folder ownership by signals. Subtree ranges
+    are read through the folder, so MPTT renumbering never leaves an entry with a stale range.
+    """
+    permission = models.ForeignKey(Permission, related_name='+', null=True, on_delete=models.CASCADE)
+    folder = models.ForeignKey(Folder, related_name='+', null=True, on_delete=models.CASCADE)
+    file = models.ForeignKey(File, related_name='+', null=True, on_delete=models.CASCADE)
+    user = models.ForeignKey(get_user_model(), related_name='+', null=True, on_delete=models.CASCADE)
+    everybody = models.BooleanField(default=False)
+    category = models.CharField(choices=Permission.CATEGORIES, max_length=10)
+
+    objects = AccessManager()
+
+    class Meta:
+        index_together = (('user', 'category'), ('everybody', 'category'))
+
+
+class PermissionResolver:
+    """Resolve permissions of many Folders and Files for any number of users.
+
+    All Access entries covering the objects are loaded in one query (and the folder positions of
+    Files in one more, unless the folder is already cached). Afterwards every has_permission call
+    is answered from memory.
+    """
+    EVERYBODY = '*'
+
+    def __init__(self, objects):
+        self.objects = list(objects)
+        self._loaded = False
+        self._positions = {}
+        self._entries = []
+
+    def _load(self):
+        folders = [obj for obj in self.objects if isinstance(obj, Folder)]
+        files = [obj for obj in self.objects if isinstance(obj, File)]
+        for folder in folders + [f.folder for f in files if hasattr(f, File.folder.cache_name)]:
+            self._positions[folder.pk] = (folder.tree_id, folder.lft, folder.rght)
+        missing = {f.folder_id for f in files} - set(self._positions)
+        if missing:
+            for pk, tree_id, lft, rght in Folder.objects.filter(pk__in=missing).order_by().values_list(
+                    'pk', 'tree_id', 'lft', 'rght'):
+                self._positions[pk] = (tree_id, lft, rght)
+        covering = Q(file__in=[f.pk for f in files]) if files else Q()
+        for tree_id, lft, rght in set(self._positions.values()):
+            covering |= Q(folder__tree_id=tree_id, folder__lft__lte=lft, folder__rght__gte=rght)
+        if covering:
+            self._entries = list(Access.objects.filter(covering).values_list(
+                'file_id', 'folder__tree_id', 'folder__lft', 'folder__rght', 'category', 'user_id', 'everybody'))
+        self._loaded = True
+
+    def _grants(self, obj):
+        """(category, user id or EVERYBODY) of all entries covering the object."""
+        if isinstance(obj, File):
+            file_id = obj.pk
+            tree_id, lft, rght = self._positions[obj.folder_id]
+        else:
+            file_id = None
+            tree_id, lft, rght = obj.tree_id, obj.lft, obj.rght
+        for e_file_id, e_tree_id, e_lft, e_rght, category, user_id, everybody in self._entries:
+            if (e_file_id is not None and e_file_id == file_id) or \
+                    (e_file_id is None and e_tree_id == tree_id and e_lft <= lft and e_rght >= rght):
+                yield category, self.EVERYBODY if everybody else user_id
+
+    def has_permission(self, user, obj, permission_category):
+        if user.is_superuser or (user.is_authenticated and obj.owner_id == user.pk):
             return True
+        if not self._loaded:
+            self._load()
+        principals = {self.EVERYBODY, user.pk} if user.is_authenticated else {self.EVERYBODY}
+        return any(category == permission_category and principal in principals
+                   for category, principal in self._grants(obj))
@@ -0,0 +1,84 @@
+import base64
+import json
+from django.core.exceptions import SuspiciousOperation
+from django.db.models import Q
+
+
+class InvalidCursor(SuspiciousOperation):
+    """A cursor that was not issued by KeysetPaginator for these sections (answered with 400)."""
+
+
+def encode_cursor(section, values):
+    data = json.dumps([section, values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor, lengths=None):
+    """Inverse of encode_cursor; returns (None, None) for a missing or malformed cursor.
+
+    `lengths` maps the known sections to the number of their keys; cursors of other sections or with
+    another number of values are malformed.
+    """
+    try:
+        section, values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        section, values = str(section), list(values) if values is not None else None
+    except Exception:
+        return None, None
+    if lengths is not None and (section not in lengths or values is not None and len(values) != lengths[section]):
+        return None, None
+    return section, values
+
+
+def keyset_filter(keys, values):
+    """Rows strictly after `values` in the (keys) ordering."""
+    condition = Q()
+    for i, key in enumerate(keys):
+        equal = {k: v for k, v in zip(keys[:i], values[:i])}
+        condition |= Q(**equal) & Q(**{'%s__gt' % key: values[i]})
+    return condition
+
+
+class KeysetPaginator:
+    """Cursor pagination over several querysets listed one after another (folders, then files).
+
+    Each queryset is ordered by unique keys and a page continues from the keys of the last row
+    of the previous page, so no page needs an OFFSET scan.
+    """
+
+    def __init__(self, sections, per_page):
+        self.sections = sections
+        self.per_page = per_page
+
+    def page(self, cursor=None):
+        """Return ({section: [rows]}, next cursor or None); raises InvalidCursor for a malformed cursor."""
+        names = [name for name, queryset, keys in self.sections]
+        section, values = None, None
+        if cursor:
+            section, values = decode_cursor(cursor, {name: len(keys) for name, queryset, keys in self.sections})
+            if section is None:
+                raise InvalidCursor('Malformed cursor.')
+        start = names.index(section) if section else 0
+        items = {name: [] for name in names}
+        remaining = self.per_page
+        for name, queryset, keys in self.sections[start:]:
+            queryset = queryset.order_by(*keys)
+            if values is not None:
+                try:
+                    queryset = queryset.filter(keyset_filter(keys, values))
+                except (TypeError, ValueError):
+                    raise InvalidCursor('Malformed cursor.')
+                values = None
+            rows = list(queryset[:remaining + 1])
+            if len(rows) > remaining:
+                rows = rows[:remaining]
+                items[name] = rows
+                last = rows[-1]
+                return items, encode_cursor(name, [getattr(last, key) for key in keys])
+            items[name] = rows
+            remaining -= len(rows)
+            if not remaining:
+                index = names.index(name)
+                if index + 1 < len(names) and self.sections[index + 1][1].exists():
+                    return items, encode_cursor(names[index + 1], None)
+                return items, None
+        return items, None
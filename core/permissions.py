@@ -0,0 +1,47 @@
+from django.contrib.contenttypes.models import ContentType
+from core import metrics
+from core.models import Permission, PermissionResolver
+
+
+class PermissionCache:
+    """Memo of permission checks keyed by (user, content type, object id, category).
+
+    A miss resolves every permission category of the object at once, so checking view and edit
+    of the same object costs one resolver load.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._results = {}
+
+    def __repr__(self):
+        return '<PermissionCache hits=%d misses=%d>' % (self.hits, self.misses)
+
+    def _key(self, user, obj, permission_category):
+        return (user.pk, ContentType.objects.get_for_model(obj).pk, obj.pk, permission_category)
+
+    def prime(self, user, objects):
+        """Resolve all categories for many objects with a single resolver."""
+        objects = [obj for obj in objects if self._key(user, obj, Permission.CATEGORIES.view) not in self._results]
+        resolver = PermissionResolver(objects)
+        for obj in objects:
+            for category, label in Permission.CATEGORIES:
+                self._results[self._key(user, obj, category)] = resolver.has_permission(user, obj, category)
+
+    def has_permission(self, user, obj, permission_category):
+        metrics.count('permission_checks')
+        key = self._key(user, obj, permission_category)
+        if key in self._results:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.prime(user, [obj])
+        return self._results[key]
+
+
+def get_permission_cache(request):
+    """Permission cache of the request (created on first use)."""
+    if not hasattr(request, '_permission_cache'):
+        request._permission_cache = PermissionCache()
+    return request._permission_cache
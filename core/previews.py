@@ -0,0 +1,156 @@
+"""Thumbnails and document previews.
+
+Derivatives are generated in a background thread pool once a File is committed and stored by
+content hash, so files sharing a blob share their previews:
+    PREVIEW_ROOT/<digest[:2]>/<digest>/<size>.png   thumbnails (first page of documents)
+    PREVIEW_ROOT/<digest[:2]>/<digest>/document.pdf office documents converted to pdf
+"""
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connection, transaction
+from core.conf import settings
+from core.models import File
+from core.utils import file_checksum
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+OFFICE_EXTENSIONS = ('doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx')
+CONTENT_TYPES = {'.png': 'image/png', '.pdf': 'application/pdf'}
+
+_executor = None
+# Files queued or being processed, so repeated requests for a missing thumbnail queue it once.
+_pending = set()
+# Request threads and the workers both use these.
+_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.DRIVE_PREVIEW_WORKERS)
+        return _executor
+
+
+def has_previews(file):
+    return file.is_image or file.is_document
+
+
+def preview_dir(digest):
+    return os.path.join(settings.DRIVE_PREVIEW_ROOT, digest[:2], digest)
+
+
+def get_preview_path(file, size):
+    """Path of a generated derivative ('pdf' or a THUMBNAIL_SIZES key) or None."""
+    if not file.checksum or (size != 'pdf' and size not in settings.DRIVE_THUMBNAIL_SIZES):
+        return None
+    path = os.path.join(preview_dir(file.checksum), 'document.pdf' if size == 'pdf' else '%s.png' % size)
+    return path if os.path.exists(path) else None
+
+
+def schedule(file):
+    """Generate the previews of `file` in the background after the current transaction commits."""
+    if has_previews(file) and Image is not None:
+        transaction.on_commit(lambda: _submit(file.pk))
+
+
+def _submit(file_id):
+    with _lock:
+        if file_id in _pending:
+            return
+        _pending.add(file_id)
+    get_executor().submit(_generate, file_id)
+
+
+def _generate(file_id):
+    try:
+        file = File.objects.filter(pk=file_id).first()
+        if file is not None:
+            generate(file)
+    except Exception as e:
+        logger.exception(e)
+    finally:
+        with _lock:
+            _pending.discard(file_id)
+        connection.close()
+
+
+def generate(file):
+    """Write the missing derivatives of `file`; a no-op when all of them exist."""
+    if not file.checksum:
+        # Stored before checksums were recorded.
+        with file.file.storage.open(file.file.name, 'rb') as content:
+            file.checksum = file_checksum(content)
+        File.objects.filter(pk=file.pk).update(checksum=file.checksum)
+    target = preview_dir(file.checksum)
+    if all(os.path.exists(os.path.join(target, '%s.png' % size)) for size in settings.DRIVE_THUMBNAIL_SIZES):
+        return
+    os.makedirs(target, exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        if file.is_image:
+            source = file.file.path
+        else:
+            source = render_first_page(file, target, tmp)
+        if source:
+            write_thumbnails(source, target)
+
+
+def render_first_page(file, target, tmp):
+    """PNG of the first page of a document, converted to pdf first unless it already is one."""
+    pdf = file.file.path
+    if file.extension in OFFICE_EXTENSIONS:
+        pdf = os.path.join(target, 'document.pdf')
+        if not os.path.exists(pdf):
+            converted = convert_to_pdf(file.file.path, tmp)
+            if not converted:
+                return None
+            os.replace(converted, pdf)
+    if not shutil.which('pdftoppm'):
+        logger.warning('pdftoppm not found, skipping document preview of %s.', file.file.name)
+        return None
+    prefix = os.path.join(tmp, 'page')
+    max_size = max(settings.DRIVE_THUMBNAIL_SIZES.values())
+    subprocess.run(['pdftoppm', '-png', '-singlefile', '-f', '1', '-l', '1', '-scale-to', str(max_size), pdf, prefix],
+                   check=True, timeout=settings.DRIVE_PREVIEW_TIMEOUT,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return prefix + '.png'
+
+
+def convert_to_pdf(path, tmp):
+    soffice = shutil.which('soffice') or shutil.which('libreoffice')
+    if not soffice:
+        logger.warning('LibreOffice not found, skipping document preview of %s.', path)
+        return None
+    # A private profile directory lets conversions run in parallel.
+    subprocess.run([soffice, '-env:UserInstallation=file://%s/profile' % tmp, '--headless',
+                    '--convert-to', 'pdf', '--outdir', tmp, path],
+                   check=True, timeout=settings.DRIVE_PREVIEW_TIMEOUT,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    pdf = os.path.join(tmp, os.path.splitext(os.path.basename(path))[0] + '.pdf')
+    return pdf if os.path.exists(pdf) else None
+
+
+def write_thumbnails(source, target):
+    with Image.open(source) as original:
+        image = original.convert('RGBA' if 'A' in original.mode or 'transparency' in original.info else 'RGB')
+    # Largest first, each one downscaled from the previous.
+    for size, pixels in sorted(settings.DRIVE_THUMBNAIL_SIZES.items(), key=lambda item: -item[1]):
+        image.thumbnail((pixels, pixels), Image.LANCZOS)
+        # Readers never see a partially written file, and concurrent writers never share a temporary one.
+        with tempfile.NamedTemporaryFile(dir=target, prefix='.%s.' % size, suffix='.png', delete=False) as tmp:
+            try:
+                image.save(tmp, 'PNG')
+            except Exception:
+                os.remove(tmp.name)
+                raise
+        os.replace(tmp.name, os.path.join(target, '%s.png' % size))
@@ -0,0 +1,242 @@
+"""Full-text search over folder and file names, descriptions and document contents.
+
+On SQLite the index is the FTS5 table core_search (see migration 0006_search); each row is a
+folder (rowid = 2 * pk) or a file (rowid = 2 * pk + 1). Other databases fall back to LIKE
+queries over names and descriptions. Results are filtered by view permission, on SQLite
+within the search query itself.
+"""
+import html
+import logging
+import re
+import shutil
+import subprocess
+import zipfile
+from itertools import chain, islice
+from django.db import connection, transaction
+from django.db.models import Q
+from core.conf import settings
+from core.models import Folder, File, Permission
+from core.permissions import PermissionCache
+from core.utils import chunks
+
+logger = logging.getLogger(__name__)
+
+TEXT_EXTENSIONS = ('txt', 'md', 'rst', 'csv', 'json', 'xml', 'html', 'htm', 'log')
+OFFICE_XML = {
+    'docx': re.compile(r'^word/document\.xml$'),
+    'xlsx': re.compile(r'^xl/sharedStrings\.xml$'),
+    'pptx': re.compile(r'^ppt/slides/slide\d+\.xml$'),
+}
+TAG_RE = re.compile(r'<[^>]+>')
+BATCH_SIZE = 200
+
+
+def is_supported():
+    return connection.vendor == 'sqlite'
+
+
+def _rowid(obj):
+    return obj.pk * 2 + isinstance(obj, File)
+
+
+def index(obj):
+    """Add or update the name and description of a folder or file, keeping its extracted content."""
+    if not is_supported() or (isinstance(obj, Folder) and obj.level == 0):
+        # User roots are not searchable.
+        return
+    name = '%s %s' % (obj.name, obj.original_filename) if isinstance(obj, File) else obj.name
+    with connection.cursor() as cursor:
+        cursor.execute('UPDATE core_search SET name = %s, description = %s WHERE rowid = %s',
+                       [name, obj.description or '', _rowid(obj)])
+        if not cursor.rowcount:
+            cursor.execute('INSERT INTO core_search (rowid, name, description, content) VALUES (%s, %s, %s, %s)',
+                           [_rowid(obj), name, obj.description or '', ''])
+
+
+def index_bulk(model, slugs):
+    """Add new folders or files by slug in a few queries (bulk_create sends no signals)."""
+    if not is_supported():
+        return
+    sql = {
+        Folder: "INSERT INTO core_search (rowid, name, description, content) "
+                "SELECT id * 2, name, COALESCE(description, ''), '' FROM core_folder WHERE slug IN (%s)",
+        File: "INSERT INTO core_search (rowid, name, description, content) "
+              "SELECT id * 2 + 1, name || ' ' || original_filename, COALESCE(description, ''), '' "
+              "FROM core_file WHERE slug IN (%s)",
+    }[model]
+    slugs = list(slugs)
+    with connection.cursor() as cursor:
+        for start in range(0, len(slugs), BATCH_SIZE):
+            chunk = slugs[start:start + BATCH_SIZE]
+            cursor.execute(sql % ', '.join(['%s'] * len(chunk)), chunk)
+
+
+def unindex(*objects):
+    if is_supported():
+        with connection.cursor() as cursor:
+            for chunk in chunks(objects):
+                cursor.execute('DELETE FROM core_search WHERE rowid IN (%s)' % ', '.join(['%s'] * len(chunk)),
+                               [_rowid(obj) for obj in chunk])
+
+
+def unindex_subtree(folder):
+    """Remove a folder with all folders and files below it."""
+    if is_supported():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'DELETE FROM core_search WHERE rowid IN ('
+                'SELECT id * 2 FROM core_folder WHERE tree_id = %s AND lft >= %s AND rght <= %s UNION ALL '
+                'SELECT core_file.id * 2 + 1 FROM core_file '
+                'INNER JOIN core_folder ON core_file.folder_id = core_folder.id '
+                'WHERE core_folder.tree_id = %s AND core_folder.lft >= %s AND core_folder.rght <= %s)',
+                [folder.tree_id, folder.lft, folder.rght] * 2)
+
+
+def index_content(file):
+    if is_supported():
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE core_search SET content = %s WHERE rowid = %s', [extract_text(file), _rowid(file)])
+
+
+def schedule_content(file):
+    """Extract and index the text of `file` in the background after the current transaction commits."""
+    if is_supported():
+        from core.previews import get_executor
+        transaction.on_commit(lambda: get_executor().submit(_index_content, file.pk))
+
+
+def _index_content(file_id):
+    try:
+        file = File.objects.filter(pk=file_id).first()
+        if file is not None:
+            index_content(file)
+    except Exception as e:
+        logger.exception(e)
+    finally:
+        connection.close()
+
+
+def extract_text(file):
+    """Plain text of a text, pdf or office (docx, xlsx, pptx) file, at most DRIVE_SEARCH_MAX_CONTENT characters."""
+    limit = settings.DRIVE_SEARCH_MAX_CONTENT
+    path = file.file.path
+    try:
+        if file.extension in TEXT_EXTENSIONS:
+            with open(path, 'rb') as f:
+                return f.read(limit).decode('utf-8', 'ignore')
+        if file.extension == 'pdf' and shutil.which('pdftotext'):
+            result = subprocess.run(['pdftotext', '-enc', 'UTF-8', path, '-'], stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL, timeout=settings.DRIVE_PREVIEW_TIMEOUT)
+            return result.stdout[:limit].decode('utf-8', 'ignore')
+        if file.extension in OFFICE_XML:
+            parts = []
+            with zipfile.ZipFile(path) as archive:
+                for name in sorted(archive.namelist()):
+                    if OFFICE_XML[file.extension].match(name):
+                        parts.append(html.unescape(TAG_RE.sub(' ', archive.read(name).decode('utf-8', 'ignore'))))
+            return ' '.join(' '.join(parts).split())[:limit]
+    except (OSError, ValueError, zipfile.BadZipFile, subprocess.SubprocessError) as e:
+        logger.warning('Cannot extract text of %s: %s', file.file.name, e)
+    return ''
+
+
+def rebuild(contents=True):
+    """Recreate the index from all folders and files; returns the number of indexed objects."""
+    if not is_supported():
+        return 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('DELETE FROM core_search')
+        cursor.execute("INSERT INTO core_search (rowid, name, description, content) "
+                       "SELECT id * 2, name, COALESCE(description, ''), '' FROM core_folder WHERE level > 0")
+        cursor.execute("INSERT INTO core_search (rowid, name, description, content) "
+                       "SELECT id * 2 + 1, name || ' ' || original_filename, COALESCE(description, ''), '' "
+                       "FROM core_file")
+        cursor.execute('SELECT count(*) FROM core_search')
+        count = cursor.fetchone()[0]
+    if contents:
+        for file in File.objects.only('id', 'file').iterator():
+            index_content(file)
+    return count
+
+
+def match_expression(query):
+    """FTS5 query matching every word of `query` as a prefix."""
+    return ' '.join('"%s"*' % word for word in re.findall(r'\w+', query))
+
+
+# Index rows the user may view: owned objects and objects covered by an access entry of the user or of
+# everybody (see core.models.AccessManager.has_access). `target` is the matched folder or the folder of the
+# matched file.
+VISIBLE_SQL = """
+SELECT core_search.rowid FROM core_search
+LEFT JOIN core_folder folder ON core_search.rowid %% 2 = 0 AND folder.id = core_search.rowid / 2
+LEFT JOIN core_file file ON core_search.rowid %% 2 = 1 AND file.id = core_search.rowid / 2
+INNER JOIN core_folder target ON target.id = COALESCE(folder.id, file.folder_id)
+WHERE core_search MATCH %%s AND (%s)
+ORDER BY core_search.rank LIMIT %%s OFFSET %%s
+"""
+VISIBLE_CONDITION = """
+COALESCE(file.owner_id, folder.owner_id) = %s
+OR EXISTS (SELECT 1 FROM core_access INNER JOIN core_folder covering ON covering.id = core_access.folder_id
+           WHERE (core_access.everybody OR core_access.user_id = %s) AND core_access.category = %s
+           AND covering.tree_id = target.tree_id AND covering.lft <= target.lft AND covering.rght >= target.rght)
+OR EXISTS (SELECT 1 FROM core_access WHERE core_access.file_id = file.id
+           AND (core_access.everybody OR core_access.user_id = %s) AND core_access.category = %s)
+"""
+
+
+def _visible_matches(user, query, offset, count):
+    """(model, pk) pairs of a slice of the objects `user` may view, best first (SQLite only)."""
+    if user.is_superuser:
+        condition, params = '1', []
+    else:
+        user_id = user.pk if user.is_authenticated else None
+        category = Permission.CATEGORIES.view
+        condition, params = VISIBLE_CONDITION, [user_id, user_id, category, user_id, category]
+    with connection.cursor() as cursor:
+        cursor.execute(VISIBLE_SQL % condition, [match_expression(query)] + params + [count, offset])
+        return [(File if rowid % 2 else Folder, rowid // 2) for rowid, in cursor.fetchall()]
+
+
+def _matches(query, offset, count):
+    """(model, pk) pairs of a slice of the candidates (LIKE fallback of other databases)."""
+    folders = Folder.objects.filter(level__gt=0).order_by('pk')
+    files = File.objects.order_by('pk')
+    for word in query.split():
+        folders = folders.filter(Q(name__icontains=word) | Q(description__icontains=word))
+        files = files.filter(Q(name__icontains=word) | Q(original_filename__icontains=word) |
+                             Q(description__icontains=word))
+    candidates = chain(((Folder, pk) for pk in folders.values_list('pk', flat=True)),
+                       ((File, pk) for pk in files.values_list('pk', flat=True)))
+    return list(islice(candidates, offset, offset + count))
+
+
+def _load(matches):
+    loaded = {
+        Folder: Folder.objects.in_bulk([pk for model, pk in matches if model is Folder]),
+        File: File.objects.select_related('folder').in_bulk([pk for model, pk in matches if model is File]),
+    }
+    # The index may briefly lag behind deletions.
+    return [loaded[model][pk] for model, pk in matches if pk in loaded[model]]
+
+
+def search(user, query, limit=50, permission_cache=None):
+    """Folders and files matching `query` which `user` may view, best matches first (at most `limit`).
+
+    With the index the permissions are checked in the same query, so only viewable matches are loaded.
+    """
+    if not match_expression(query):
+        return []
+    if is_supported():
+        return _load(_visible_matches(user, query, 0, limit))
+    permission_cache = permission_cache or PermissionCache()
+    results, offset = [], 0
+    while len(results) < limit:
+        matches = _matches(query, offset, BATCH_SIZE)
+        offset += BATCH_SIZE
+        objects = _load(matches)
+        permission_cache.prime(user, objects)
+        results.extend(obj for obj in objects if permission_cache.has_permission(user, obj, Permission.CATEGORIES.view))
+        if len(matches) < BATCH_SIZE:
+            break
+    return results[:limit]
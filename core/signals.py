@@ -1,38 +1,171 @@
 import logging
-from django.db.models.signals import pre_save, post_delete
+from django.contrib.auth import get_user_model
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
-from core.models import Folder, File
-from core.utils import generate_random_hex
+from mptt.signals import node_moved
+from core import search
+from core.cache import invalidate_tree
+from core.models import Folder, File, Permission, Access, Quota
+from core.previews import schedule as schedule_previews
+from core.utils import file_checksum
 
 logger = logging.getLogger(__name__)
 
 
-@receiver(pre_save, sender=Folder)
-@receiver(pre_save, sender=File)
-def folder_file_generate_slug(sender, instance, **kwargs):
-    if not instance.slug:
-        exists = True
-        while exists:
-            slug = generate_random_hex(length=20)
-            exists = instance.__class__.objects.filter(slug=slug).exists()
-        instance.slug = slug
-
-
 @receiver(pre_save, sender=File)
 def file_set_info(sender, instance, **kwargs):
     try:
         if not instance.name:
             instance.name = instance.file.name
+        if instance.file._committed and (
+                getattr(instance, '_loaded_values', {}).get('file') == instance.file.name or instance.checksum):
+            # Unchanged, or stored content whose size and checksum came with it: no storage access.
+            return
         instance.size = instance.file.size
+        if not instance.file._committed:
+            # New content: hashed by the upload handler while it streamed in, or read once here.
+            content = instance.file.file
+            content.checksum = getattr(content, 'checksum', None) or file_checksum(content)
+            instance.checksum = content.checksum
     except Exception as e:
         logger.exception(e)
 
 
+@receiver(post_save, sender=File)
+def file_schedule_previews(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or 'file' in update_fields:
+        schedule_previews(instance)
+
+
+@receiver(post_save, sender=File)
+def file_update_counters(sender, instance, created, **kwargs):
+    """Folder aggregates and the owner's quota usage."""
+    loaded = getattr(instance, '_loaded_values', {})
+    old_folder_id, old_owner_id, old_size = loaded.get('folder_id'), loaded.get('owner_id'), loaded.get('size')
+    if created:
+        Folder.objects.add_to_aggregates(instance.folder_id, files=1, size=instance.size)
+        Quota.objects.add_usage(instance.owner_id, instance.size)
+    else:
+        old_size = instance.size if old_size is None else old_size
+        if old_folder_id is not None and old_folder_id != instance.folder_id:
+            Folder.objects.add_to_aggregates(old_folder_id, files=-1, size=-old_size)
+            Folder.objects.add_to_aggregates(instance.folder_id, files=1, size=instance.size)
+        elif old_size != instance.size:
+            Folder.objects.add_to_aggregates(instance.folder_id, size=instance.size - old_size)
+        if old_owner_id is not None and old_owner_id != instance.owner_id:
+            Quota.objects.add_usage(old_owner_id, -old_size)
+            Quota.objects.add_usage(instance.owner_id, instance.size)
+        else:
+            Quota.objects.add_usage(instance.owner_id, instance.size - old_size)
+    # Later saves of the same instance count from here.
+    instance._loaded_values = dict(loaded, folder_id=instance.folder_id, owner_id=instance.owner_id,
+                                   size=instance.size)
+
+
+@receiver(pre_delete, sender=File)
+def file_remove_counters(sender, instance, **kwargs):
+    Folder.objects.add_to_aggregates(instance.folder_id, files=-1, size=-instance.size)
+    Quota.objects.add_usage(instance.owner_id, -instance.size)
+
+
+@receiver(post_save, sender=get_user_model())
+def user_create_root(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        Folder.objects.create_user_root(instance)
+
+
+@receiver(post_save, sender=Permission)
+def permission_sync_access(sender, instance, **kwargs):
+    Access.objects.sync_permission(instance)
+
+
+def _saves_owner(update_fields):
+    return update_fields is None or bool({'owner', 'owner_id'} & set(update_fields))
+
+
+@receiver(pre_save, sender=Folder)
+def folder_load_owner(sender, instance, update_fields=None, **kwargs):
+    # Folders loaded without their owner (or not loaded at all) get it from the database, so that
+    # folder_sync_access only rebuilds Access entries when it changes.
+    loaded = getattr(instance, '_loaded_values', {})
+    if not instance._state.adding and 'owner_id' not in loaded and _saves_owner(update_fields):
+        owner_id = Folder.objects.filter(pk=instance.pk).values_list('owner_id', flat=True).first()
+        if 'owner_id' in instance.get_deferred_fields():
+            instance.owner_id = owner_id
+        instance._loaded_values = dict(loaded, owner_id=owner_id)
+
+
+@receiver(post_save, sender=Folder)
+def folder_sync_access(sender, instance, created, update_fields=None, **kwargs):
+    if not created and not _saves_owner(update_fields):
+        return
+    loaded = getattr(instance, '_loaded_values', {})
+    if created or loaded.get('owner_id') != instance.owner_id:
+        Access.objects.sync_owner(instance)
+        if not created:
+            # Whether the subfolders need an entry of their own depends on this owner too.
+            children = list(instance.children.all())
+            for child in children:
+                child.parent = instance
+            Access.objects.sync_owners(children)
+    instance._loaded_values = dict(loaded, owner_id=instance.owner_id)
+
+
+@receiver(node_moved, sender=Folder)
+def folder_moved_sync_access(sender, instance, **kwargs):
+    # Renames reorder siblings too; the entries only depend on the parent.
+    if getattr(instance, '_loaded_values', {}).get('parent_id') != instance.parent_id:
+        Access.objects.sync_owner(instance)
+
+
+@receiver(post_save, sender=Folder)
+def folder_add_aggregates(sender, instance, created, **kwargs):
+    if created and instance.parent_id:
+        Folder.objects.add_to_aggregates(instance.parent_id, folders=1)
+        instance._loaded_values = dict(getattr(instance, '_loaded_values', {}), parent_id=instance.parent_id)
+
+
+@receiver(pre_delete, sender=Folder)
+def folder_remove_aggregates(sender, instance, **kwargs):
+    # Cascades send this for every folder of a subtree, so each one only takes itself off.
+    if instance.parent_id:
+        Folder.objects.add_to_aggregates(instance.parent_id, folders=-1)
+
+
+@receiver(node_moved, sender=Folder)
+def folder_moved_update_aggregates(sender, instance, **kwargs):
+    # A rename reorders the node too, without changing the parent.
+    loaded = getattr(instance, '_loaded_values', {})
+    old_parent_id = loaded.get('parent_id')
+    if old_parent_id == instance.parent_id:
+        return
+    files, folders, size = Folder.objects.filter(pk=instance.pk) \
+        .values_list('total_file_count', 'total_folder_count', 'total_size').get()
+    if old_parent_id:
+        Folder.objects.add_to_aggregates(old_parent_id, folders=-1, total=(-files, -folders - 1, -size))
+    if instance.parent_id:
+        Folder.objects.add_to_aggregates(instance.parent_id, folders=1, total=(files, folders + 1, size))
+    instance._loaded_values = dict(loaded, parent_id=instance.parent_id)
+
+
+@receiver(post_save, sender=Folder)
+@receiver(post_delete, sender=Folder)
+def folder_invalidate_tree(sender, instance, **kwargs):
+    # A move to another tree also renumbers the tree the folder was loaded from.
+    tree_ids = {instance.tree_id, getattr(instance, '_loaded_values', {}).get('tree_id')}
+    for tree_id in tree_ids - {None}:
+        invalidate_tree(tree_id)
+
+
+@receiver(post_save, sender=Folder)
+@receiver(post_save, sender=File)
+def folder_file_index(sender, instance, created, **kwargs):
+    search.index(instance)
+    if sender is File and (created or getattr(instance, '_loaded_values', {}).get('file') != instance.file.name):
+        search.schedule_content(instance)
+
+
+@receiver(post_delete, sender=Folder)
 @receiver(post_delete, sender=File)
-def file_delete_file(sender, instance, **kwargs):
-    try:
-        # Delete the file if there are no other Files referencing it.
-        if not File.objects.filter(file=instance.file.name).exists():
-            instance.file.delete(save=False)
-    except Exception as e:
-        logger.exception(e)
+def folder_file_unindex(sender, instance, **kwargs):
+    search.unindex(instance)
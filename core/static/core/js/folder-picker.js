@@ -0,0 +1,107 @@
+/* Folder picker of core.forms.FolderPickerWidget: loads one level of the tree, or search results, at a time. */
+(function ($) {
+  'use strict';
+
+  function load(picker, params, done) {
+    var exclude = picker.data('exclude');
+    if (exclude) {
+      params.exclude = exclude;
+    }
+    $.getJSON(picker.data('url'), params, done);
+  }
+
+  function folderItem(folder) {
+    var item = $('<li>').attr('data-id', folder.id).attr('data-has-children', folder.has_children ? '1' : '');
+    var expand = $('<a href="#" class="folder-picker-expand">');
+    if (folder.has_children) {
+      expand.append('<span class="glyphicon glyphicon-chevron-right"></span>');
+    }
+    item.append(expand, ' ', $('<a href="#" class="folder-picker-select">').text(folder.name));
+    if (folder.path) {
+      item.append(' ', $('<small class="text-muted">').text(folder.path));
+    }
+    return item;
+  }
+
+  // The folders of one page; `params` are the ones the page was loaded with, for loading the next one.
+  function folderItems(picker, data, params) {
+    var items = $.map(data.folders, folderItem);
+    if (data.next) {
+      var more = $('<a href="#" class="folder-picker-more">').text(picker.data('more-label'));
+      items.push($('<li>').append(more).data('params', $.extend({}, params, {cursor: data.next})));
+    }
+    return items;
+  }
+
+  function folderList(picker, data, params) {
+    return $('<ul class="list-unstyled">').append(folderItems(picker, data, params));
+  }
+
+  $(document).on('click', '.folder-picker-toggle', function () {
+    $(this).closest('.folder-picker').find('.folder-picker-panel').toggle();
+  });
+
+  $(document).on('click', '.folder-picker-expand', function (event) {
+    event.preventDefault();
+    var item = $(this).closest('li');
+    var icon = $(this).find('.glyphicon');
+    if (!item.data('has-children')) {
+      return;
+    }
+    if (item.children('ul').length) {
+      item.children('ul').toggle();
+      icon.toggleClass('glyphicon-chevron-right glyphicon-chevron-down');
+      return;
+    }
+    var picker = $(this).closest('.folder-picker');
+    var params = {parent: item.data('id')};
+    load(picker, params, function (data) {
+      item.append(folderList(picker, data, params));
+      icon.removeClass('glyphicon-chevron-right').addClass('glyphicon-chevron-down');
+    });
+  });
+
+  $(document).on('click', '.folder-picker-more', function (event) {
+    event.preventDefault();
+    var picker = $(this).closest('.folder-picker');
+    var item = $(this).closest('li');
+    var params = item.data('params');
+    item.find('a').removeClass('folder-picker-more');
+    load(picker, params, function (data) {
+      item.replaceWith(folderItems(picker, data, params));
+    });
+  });
+
+  $(document).on('click', '.folder-picker-select', function (event) {
+    event.preventDefault();
+    var picker = $(this).closest('.folder-picker');
+    picker.find('input[type=hidden]').val($(this).closest('li').data('id'));
+    picker.find('.folder-picker-label').val($(this).text());
+    picker.find('.folder-picker-panel').hide();
+  });
+
+  $(document).on('keydown', '.folder-picker-search', function (event) {
+    // Enter searches, it does not submit the form.
+    if (event.which === 13) {
+      event.preventDefault();
+    }
+  });
+
+  var searchTimer;
+  $(document).on('input', '.folder-picker-search', function () {
+    var picker = $(this).closest('.folder-picker');
+    var query = $.trim($(this).val());
+    clearTimeout(searchTimer);
+    picker.find('.folder-picker-tree').toggle(!query);
+    if (!query) {
+      picker.find('.folder-picker-results').empty();
+      return;
+    }
+    searchTimer = setTimeout(function () {
+      var params = {q: query};
+      load(picker, params, function (data) {
+        picker.find('.folder-picker-results').empty().append(folderItems(picker, data, params));
+      });
+    }, 250);
+  });
+})(jQuery);
@@ -0,0 +1,48 @@
+import os
+from django.core.files.storage import FileSystemStorage
+from core.utils import file_checksum, generate_random_hex
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """Stores every distinct content once under blobs/<digest><ext>.
+
+    The digest is taken from the `checksum` attribute set by the hashing upload handlers or
+    computed here. Saving content that is already stored writes nothing and returns the existing
+    name. Blobs are shared by all File rows with the same content and are only ever removed by
+    core.sweeper, once nothing has referred to them for the grace period.
+    """
+    prefix = 'blobs'
+
+    def blob_name(self, digest, extension=''):
+        return os.path.join(self.prefix, digest[:2], digest[2:4], digest + extension.lower())
+
+    def get_available_name(self, name, max_length=None):
+        # The final name is chosen in _save from the content.
+        return name
+
+    def _save(self, name, content):
+        digest = getattr(content, 'checksum', None) or file_checksum(content)
+        content.checksum = digest
+        blob = self.blob_name(digest, os.path.splitext(name)[1])
+        if self.exists(blob):
+            self.touch(blob)
+            return blob
+        # Write under a unique name first; concurrent uploads of the same content then simply
+        # replace the blob with identical bytes.
+        tmp = super()._save(os.path.join(self.prefix, 'tmp', generate_random_hex(length=20)), content)
+        return self.adopt(tmp, blob)
+
+    def adopt(self, name, blob):
+        """Move the stored file `name` to `blob`, or drop it when the blob already exists."""
+        if self.exists(blob):
+            self.delete(name)
+            self.touch(blob)
+            return blob
+        os.makedirs(os.path.dirname(self.path(blob)), exist_ok=True)
+        os.replace(self.path(name), self.path(blob))
+        return blob
+
+    def touch(self, blob):
+        # A reused blob may be unreferenced at the moment; a fresh mtime keeps the sweeper away
+        # until the new reference is committed.
+        os.utime(self.path(blob))
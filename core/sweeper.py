@@ -0,0 +1,113 @@
+"""Removal of stored data nothing refers to any more (run periodically with manage.py sweep_storage).
+
+Deleting a File never removes its content right away: the blob may just have been reused by an
+upload whose File row is not committed yet, so blobs are only removed here. Unreferenced blobs and
+legacy files, partial uploads of deleted or expired uploads, leftovers of interrupted writes and
+previews of content that is gone are collected here. Only entries older than DRIVE_SWEEP_GRACE seconds are
+removed, so content that is being written or reused right now survives until its reference is
+committed.
+"""
+import os
+import shutil
+import time
+from datetime import timedelta
+from django.core.files.storage import default_storage
+from django.utils.timezone import now
+from core.conf import settings
+from core.models import File, Upload
+from core.uploads import UPLOADS_DIR, UploadError, abort_upload
+from core.utils import chunks
+
+TMP_DIR = os.path.join('blobs', 'tmp')
+
+
+def _is_old(path, cutoff):
+    try:
+        return os.path.getmtime(path) < cutoff
+    except FileNotFoundError:
+        return False
+
+
+def _walk(top, cutoff):
+    """(storage name, path) of files below the storage directory `top` last modified before `cutoff`."""
+    for dirpath, dirnames, filenames in os.walk(default_storage.path(top)):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if _is_old(path, cutoff):
+                yield os.path.relpath(path, default_storage.path('')), path
+
+
+def _referenced_by_files(names):
+    return set(File.objects.filter(file__in=names).values_list('file', flat=True))
+
+
+def _referenced_by_uploads(names):
+    return _referenced_by_files(names) | set(Upload.objects.filter(path__in=names).values_list('path', flat=True))
+
+
+def sweep_directory(top, referenced, cutoff, dry_run=False):
+    """Delete files below `top` whose storage names are not in `referenced(names)`; returns the count."""
+    removed = 0
+    for chunk in chunks(_walk(top, cutoff)):
+        keep = referenced([name for name, path in chunk]) if referenced else set()
+        for name, path in chunk:
+            if name in keep:
+                continue
+            # Checked again right before the removal: content may have been reused (which touches it) or
+            # referenced since the chunk was looked up.
+            if not _is_old(path, cutoff) or (referenced and referenced([name])):
+                continue
+            removed += 1
+            if not dry_run:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    removed -= 1
+    return removed
+
+
+def sweep_previews(cutoff, dry_run=False):
+    """Delete previews (stored per content digest) of content no File has any more."""
+    removed = 0
+    root = settings.DRIVE_PREVIEW_ROOT
+    if not os.path.isdir(root):
+        return removed
+    directories = ((digest, os.path.join(root, prefix, digest))
+                   for prefix in os.listdir(root) for digest in os.listdir(os.path.join(root, prefix)))
+    for chunk in chunks((digest, path) for digest, path in directories if _is_old(path, cutoff)):
+        keep = set(File.objects.filter(checksum__in=[digest for digest, path in chunk])
+                   .values_list('checksum', flat=True))
+        for digest, path in chunk:
+            if digest not in keep:
+                removed += 1
+                if not dry_run:
+                    shutil.rmtree(path, ignore_errors=True)
+    return removed
+
+
+def expire_uploads(dry_run=False):
+    uploads = Upload.objects.filter(modified__lt=now() - timedelta(seconds=settings.DRIVE_UPLOAD_EXPIRY))
+    if dry_run:
+        return uploads.count()
+    count = 0
+    for upload in uploads.iterator():
+        try:
+            abort_upload(upload)
+        except UploadError:
+            # Finalized in the meantime, or the partial file is left to sweep_directory.
+            continue
+        count += 1
+    return count
+
+
+def sweep(dry_run=False):
+    """Run every sweep; returns the number of removed entries per kind."""
+    cutoff = time.time() - settings.DRIVE_SWEEP_GRACE
+    return {
+        'expired uploads': expire_uploads(dry_run),
+        'partial uploads': sweep_directory(UPLOADS_DIR, _referenced_by_uploads, cutoff, dry_run),
+        'temporary files': sweep_directory(TMP_DIR, None, cutoff, dry_run),
+        'blobs': sweep_directory('blobs', _referenced_by_files, cutoff, dry_run),
+        'files': sweep_directory('files', _referenced_by_files, cutoff, dry_run),
+        'previews': sweep_previews(cutoff, dry_run),
+    }
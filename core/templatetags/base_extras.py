@@ -1,5 +1,8 @@
 from django import template
+from django.utils.safestring import mark_safe
+from core.cache import render_breadcrumbs
 from core.models import Permission
+from core.permissions import get_permission_cache
 
 register = template.Library()
 
@@ -11,9 +14,14 @@ def build_absolute_uri(request, url):
 
 @register.filter
 def can_edit(request, file):
-    return file.has_permission(request.user, Permission.CATEGORIES.edit)
+    return get_permission_cache(request).has_permission(request.user, file, Permission.CATEGORIES.edit)
 
 
 @register.filter
 def can_share(request, file):
     return file.can_share(request.user)
+
+
+@register.simple_tag
+def breadcrumbs(folder, include_self=False):
+    return mark_safe(render_breadcrumbs(folder, include_self))
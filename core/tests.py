@@ -1,3 +1,1211 @@
-from django.test import TestCase
+import fcntl
+import hashlib
+import importlib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache, caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.core.urlresolvers import reverse
+from django.db import IntegrityError, connection, transaction
+from django.db.models.query import QuerySet
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from core import cachestats, metrics, previews, search, sweeper, uploads
+from core.conf import settings
+from core.forms import FolderForm
+from core.models import Folder, File, Permission, PermissionResolver, Access, Upload, Quota
+from core.permissions import PermissionCache
+from core.pagination import encode_cursor
 
-# Create your tests here.
+
+class TempMediaMixin:
+    """Stores the files created by the tests of the class in a temporary MEDIA_ROOT of its own."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_settings = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media_settings.enable()
+        try:
+            super().setUpClass()
+        except Exception:
+            cls.remove_media_root()
+            raise
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.remove_media_root()
+
+    @classmethod
+    def remove_media_root(cls):
+        cls.media_settings.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+@override_settings(CACHALOT_ENABLED=False)
+class FolderListingTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create_user('owner', password='secret')
+        self.other = User.objects.create_user('other', password='secret')
+        self.root = Folder.objects.get_user_root(self.owner)
+        self.folder = Folder.objects.create(name='folder', parent=self.root, owner=self.owner)
+        Permission.objects.create(content_type=ContentType.objects.get_for_model(Folder), object_id=self.folder.id,
+                                  user=self.other, category=Permission.CATEGORIES.view)
+
+    def add_items(self, count):
+        offset = self.folder.children.count()
+        for i in range(offset, offset + count):
+            Folder.objects.create(name='child %d' % i, parent=self.folder, owner=self.owner)
+            File.objects.create(folder=self.folder, owner=self.owner, file=ContentFile(b'x', name='file%d.txt' % i))
+            File.objects.create(folder=self.root, owner=self.owner, file=ContentFile(b'x', name='home%d.txt' % i))
+
+    def count_queries(self, user, url):
+        self.client.force_login(user)
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def test_folder_detail_query_count(self):
+        self.add_items(2)
+        for user in (self.owner, self.other):
+            queries = self.count_queries(user, self.folder.get_absolute_url())
+            self.add_items(10)
+            self.assertEqual(self.count_queries(user, self.folder.get_absolute_url()), queries)
+
+    def test_home_query_count(self):
+        self.add_items(2)
+        queries = self.count_queries(self.owner, '/drive/my/')
+        self.add_items(10)
+        self.assertEqual(self.count_queries(self.owner, '/drive/my/'), queries)
+
+    def test_breadcrumbs_follow_renames(self):
+        sub = Folder.objects.create(name='sub', parent=self.folder, owner=self.owner)
+        self.client.force_login(self.owner)
+        self.assertContains(self.client.get(sub.get_absolute_url()), '>folder</a>')
+        folder = Folder.objects.get(pk=self.folder.pk)
+        folder.name = 'renamed'
+        folder.save()
+        response = self.client.get(sub.get_absolute_url())
+        self.assertContains(response, '>renamed</a>')
+        self.assertNotContains(response, '>folder</a>')
+        self.assertEqual([f.name for f in Folder.objects.get(pk=sub.pk).get_user_ancestors()],
+                         [self.root.name, 'renamed'])
+
+
+@override_settings(CACHALOT_ENABLED=False)
+class PermissionTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create_user('owner')
+        self.other = User.objects.create_user('other')
+        self.third = User.objects.create_user('third')
+        self.root = Folder.objects.get_user_root(self.owner)
+        self.folder = Folder.objects.create(name='folder', parent=self.root, owner=self.owner)
+        self.child = Folder.objects.create(name='child', parent=self.folder, owner=self.owner)
+        self.file = File.objects.create(folder=self.child, owner=self.owner, file=ContentFile(b'x', name='p.txt'))
+
+    def share(self, obj, category=Permission.CATEGORIES.view, **principal):
+        return Permission.objects.create(content_type=ContentType.objects.get_for_model(obj), object_id=obj.pk,
+                                         category=category, **principal)
+
+    def assertPermissions(self, user, expected):
+        """`expected` maps objects to (view, edit); checked per query, with a resolver and with a cache."""
+        objects = list(expected)
+        resolver = PermissionResolver(objects)
+        for obj, (view, edit) in expected.items():
+            for category, allowed in ((Permission.CATEGORIES.view, view), (Permission.CATEGORIES.edit, edit)):
+                self.assertEqual(obj.has_permission(user, category), allowed, (obj, category))
+                self.assertEqual(resolver.has_permission(user, obj, category), allowed, (obj, category))
+                self.assertEqual(PermissionCache().has_permission(user, obj, category), allowed, (obj, category))
+
+    def test_owner(self):
+        self.assertPermissions(self.owner, {self.folder: (True, True), self.file: (True, True)})
+        self.assertPermissions(self.other, {self.folder: (False, False), self.file: (False, False)})
+
+    def test_shared_folder_covers_subtree(self):
+        self.share(self.folder, user=self.other)
+        self.assertPermissions(self.other, {self.root: (False, False), self.folder: (True, False),
+                                            self.child: (True, False), self.file: (True, False)})
+        self.assertPermissions(self.third, {self.folder: (False, False), self.file: (False, False)})
+
+    def test_shared_file(self):
+        self.share(self.file, category=Permission.CATEGORIES.edit, user=self.other)
+        self.assertPermissions(self.other, {self.child: (False, False), self.file: (False, True)})
+
+    def test_everybody(self):
+        self.share(self.child, everybody=True)
+        self.assertPermissions(AnonymousUser(), {self.folder: (False, False), self.file: (True, False)})
+        self.assertPermissions(self.third, {self.child: (True, False)})
+
+    def test_permission_change_and_delete(self):
+        permission = self.share(self.folder, user=self.other)
+        permission.category = Permission.CATEGORIES.edit
+        permission.save()
+        self.assertPermissions(self.other, {self.file: (False, True)})
+        permission.delete()
+        self.assertPermissions(self.other, {self.file: (False, False)})
+
+    def test_owner_change(self):
+        self.folder.owner = self.other
+        self.folder.save()
+        self.assertPermissions(self.other, {self.folder: (True, True), self.file: (True, True)})
+        # The subfolder is still the old owner's, below a folder of somebody else.
+        self.assertTrue(Access.objects.filter(folder=self.child, permission=None, user=self.owner).exists())
+        folder = Folder.objects.get(pk=self.folder.pk)
+        folder.owner = self.owner
+        folder.save()
+        self.assertPermissions(self.other, {folder: (False, False), self.file: (False, False)})
+        self.assertFalse(Access.objects.filter(folder__in=[self.folder, self.child], permission=None).exists())
+
+    def test_save_without_owner_change(self):
+        folders = (Folder.objects.get(pk=self.folder.pk), Folder.objects.only('name').get(pk=self.folder.pk),
+                   Folder.objects.defer('owner').get(pk=self.folder.pk))
+        with mock.patch.object(Access.objects, 'sync_owner') as sync_owner:
+            for i, folder in enumerate(folders):
+                folder.name = 'renamed %d' % i
+                folder.save()
+            self.assertFalse(sync_owner.called)
+            folder = Folder.objects.only('name', 'parent', 'tree_id', 'lft', 'rght').get(pk=self.folder.pk)
+            folder.owner = self.other
+            folder.save()
+            sync_owner.assert_called_once_with(folder)
+
+    def test_resolver_queries(self):
+        self.share(self.folder, user=self.other)
+        self.share(self.child, category=Permission.CATEGORIES.edit, user=self.third)
+        for i in range(3):
+            sub = Folder.objects.create(name='sub %d' % i, parent=self.child, owner=self.owner)
+            File.objects.create(folder=sub, owner=self.owner, file=ContentFile(b'x', name='%d.txt' % i))
+        objects = list(Folder.objects.filter(tree_id=self.root.tree_id)) + list(File.objects.all())
+        checks = [(user, obj, category) for user in (self.owner, self.other, self.third, AnonymousUser())
+                  for obj in objects for category, label in Permission.CATEGORIES]
+        expected = [obj.has_permission(user, category) for user, obj, category in checks]
+        # Owner: everything, other: view below the folder, third: edit below the child.
+        self.assertEqual(expected.count(True), 2 * 10 + 9 + 8)
+        # The folders of the files are among the objects, so only the Access entries are read.
+        with self.assertNumQueries(1):
+            resolver = PermissionResolver(objects)
+            self.assertEqual([resolver.has_permission(*check) for check in checks], expected)
+        files = [(check, allowed) for check, allowed in zip(checks, expected) if isinstance(check[1], File)]
+        # Without them, their positions take one more query.
+        with self.assertNumQueries(2):
+            resolver = PermissionResolver(obj for obj in objects if isinstance(obj, File))
+            self.assertEqual([resolver.has_permission(*check) for check, allowed in files],
+                             [allowed for check, allowed in files])
+
+    def test_cache_reuses_results(self):
+        self.share(self.folder, user=self.other)
+        permissions = PermissionCache()
+        self.assertTrue(permissions.has_permission(self.other, self.file, Permission.CATEGORIES.view))
+        with self.assertNumQueries(0):
+            self.assertTrue(permissions.has_permission(self.other, self.file, Permission.CATEGORIES.view))
+            self.assertFalse(permissions.has_permission(self.other, self.file, Permission.CATEGORIES.edit))
+        self.assertEqual((permissions.hits, permissions.misses), (2, 1))
+
+    def test_move_to_foreign_folder(self):
+        foreign = Folder.objects.create(name='foreign', parent=Folder.objects.get_user_root(self.other),
+                                        owner=self.other)
+        child = Folder.objects.get(pk=self.child.pk)
+        child.move_to(foreign)
+        self.assertPermissions(self.owner, {Folder.objects.get(pk=self.child.pk): (True, True),
+                                            self.file: (True, True)})
+        self.assertPermissions(self.other, {foreign: (True, True), File.objects.get(pk=self.file.pk): (True, True)})
+
+
+@override_settings(CACHALOT_ENABLED=False)
+class SearchTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create_user('owner')
+        self.other = User.objects.create_user('other')
+        root = Folder.objects.get_user_root(self.owner)
+        self.shared = Folder.objects.create(name='report shared', parent=root, owner=self.owner)
+        self.private = Folder.objects.create(name='report private', parent=root, owner=self.owner)
+        self.file = File.objects.create(folder=self.shared, owner=self.owner, file=ContentFile(b'x', name='report.txt'))
+        self.single = File.objects.create(folder=self.private, owner=self.owner,
+                                          file=ContentFile(b'x', name='report single.txt'))
+        Permission.objects.create(content_type=ContentType.objects.get_for_model(Folder), object_id=self.shared.pk,
+                                  user=self.other)
+        Permission.objects.create(content_type=ContentType.objects.get_for_model(File), object_id=self.single.pk,
+                                  everybody=True)
+
+    def found(self, user):
+        return set(search.search(user, 'report'))
+
+    def test_visibility(self):
+        self.assertEqual(self.found(self.owner), {self.shared, self.private, self.file, self.single})
+        self.assertEqual(self.found(self.other), {self.shared, self.file, self.single})
+        self.assertEqual(self.found(AnonymousUser()), {self.single})
+
+    def test_limit(self):
+        self.assertEqual(len(search.search(self.owner, 'report', limit=3)), 3)
+        self.assertEqual(search.search(self.owner, '***'), [])
+
+
+@override_settings(CACHALOT_ENABLED=False)
+class KeysetPaginationTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        self.owner = get_user_model().objects.create_user('owner')
+        self.folder = Folder.objects.create(name='folder', parent=Folder.objects.get_user_root(self.owner),
+                                            owner=self.owner)
+        for i in range(3):
+            Folder.objects.create(name='child %d' % i, parent=Folder.objects.get(pk=self.folder.pk), owner=self.owner)
+        # Equal names, so pages have to continue on the later keys.
+        for i in range(5):
+            File.objects.create(folder=self.folder, owner=self.owner, name='same.txt',
+                                file=ContentFile(b'x', name='file%d.txt' % (i % 2)))
+        self.client.force_login(self.owner)
+        self.url = reverse('core:folder-items', args=[self.folder.slug])
+
+    def test_pages_cover_all_items_once(self):
+        folders, files, cursor = [], [], None
+        while True:
+            data = self.client.get(self.url, dict({'limit': 2}, **({'cursor': cursor} if cursor else {}))).json()
+            folders += [folder['slug'] for folder in data['folders']]
+            files += [file['slug'] for file in data['files']]
+            cursor = data['next']
+            if not cursor:
+                break
+        self.assertEqual(folders, [f.slug for f in self.folder.children.order_by('name', 'id')])
+        self.assertEqual(files, [f.slug for f in self.folder.files.order_by('name', 'original_filename', 'id')])
+
+    def test_malformed_cursor(self):
+        for cursor in ('garbage', encode_cursor('children', ['child 1']), encode_cursor('files', ['a', 'b', 'c', 4]),
+                       encode_cursor('children', ['child 1', 'x']), encode_cursor('nothing', None)):
+            self.assertEqual(self.client.get(self.url, {'cursor': cursor}).status_code, 400, cursor)
+        self.assertEqual(self.client.get(self.url, {'cursor': encode_cursor('files', None)}).status_code, 200)
+
+
+@override_settings(CACHALOT_ENABLED=False)
+class DownloadTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        self.owner = get_user_model().objects.create_user('owner')
+        root = Folder.objects.get_user_root(self.owner)
+        self.file = File.objects.create(folder=root, owner=self.owner, file=ContentFile(b'0123456789', name='d.txt'))
+        self.url = reverse('core:file-download', args=[self.file.slug])
+        self.client.force_login(self.owner)
+
+    def get(self, url=None, **headers):
+        response = self.client.get(url or self.url, **headers)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, content
+
+    def test_full(self):
+        response, content = self.get()
+        self.assertEqual((response.status_code, content), (200, b'0123456789'))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['X-Content-Type-Options'], 'nosniff')
+        self.assertTrue(response['Content-Disposition'].startswith('attachment;'))
+
+    def test_range(self):
+        response, content = self.get(HTTP_RANGE='bytes=2-4')
+        self.assertEqual((response.status_code, content), (206, b'234'))
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+        response, content = self.get(HTTP_RANGE='bytes=-3')
+        self.assertEqual((response.status_code, content), (206, b'789'))
+        response, content = self.get(HTTP_RANGE='bytes=20-30')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */10'))
+
+    def test_conditional(self):
+        response, content = self.get()
+        etag = response['ETag']
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag)[0].status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])[0].status_code, 304)
+        # A range of another version of the file is answered with the whole current file.
+        response, content = self.get(HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE='"other"')
+        self.assertEqual((response.status_code, content), (200, b'0123456789'))
+        self.assertEqual(self.get(HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE=etag)[0].status_code, 206)
+
+    def test_inline(self):
+        response, content = self.get(self.url + '?inline')
+        self.assertTrue(response['Content-Disposition'].startswith('inline;'))
+        for name in ('page.html', 'image.svg'):
+            file = File.objects.create(folder=self.file.folder, owner=self.owner, file=ContentFile(b'<x/>', name=name))
+            response, content = self.get(reverse('core:file-download', args=[file.slug]) + '?inline')
+            self.assertTrue(response['Content-Disposition'].startswith('attachment;'), name)
+
+    @override_settings(DRIVE_SENDFILE='x-accel-redirect', DRIVE_SENDFILE_URL='/protected/')
+    def test_accel_redirect_is_quoted(self):
+        self.file.file.name = 'files/a b?#%.txt'
+        self.file.save()
+        response, content = self.get()
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/files/a%20b%3F%23%25.txt')
+
+
+@override_settings(CACHALOT_ENABLED=False)
+class ChunkedUploadTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        self.owner = get_user_model().objects.create_user('owner')
+        self.root = Folder.objects.get_user_root(self.owner)
+        self.client.force_login(self.owner)
+        response = self.client.post(reverse('core:upload-start', args=[self.root.slug]),
+                                    {'filename': 'chunked.txt', 'size': 10})
+        self.assertEqual(response.status_code, 201)
+        self.url = response.json()['url']
+        self.upload = Upload.objects.get(token=response.json()['token'])
+
+    def put(self, data, start, size=10):
+        return self.client.put(self.url, data, content_type='application/octet-stream',
+                               HTTP_CONTENT_RANGE='bytes %d-%d/%d' % (start, start + len(data) - 1, size))
+
+    def finalize(self):
+        return self.client.post(reverse('core:upload-finalize', args=[self.upload.token]))
+
+    def test_resume_and_finalize(self):
+        self.assertEqual(self.put(b'01234', 0).json(), {'offset': 5, 'size': 10})
+        self.assertEqual(self.client.get(self.url).json(), {'offset': 5, 'size': 10})
+        self.assertEqual(self.finalize().status_code, 409)
+        # A chunk that was already received is refused with the offset to continue from.
+        response = self.put(b'01234', 0)
+        self.assertEqual((response.status_code, response.json()['offset']), (409, 5))
+        self.assertEqual(self.put(b'56789', 5).json(), {'offset': 10, 'size': 10})
+        self.assertEqual(self.finalize().status_code, 201)
+        file = File.objects.get(folder=self.root)
+        self.assertEqual((file.name, file.size), ('chunked.txt', 10))
+        self.assertEqual(file.checksum, hashlib.sha256(b'0123456789').hexdigest())
+        with default_storage.open(file.file.name) as f:
+            self.assertEqual(f.read(), b'0123456789')
+        self.assertFalse(Upload.objects.filter(pk=self.upload.pk).exists())
+
+    def test_invalid_ranges(self):
+        self.assertEqual(self.client.put(self.url, b'x', content_type='application/octet-stream').status_code, 400)
+        self.assertEqual(self.put(b'0123', 0, size=11).status_code, 400)
+        self.assertEqual(self.put(b'0123456789x', 0, size=10).status_code, 400)
+        self.assertEqual(Upload.objects.get(pk=self.upload.pk).offset, 0)
+
+    def test_concurrent_chunk(self):
+        with open(default_storage.path(self.upload.path), 'rb') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self.assertEqual(self.put(b'01234', 0).status_code, 409)
+        self.assertEqual(self.put(b'01234', 0).status_code, 200)
+
+    def test_finalize_once(self):
+        self.put(b'0123456789', 0)
+        upload = Upload.objects.get(pk=self.upload.pk)
+        uploads.finalize_upload(upload)
+        # A second finalize that loaded the upload before the first one deleted it.
+        with self.assertRaises(uploads.UploadError) as context:
+            uploads.finalize_upload(upload)
+        self.assertEqual(context.exception.status, 409)
+        self.assertEqual(File.objects.filter(folder=self.root).count(), 1)
+        self.assertEqual(self.finalize().status_code, 404)
+
+    def test_revoked_share(self):
+        uploader = get_user_model().objects.create_user('uploader')
+        permission = Permission.objects.create(content_type=ContentType.objects.get_for_model(Folder),
+                                               object_id=self.root.pk, user=uploader,
+                                               category=Permission.CATEGORIES.edit)
+        self.client.force_login(uploader)
+        response = self.client.post(reverse('core:upload-start', args=[self.root.slug]),
+                                    {'filename': 'shared.txt', 'size': 10})
+        self.url = response.json()['url']
+        self.assertEqual(self.put(b'01234', 0).status_code, 200)
+        permission.delete()
+        self.assertEqual(self.put(b'56789', 5).status_code, 403)
+        self.assertEqual(Upload.objects.get(token=response.json()['token']).offset, 5)
+
+    def test_abort(self):
+        self.put(b'01234', 0)
+        self.assertEqual(self.client.delete(self.url).status_code, 200)
+        self.assertFalse(Upload.objects.filter(pk=self.upload.pk).exists())
+        self.assertFalse(os.path.exists(default_storage.path(self.upload.path)))
+        self.assertEqual(self.client.delete(self.url).status_code, 404)
+
+    def test_abort_errors(self):
+        # An abort that loaded the upload before it was finalized.
+        self.put(b'0123456789', 0)
+        uploads.finalize_upload(Upload.objects.get(pk=self.upload.pk))
+        with self.assertRaises(uploads.UploadError) as context:
+            uploads.abort_upload(self.upload)
+        self.assertEqual(context.exception.status, 409)
+        self.assertEqual(File.objects.filter(folder=self.root).count(), 1)
+
+    def test_abort_storage_error(self):
+        with mock.patch.object(default_storage, 'delete', side_effect=PermissionError('read-only')):
+            response = self.client.delete(self.url)
+        self.assertEqual(response.status_code, 500)
+        self.assertIn('sweeper', response.json()['error'])
+        self.assertFalse(Upload.objects.filter(pk=self.upload.pk).exists())
+
+
+@override_settings(CACHALOT_ENABLED=False)
+class ArchiveTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        self.owner = get_user_model().objects.create_user('owner')
+        self.top = Folder.objects.create(name='top', parent=Folder.objects.get_user_root(self.owner), owner=self.owner)
+        self.client.force_login(self.owner)
+
+    def download(self, folder):
+        response = self.client.get(reverse('core:folder-download', args=[folder.slug]))
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertIsNone(archive.testzip())
+        return archive
+
+    def test_contents(self):
+        sub = Folder.objects.create(name='sub', parent=self.top, owner=self.owner)
+        Folder.objects.create(name='empty', parent=Folder.objects.get(pk=self.top.pk), owner=self.owner)
+        File.objects.create(folder=sub, owner=self.owner, file=ContentFile(b'text', name='a.txt'))
+        File.objects.create(folder=sub, owner=self.owner, name='a.txt', file=ContentFile(b'other', name='a.txt'))
+        archive = self.download(self.top)
+        self.assertEqual(sorted(archive.namelist()),
+                         ['top/', 'top/empty/', 'top/sub/', 'top/sub/a (2).txt', 'top/sub/a.txt'])
+        self.assertEqual({archive.read('top/sub/a.txt'), archive.read('top/sub/a (2).txt')}, {b'text', b'other'})
+
+    def test_unsafe_names(self):
+        for name in ('..', '.', 'a/b', 'a\\b'):
+            Folder.objects.create(name=name, parent=Folder.objects.get(pk=self.top.pk), owner=self.owner)
+        file = File.objects.create(folder=self.top, owner=self.owner, file=ContentFile(b'x', name='x.txt'))
+        File.objects.filter(pk=file.pk).update(original_filename='../../evil.txt')
+        names = self.download(self.top).namelist()
+        self.assertEqual(sorted(names),
+                         ['top/', 'top/.._.._evil.txt', 'top/_/', 'top/__/', 'top/a_b (2)/', 'top/a_b/'])
+        for name in names:
+            self.assertNotIn('..', name.split('/'))
+            self.assertNotIn('\\', name)
+
+
+@override_settings(CACHALOT_ENABLED=False)
+class AggregateTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        self.owner = get_user_model().objects.create_user('owner')
+        self.root = Folder.objects.get_user_root(self.owner)
+        self.a = Folder.objects.create(name='a', parent=self.root, owner=self.owner)
+        self.b = Folder.objects.create(name='b', parent=Folder.objects.get(pk=self.root.pk), owner=self.owner)
+        self.sub = Folder.objects.create(name='sub', parent=self.a, owner=self.owner)
+        self.file = File.objects.create(folder=self.sub, owner=self.owner, file=ContentFile(b'12345', name='f.txt'))
+
+    def counters(self, folder):
+        return Folder.objects.filter(pk=folder.pk).values_list(
+            'file_count', 'folder_count', 'size', 'total_file_count', 'total_folder_count', 'total_size').get()
+
+    def test_create(self):
+        self.assertEqual(self.counters(self.sub), (1, 0, 5, 1, 0, 5))
+        self.assertEqual(self.counters(self.a), (0, 1, 0, 1, 1, 5))
+        self.assertEqual(self.counters(self.root), (0, 2, 0, 1, 3, 5))
+
+    def test_file_change_move_and_delete(self):
+        self.file.file = ContentFile(b'1234567', name='g.txt')
+        self.file.save()
+        self.assertEqual(self.counters(self.root)[3:], (1, 3, 7))
+        self.file.folder = self.b
+        self.file.save()
+        self.assertEqual(self.counters(self.a)[3:], (0, 1, 0))
+        self.assertEqual(self.counters(self.b), (1, 0, 7, 1, 0, 7))
+        File.objects.get(pk=self.file.pk).delete()
+        self.assertEqual(self.counters(self.root), (0, 2, 0, 0, 3, 0))
+
+    def test_folder_move_and_delete(self):
+        sub = Folder.objects.get(pk=self.sub.pk)
+        sub.move_to(Folder.objects.get(pk=self.b.pk))
+        self.assertEqual(self.counters(self.a), (0, 0, 0, 0, 0, 0))
+        self.assertEqual(self.counters(self.b), (0, 1, 0, 1, 1, 5))
+        self.assertEqual(self.counters(self.root)[3:], (1, 3, 5))
+        Folder.objects.get(pk=self.b.pk).delete()
+        self.assertEqual(self.counters(self.root), (0, 1, 0, 0, 1, 0))
+
+    def test_reconcile(self):
+        expected = [self.counters(folder) for folder in (self.root, self.a, self.sub)]
+        Folder.objects.filter(pk__in=[self.a.pk, self.sub.pk]).update(size=99, total_file_count=42)
+        self.assertEqual(Folder.objects.reconcile_aggregates(Folder.objects.get(pk=self.root.pk)), 2)
+        self.assertEqual([self.counters(folder) for folder in (self.root, self.a, self.sub)], expected)
+        self.assertEqual(Folder.objects.reconcile_aggregates(Folder.objects.get(pk=self.root.pk)), 0)
+
+
+@override_settings(CACHALOT_ENABLED=False)
+class QuotaTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        self.owner = get_user_model().objects.create_user('owner')
+        self.root = Folder.objects.get_user_root(self.owner)
+        self.quota = Quota.objects.get_for_user(self.owner)
+        self.quota.limit = 10
+        self.quota.save()
+        self.client.force_login(self.owner)
+
+    def usage(self, user=None):
+        return Quota.objects.get(user=user or self.owner).usage
+
+    def test_usage(self):
+        file = File.objects.create(folder=self.root, owner=self.owner, file=ContentFile(b'12345', name='f.txt'))
+        self.assertEqual(self.usage(), 5)
+        other = get_user_model().objects.create_user('other')
+        Quota.objects.get_for_user(other)
+        file.owner = other
+        file.save()
+        self.assertEqual((self.usage(), self.usage(other)), (0, 5))
+        file.delete()
+        self.assertEqual(self.usage(other), 0)
+
+    def test_reconcile(self):
+        File.objects.create(folder=self.root, owner=self.owner, file=ContentFile(b'12345', name='f.txt'))
+        Quota.objects.filter(pk=self.quota.pk).update(usage=99)
+        self.assertEqual(Quota.objects.reconcile(), 1)
+        self.assertEqual(self.usage(), 5)
+        self.assertEqual(Quota.objects.reconcile(), 0)
+
+    def test_upload_start(self):
+        url = reverse('core:upload-start', args=[self.root.slug])
+        self.assertEqual(self.client.post(url, {'filename': 'a.txt', 'size': 11}).status_code, 413)
+        self.assertEqual(self.client.post(url, {'filename': 'a.txt', 'size': 10}).status_code, 201)
+
+    def test_file_add(self):
+        url = reverse('core:file-add', args=[self.root.slug])
+        response = self.client.post(url, {'folder': self.root.pk, 'file': SimpleUploadedFile('a.txt', b'x' * 11)})
+        self.assertContains(response, 'storage quota', status_code=200)
+        self.assertFalse(File.objects.exists())
+        with override_settings(DRIVE_QUOTA=10):
+            Quota.objects.filter(pk=self.quota.pk).update(limit=None, usage=10 ** 6)
+            response = self.client.post(url, {'folder': self.root.pk, 'file': SimpleUploadedFile('a.txt', b'x')})
+        self.assertContains(response, 'storage quota', status_code=413)
+        self.assertFalse(File.objects.exists())
+
+
+@override_settings(CACHALOT_ENABLED=False)
+class BulkTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create_user('owner')
+        self.other = User.objects.create_user('other')
+        self.root = Folder.objects.get_user_root(self.owner)
+        self.source = Folder.objects.create(name='source', parent=self.root, owner=self.owner)
+        self.target = Folder.objects.create(name='target', parent=Folder.objects.get(pk=self.root.pk),
+                                            owner=self.owner)
+        self.sub = Folder.objects.create(name='sub', parent=self.source, owner=self.owner)
+        self.file = File.objects.create(folder=self.sub, owner=self.owner, file=ContentFile(b'abc', name='a.txt'))
+        self.client.force_login(self.owner)
+
+    def post(self, action, **data):
+        return self.client.post(reverse('core:bulk', args=[action]), data)
+
+    def assertTreeValid(self):
+        self.assertEqual(Folder.objects.rebuild_tree(self.root.tree_id), 0)
+
+    def test_move(self):
+        response = self.post('move', folders=[self.sub.slug], target=self.target.slug)
+        self.assertEqual(response.json(), {'folders': 1, 'files': 0})
+        self.assertEqual(Folder.objects.get(pk=self.sub.pk).parent_id, self.target.pk)
+        self.assertTreeValid()
+        target, source = Folder.objects.get(pk=self.target.pk), Folder.objects.get(pk=self.source.pk)
+        self.assertEqual((target.total_file_count, target.total_size), (1, 3))
+        self.assertEqual((source.total_file_count, source.total_size), (0, 0))
+
+    def test_trees_are_shifted_not_rebuilt(self):
+        other_root = Folder.objects.get_user_root(self.other)
+        Permission.objects.create(content_type=ContentType.objects.get_for_model(Folder), object_id=other_root.pk,
+                                  user=self.owner, category=Permission.CATEGORIES.edit)
+        with mock.patch.object(type(Folder.objects), 'rebuild_tree', side_effect=AssertionError):
+            self.assertEqual(self.post('copy', folders=[self.source.slug], target=self.root.slug).status_code, 200)
+            self.assertEqual(self.post('copy', folders=[self.source.slug], target=self.root.slug).status_code, 200)
+            self.assertEqual(self.post('move', folders=[self.source.slug], target=self.target.slug).status_code, 200)
+            self.assertEqual(self.post('move', folders=[self.sub.slug], target=other_root.slug).status_code, 200)
+        # Children are placed in name order, as rebuild_tree numbers them.
+        self.assertEqual(list(Folder.objects.get(pk=self.root.pk).get_children().values_list('name', flat=True)),
+                         ['source (2)', 'source (3)', 'target'])
+        self.assertTreeValid()
+        self.assertEqual(Folder.objects.rebuild_tree(other_root.tree_id), 0)
+        self.assertEqual(Folder.objects.get(pk=self.sub.pk).get_ancestors().get().pk, other_root.pk)
+
+    def test_move_into_itself(self):
+        self.assertEqual(self.post('move', folders=[self.source.slug], target=self.sub.slug).status_code, 400)
+
+    def test_copy(self):
+        # The file is part of the selected folder and copied with it only.
+        response = self.post('copy', folders=[self.sub.slug], files=[self.file.slug], target=self.target.slug)
+        self.assertEqual(response.json(), {'folders': 1, 'files': 1})
+        self.assertTreeValid()
+        copied = Folder.objects.get(parent=self.target, name='sub')
+        self.assertEqual(copied.files.get().checksum, self.file.checksum)
+        self.assertEqual(Folder.objects.get(pk=self.target.pk).total_file_count, 1)
+        self.assertEqual(File.objects.filter(folder=self.sub).count(), 1)
+
+    def test_delete(self):
+        self.assertEqual(self.post('delete', folders=[self.source.slug]).status_code, 200)
+        self.assertFalse(Folder.objects.filter(pk__in=[self.source.pk, self.sub.pk]).exists())
+        self.assertFalse(File.objects.filter(pk=self.file.pk).exists())
+        self.assertTreeValid()
+        self.assertEqual(Folder.objects.get(pk=self.root.pk).total_file_count, 0)
+
+    def test_share(self):
+        response = self.post('share', folders=[self.source.slug], user=str(self.other.pk))
+        self.assertEqual(response.json(), {'permissions': 1})
+        self.assertTrue(File.objects.get(pk=self.file.pk).has_permission(self.other, Permission.CATEGORIES.view))
+
+    def test_share_invalid_user(self):
+        for user in ('abc', '1.5', '9' * 30):
+            response = self.post('share', folders=[self.source.slug], user=user)
+            self.assertEqual(response.status_code, 400, user)
+            self.assertEqual(response.json(), {'error': 'Invalid user id.'})
+
+    def test_foreign_selection(self):
+        self.client.force_login(self.other)
+        self.assertEqual(self.post('delete', folders=[self.source.slug]).status_code, 403)
+        self.assertTrue(Folder.objects.filter(pk=self.source.pk).exists())
+
+
+@override_settings(CACHALOT_ENABLED=False)
+class DeduplicationTest(TestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.owner = get_user_model().objects.create_user('owner')
+        self.root = Folder.objects.get_user_root(self.owner)
+        self.client.force_login(self.owner)
+
+    def upload(self, content, name='upload.txt'):
+        response = self.client.post(reverse('core:file-add', args=[self.root.slug]),
+                                    {'folder': self.root.pk, 'file': SimpleUploadedFile(name, content)})
+        self.assertEqual(response.status_code, 302)
+        return File.objects.latest('pk')
+
+    def test_same_content_is_stored_once(self):
+        for max_memory_size in (2 ** 20, 4):
+            with self.settings(FILE_UPLOAD_MAX_MEMORY_SIZE=max_memory_size):
+                first, second = self.upload(b'same content', 'a.txt'), self.upload(b'same content', 'b.txt')
+            self.assertEqual(first.checksum, hashlib.sha256(b'same content').hexdigest())
+            self.assertEqual(first.file.name, second.file.name)
+            self.assertEqual(second.original_filename, 'b.txt')
+            first.delete()
+            second.delete()
+            # Only the sweeper removes blobs.
+            self.assertTrue(default_storage.exists(second.file.name))
+            sweeper.sweep_directory('blobs', sweeper._referenced_by_files, time.time() + 60)
+            self.assertFalse(default_storage.exists(second.file.name))
+
+    def test_passed_on_files_are_not_hashed(self):
+        handler = uploads.HashingMemoryFileUploadHandler()
+        handler.handle_raw_input(None, {}, settings.FILE_UPLOAD_MAX_MEMORY_SIZE + 1, 'boundary')
+        handler.new_file('file', 'large.bin', 'application/octet-stream', settings.FILE_UPLOAD_MAX_MEMORY_SIZE + 1)
+        self.assertEqual(handler.receive_data_chunk(b'data', 0), b'data')
+        self.assertEqual(handler.hasher.hexdigest(), hashlib.sha256().hexdigest())
+
+
+@override_settings(CACHALOT_ENABLED=False)
+class SweeperTest(TestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.owner = get_user_model().objects.create_user('owner')
+        self.root = Folder.objects.get_user_root(self.owner)
+        self.folder = Folder.objects.create(name='folder', parent=self.root, owner=self.owner)
+        Folder.objects.create(name='sub', parent=self.folder, owner=self.owner)
+        self.kept = File.objects.create(folder=self.root, owner=self.owner, file=ContentFile(b'kept', name='k.txt'))
+        self.gone = File.objects.create(folder=self.folder, owner=self.owner, file=ContentFile(b'gone', name='g.txt'))
+        self.client.force_login(self.owner)
+
+    def delete_folder(self):
+        response = self.client.post(reverse('core:folder-delete', args=[self.folder.slug]))
+        self.assertEqual(response.status_code, 302)
+
+    def test_subtree_delete(self):
+        self.delete_folder()
+        self.assertEqual(Folder.objects.filter(tree_id=self.root.tree_id).count(), 1)
+        self.assertFalse(File.objects.filter(pk=self.gone.pk).exists())
+        root = Folder.objects.get(pk=self.root.pk)
+        self.assertEqual((root.total_folder_count, root.total_file_count, root.total_size), (0, 1, 4))
+        self.assertEqual(Folder.objects.rebuild_tree(self.root.tree_id), 0)
+        # The blob is left to the sweeper.
+        self.assertTrue(default_storage.exists(self.gone.file.name))
+
+    def test_delete_counts(self):
+        Permission.objects.create(content_type=ContentType.objects.get_for_model(File), object_id=self.gone.pk,
+                                  everybody=True)
+        total, counts = Folder.objects.get(pk=self.folder.pk).delete()
+        self.assertEqual({label: count for label, count in counts.items() if count},
+                         {'core.Folder': 2, 'core.File': 1, 'core.Permission': 1, 'core.Access': 1})
+        self.assertEqual(total, 5)
+
+    def test_sweep(self):
+        self.delete_folder()
+        cutoff = time.time() + 60
+        self.assertEqual(sweeper.sweep_directory('blobs', sweeper._referenced_by_files, cutoff, dry_run=True), 1)
+        self.assertTrue(default_storage.exists(self.gone.file.name))
+        self.assertEqual(sweeper.sweep_directory('blobs', sweeper._referenced_by_files, cutoff), 1)
+        self.assertFalse(default_storage.exists(self.gone.file.name))
+        self.assertTrue(default_storage.exists(self.kept.file.name))
+
+    def test_referenced_during_sweep(self):
+        self.delete_folder()
+
+        def referenced(names):
+            result = sweeper._referenced_by_files(names)
+            if len(names) > 1:
+                # The same content is uploaded again after the references were looked up.
+                File.objects.create(folder=self.root, owner=self.owner, file=ContentFile(b'gone', name='again.txt'))
+            return result
+
+        self.assertEqual(sweeper.sweep_directory('blobs', referenced, time.time() + 60), 0)
+        self.assertTrue(default_storage.exists(self.gone.file.name))
+
+    def test_touched_during_sweep(self):
+        self.delete_folder()
+        path = default_storage.path(self.gone.file.name)
+
+        def referenced(names):
+            os.utime(path, (time.time() + 120,) * 2)
+            return sweeper._referenced_by_files(names)
+
+        self.assertEqual(sweeper.sweep_directory('blobs', referenced, time.time() + 60), 0)
+        self.assertTrue(os.path.exists(path))
+
+
+@override_settings(CACHALOT_ENABLED=False)
+class ChecksumTest(TestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.owner = get_user_model().objects.create_user('owner')
+        self.root = Folder.objects.get_user_root(self.owner)
+        self.file = File.objects.create(folder=self.root, owner=self.owner, file=ContentFile(b'content', name='c.txt'))
+
+    def test_unchanged_file_is_not_read(self):
+        file = File.objects.get(pk=self.file.pk)
+        file.description = 'changed'
+        with mock.patch.object(default_storage, 'size') as size, mock.patch.object(default_storage, 'open') as open_:
+            file.save()
+        self.assertFalse(size.called or open_.called)
+        self.assertEqual(File.objects.get(pk=file.pk).size, 7)
+
+    def test_known_checksum_is_not_read(self):
+        copy = File(folder=self.root, owner=self.owner, file=self.file.file.name, name='copy.txt', size=7,
+                    checksum=self.file.checksum)
+        with mock.patch.object(default_storage, 'size') as size, mock.patch.object(default_storage, 'open') as open_:
+            copy.save()
+        self.assertFalse(size.called or open_.called)
+        self.assertEqual(File.objects.get(pk=copy.pk).checksum, hashlib.sha256(b'content').hexdigest())
+
+    def verify(self, *args):
+        out, err = io.StringIO(), io.StringIO()
+        call_command('verify_checksums', *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_verify_checksums(self):
+        self.assertIn('ok: 1', self.verify()[0])
+        with open(default_storage.path(self.file.file.name), 'wb') as f:
+            f.write(b'corrupted')
+        out, err = io.StringIO(), io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command('verify_checksums', stdout=out, stderr=err)
+        self.assertIn('Checksum mismatch: %s' % self.file.file.name, err.getvalue())
+        self.assertIn('corrupt: 1', out.getvalue())
+
+    def test_fill(self):
+        File.objects.filter(pk=self.file.pk).update(checksum='')
+        self.assertIn('filled: 1', self.verify('--fill')[0])
+        self.assertEqual(File.objects.get(pk=self.file.pk).checksum, hashlib.sha256(b'content').hexdigest())
+
+
+@override_settings(CACHALOT_ENABLED=False)
+class IngestTest(TestCase):
+    CONTENTS = {'top.txt': b'top', 'a/x.txt': b'same', 'a/b/y.txt': b'other', 'a/b/z.txt': b'same'}
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source, ignore_errors=True)
+        os.makedirs(os.path.join(self.source, 'c'))
+        for name, content in self.CONTENTS.items():
+            os.makedirs(os.path.dirname(os.path.join(self.source, name)), exist_ok=True)
+            with open(os.path.join(self.source, name), 'wb') as f:
+                f.write(content)
+        self.owner = get_user_model().objects.create_user('owner')
+        self.root = Folder.objects.get_user_root(self.owner)
+
+    def ingest(self):
+        out = io.StringIO()
+        call_command('ingest', self.source, 'owner', '--workers', '1', verbosity=0, stdout=out)
+        return out.getvalue()
+
+    def test_ingest(self):
+        self.assertIn('Imported 3 folders and 4 files', self.ingest())
+        a = Folder.objects.get(parent=self.root, name='a')
+        self.assertEqual(Folder.objects.get(name='b').parent_id, a.pk)
+        self.assertEqual(Folder.objects.get(name='c').parent_id, self.root.pk)
+        self.assertEqual(Folder.objects.rebuild_tree(self.root.tree_id), 0)
+        for name, content in self.CONTENTS.items():
+            folder = self.root
+            for part in name.split('/')[:-1]:
+                folder = Folder.objects.get(parent=folder, name=part)
+            file = File.objects.get(folder=folder, name=os.path.basename(name))
+            self.assertEqual((file.size, file.checksum), (len(content), hashlib.sha256(content).hexdigest()))
+            with default_storage.open(file.file.name) as f:
+                self.assertEqual(f.read(), content)
+        self.assertEqual(File.objects.get(name='x.txt').file.name, File.objects.get(name='z.txt').file.name)
+        root, a = Folder.objects.get(pk=self.root.pk), Folder.objects.get(pk=a.pk)
+        self.assertEqual((root.file_count, root.folder_count, root.total_file_count, root.total_folder_count,
+                          root.total_size), (1, 2, 4, 3, 16))
+        self.assertEqual((a.file_count, a.folder_count, a.total_file_count, a.total_size), (1, 1, 3, 13))
+        self.assertEqual(Folder.objects.reconcile_aggregates(root), 0)
+        self.assertEqual(Quota.objects.get_for_user(self.owner).usage, 16)
+
+    def test_resume(self):
+        self.ingest()
+        self.assertIn('Imported 0 folders and 0 files (4 files already existed)', self.ingest())
+        self.assertEqual(File.objects.count(), 4)
+        self.assertEqual(Folder.objects.get(pk=self.root.pk).total_file_count, 4)
+
+
+@override_settings(CACHALOT_ENABLED=False, DRIVE_PAGE_SIZE=2)
+class FolderPickerTest(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.owner = User.objects.create_user('owner')
+        self.other = User.objects.create_user('other')
+        self.root = Folder.objects.get_user_root(self.owner)
+        self.folders = [Folder.objects.create(name='folder %d' % i, parent=Folder.objects.get(pk=self.root.pk),
+                                              owner=self.owner) for i in range(5)]
+        self.foreign = Folder.objects.create(name='foreign', parent=Folder.objects.get_user_root(self.other),
+                                             owner=self.other)
+        self.client.force_login(self.owner)
+
+    def pick(self, **params):
+        response = self.client.get(reverse('core:folder-picker'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_pages(self):
+        names, params = [], {}
+        while True:
+            data = self.pick(**params)
+            names += [folder['name'] for folder in data['folders']]
+            self.assertEqual(data['more'], bool(data['next']))
+            if not data['next']:
+                break
+            params = {'cursor': data['next']}
+        self.assertEqual(names, ['folder %d' % i for i in range(5)])
+        data = self.pick(q='folder', cursor=self.pick(q='folder')['next'])
+        self.assertEqual([folder['name'] for folder in data['folders']], ['folder 2', 'folder 3'])
+
+    def test_other_drives_are_not_listed(self):
+        self.assertEqual(self.pick(parent=self.foreign.parent_id)['folders'], [])
+        self.assertEqual(self.pick(q='foreign')['folders'], [])
+
+    def test_exclude(self):
+        data = self.pick(exclude=self.folders[0].pk)
+        self.assertNotIn('folder 0', [folder['name'] for folder in data['folders']])
+
+    def test_form_bounds(self):
+        form = FolderForm(self.owner, {'parent': self.foreign.pk, 'name': 'new'})
+        self.assertIn('parent', form.errors)
+        Permission.objects.create(content_type=ContentType.objects.get_for_model(Folder), object_id=self.foreign.pk,
+                                  user=self.owner, category=Permission.CATEGORIES.edit)
+        self.assertTrue(FolderForm(self.owner, {'parent': self.foreign.pk, 'name': 'new'}).is_valid())
+        folder = self.folders[0]
+        child = Folder.objects.create(name='child', parent=folder, owner=self.owner)
+        form = FolderForm(self.owner, {'parent': child.pk, 'name': folder.name}, instance=folder)
+        self.assertIn('parent', form.errors)
+
+
+class ThumbnailTest(SimpleTestCase):
+    def test_write_thumbnails(self):
+        from PIL import Image
+        target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target)
+        source = os.path.join(target, 'source.png')
+        Image.new('RGB', (800, 600)).save(source)
+        previews.write_thumbnails(source, target)
+        self.assertEqual(sorted(os.listdir(target)), sorted(['source.png'] + [
+            '%s.png' % size for size in settings.DRIVE_THUMBNAIL_SIZES]))
+        for size, pixels in settings.DRIVE_THUMBNAIL_SIZES.items():
+            with Image.open(os.path.join(target, '%s.png' % size)) as image:
+                self.assertEqual(max(image.size), min(pixels, 800))
+
+    def test_submit_once(self):
+        executor = mock.Mock()
+        self.addCleanup(previews._pending.discard, -1)
+        with mock.patch.object(previews, 'get_executor', return_value=executor):
+            threads = [threading.Thread(target=previews._submit, args=(-1,)) for thread in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        executor.submit.assert_called_once_with(previews._generate, -1)
+
+
+@override_settings(CACHALOT_ENABLED=False)
+class UserTreeTest(TestCase):
+    def setUp(self):
+        self.admin = get_user_model().objects.create_user('admin')
+
+    def test_admin_root_before_new_user(self):
+        archive = Folder.objects.create(name='Archive', parent=None, owner=self.admin)
+        user = get_user_model().objects.create_user('user')
+        root = Folder.objects.get_user_root(user)
+        self.assertEqual((root.owner_id, root.tree_id), (user.pk, user.pk))
+        self.assertTrue(root.is_user_root)
+        archive.refresh_from_db()
+        self.assertNotEqual(archive.tree_id, root.tree_id)
+        self.assertEqual(Folder.objects.get(pk=archive.pk).owner_id, self.admin.pk)
+
+    def test_moved_root_keeps_user_trees(self):
+        archive = Folder.objects.create(name='Archive', parent=None, owner=self.admin)
+        user = get_user_model().objects.create_user('user')
+        archive.parent = Folder.objects.get_user_root(self.admin)
+        archive.save()
+        self.assertEqual(Folder.objects.get_user_root(user).tree_id, user.pk)
+        self.assertEqual(Folder.objects.get(pk=archive.pk).tree_id, self.admin.pk)
+
+    def test_cached_root(self):
+        root = Folder.objects.get_user_root(self.admin)
+        with self.assertNumQueries(0):
+            self.assertEqual(Folder.objects.get_user_root(self.admin), root)
+        Folder.objects.create(name='docs', parent=root, owner=self.admin)
+        # A change of the tree drops the cached root.
+        self.assertEqual(Folder.objects.get_user_root(self.admin).rght, 4)
+
+    def test_one_root_per_tree(self):
+        root = Folder.objects.get_user_root(self.admin)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Folder.objects.create(name='second', parent=None, owner=self.admin, tree_id=root.tree_id, lft=1, rght=2,
+                                  level=0)
+
+    def test_concurrent_root_creation(self):
+        root = Folder.objects.get_user_root(self.admin)
+        first, lookups = QuerySet.first, []
+
+        def racing_first(queryset):
+            # The first lookup misses the root created by another request in the meantime.
+            lookups.append(queryset)
+            return None if len(lookups) == 1 else first(queryset)
+
+        with mock.patch.object(QuerySet, 'first', racing_first), \
+                mock.patch.object(type(Folder.objects), '_move_tree_away'):
+            self.assertEqual(Folder.objects.create_user_root(self.admin).pk, root.pk)
+        self.assertEqual(Folder.objects.filter(tree_id=self.admin.pk, level=0).count(), 1)
+
+    def migrations(self):
+        state = MigrationExecutor(connection).loader.project_state(('core', '0010_user_trees'))
+        trees = importlib.import_module('core.migrations.0010_user_trees')
+        index = importlib.import_module('core.migrations.0011_folder_root_index')
+        return state.apps, connection.schema_editor(), trees, index
+
+    def join(self):
+        # Migrating back removes the root index first.
+        apps, schema_editor, trees, index = self.migrations()
+        index.drop_root_index(apps, schema_editor)
+        trees.join_user_trees(apps, schema_editor)
+
+    def split(self):
+        apps, schema_editor, trees, index = self.migrations()
+        trees.split_user_trees(apps, schema_editor)
+        index.create_root_index(apps, schema_editor)
+
+    def test_migration_round_trip(self):
+        user = get_user_model().objects.create_user('user')
+        roots = [Folder.objects.get_user_root(owner) for owner in (self.admin, user)]
+        Folder.objects.create(name='docs', parent=roots[1], owner=user)
+        archive = Folder.objects.create(name='Archive', parent=None, owner=self.admin)
+        self.join()
+        container = Folder.objects.get(name='Users', parent=None)
+        self.assertEqual(set(Folder.objects.filter(parent=container).values_list('pk', 'level')),
+                         {(roots[0].pk, 1), (roots[1].pk, 1)})
+        self.assertTrue(all(tree_id > 0 for tree_id in Folder.objects.values_list('tree_id', flat=True)))
+        self.assertEqual(Folder.objects.rebuild_tree(container.tree_id), 0)
+        self.split()
+        self.assertFalse(Folder.objects.filter(name='Users').exists())
+        for root in roots:
+            root = Folder.objects.get(pk=root.pk)
+            self.assertEqual((root.parent_id, root.level, root.tree_id), (None, 0, root.owner_id))
+            self.assertTrue(root.is_user_root)
+            self.assertEqual(Folder.objects.rebuild_tree(root.tree_id), 0)
+        self.assertEqual(Folder.objects.get(name='docs').tree_id, user.pk)
+        self.assertLess(Folder.objects.get(pk=archive.pk).tree_id, 0)
+
+    def test_migration_keeps_other_container_children(self):
+        root = Folder.objects.get_user_root(self.admin)
+        self.join()
+        container = Folder.objects.get(name='Users', parent=None)
+        shared = Folder.objects.create(name='shared', parent=container, owner=self.admin)
+        public = Folder.objects.create(name='public', parent=Folder.objects.get(pk=container.pk), owner=None)
+        Folder.objects.create(name='sub', parent=public, owner=self.admin)
+        self.split()
+        self.assertEqual(Folder.objects.get(pk=root.pk).tree_id, self.admin.pk)
+        trees = set()
+        for folder in (shared, public):
+            folder = Folder.objects.get(pk=folder.pk)
+            self.assertEqual((folder.parent_id, folder.level), (None, 0))
+            self.assertLess(folder.tree_id, 0)
+            self.assertEqual(Folder.objects.rebuild_tree(folder.tree_id), 0)
+            trees.add(folder.tree_id)
+        self.assertEqual(len(trees), 2)
+        self.assertEqual(Folder.objects.get(name='sub').get_root().pk, public.pk)
+
+    def test_migration_refuses_two_roots(self):
+        Folder.objects.get_user_root(self.admin)
+        self.join()
+        container = Folder.objects.create(name='Users', parent=None, owner=None)
+        Folder.objects.create(name=str(self.admin.pk), parent=container, owner=self.admin)
+        with self.assertRaises(RuntimeError):
+            self.split()
+
+
+@override_settings(CACHALOT_ENABLED=False)
+class SlugTest(TestCase):
+    def setUp(self):
+        self.owner = get_user_model().objects.create_user('owner')
+        self.root = Folder.objects.get_user_root(self.owner)
+        self.taken = Folder.objects.create(name='taken', parent=self.root, owner=self.owner)
+
+    def test_collision_is_retried(self):
+        with mock.patch('core.models.generate_slug', side_effect=[self.taken.slug, 'fresh']):
+            folder = Folder.objects.create(name='untitled', parent=Folder.objects.get(pk=self.root.pk),
+                                           owner=self.owner)
+        self.assertEqual(folder.slug, 'fresh')
+        self.assertEqual(Folder.objects.rebuild_tree(self.root.tree_id), 0)
+        self.assertEqual(Folder.objects.get(pk=self.root.pk).get_descendant_count(), 2)
+
+    def test_user_root_keeps_its_tree(self):
+        with mock.patch('core.models.generate_slug', side_effect=[self.taken.slug, 'fresh']):
+            user = get_user_model().objects.create_user('user')
+        root = Folder.objects.get_user_root(user)
+        self.assertEqual((root.slug, root.tree_id, root.lft, root.rght), ('fresh', user.pk, 1, 2))
+
+    def test_gives_up(self):
+        with mock.patch('core.models.generate_slug', return_value=self.taken.slug):
+            with self.assertRaises(IntegrityError):
+                Folder.objects.create(name='new', parent=self.root, owner=self.owner)
+
+
+@override_settings(CACHALOT_ENABLED=False)
+class MetricsTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        # The local memory cache of the tests evicts entries, among them the list of views that reset() clears.
+        caches[settings.DRIVE_CACHE].clear()
+        metrics.reset()
+        self.owner = get_user_model().objects.create_user('owner')
+        self.root = Folder.objects.get_user_root(self.owner)
+        self.file = File.objects.create(folder=self.root, owner=self.owner,
+                                        file=ContentFile(b'hello world', name='hello.txt'))
+        self.client.force_login(self.owner)
+
+    def render(self):
+        metrics.flush()
+        return metrics.render()
+
+    def test_counters(self):
+        with self.settings(DRIVE_METRICS_SLOW=0), self.assertLogs('core.metrics', 'WARNING') as logs:
+            self.assertEqual(self.client.get(reverse('core:home')).status_code, 200)
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((line['event'], line['view']), ('slow_request', 'core:home'))
+        self.assertGreater(line['queries'], 0)
+        text = self.render()
+        self.assertIn('drive_request_duration_seconds_count{view="core:home"} 1', text)
+        self.assertIn('drive_request_queries_bucket{view="core:home",le="+Inf"} 1', text)
+
+    def test_streamed_response(self):
+        with self.settings(DRIVE_METRICS_SLOW=0), self.assertLogs('core.metrics', 'WARNING') as logs:
+            response = self.client.get(reverse('core:file-download', args=[self.file.slug]))
+            self.assertEqual(b''.join(response.streaming_content), b'hello world')
+            response.close()
+            # assertLogs needs one record.
+            logging.getLogger('core.metrics').warning('done')
+        self.assertEqual([record.getMessage() for record in logs.records], ['done'])
+        text = self.render()
+        self.assertIn('drive_storage_read_bytes_total{view="core:file-download"} 11', text)
+        self.assertIn('drive_streamed_requests_total{view="core:file-download"} 1', text)
+        self.assertIn('drive_request_duration_seconds_count{view="core:file-download"} 0', text)
+
+    @override_settings(CACHALOT_ENABLED=True)
+    def test_query_cache_lookups(self):
+        from cachalot import monkey_patch
+        cachestats.install()
+        hook = monkey_patch._get_result_or_execute_query
+        cachestats.install()
+        metrics.install()
+        # Both consumers share one wrapper of cachalot's lookup.
+        self.assertIs(monkey_patch._get_result_or_execute_query, hook)
+        cachestats.reset()
+        counters = metrics.start()
+        for attempt in range(2):
+            list(Permission.objects.filter(object_id=self.root.pk).order_by('pk'))
+        metrics.finish(counters, 'test', 'GET', '/', 200)
+        self.assertEqual((counters['cachalot_misses'], counters['cachalot_hits']), (1, 1))
+        self.assertEqual(cachestats.get_stats()['core_permission'], {'hits': 1, 'misses': 1, 'invalidations': 0})
+
+    def test_access(self):
+        self.client.logout()
+        url = reverse('core:metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        with self.settings(DRIVE_METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+        with self.settings(DRIVE_METRICS_IPS=('127.0.0.1',)):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.client.force_login(get_user_model().objects.create_user('staff', is_staff=True))
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+@override_settings(CACHALOT_ENABLED=True, DRIVE_CACHALOT_STATS=True)
+class CachalotStatsTest(TransactionTestCase):
+    # Cachalot reports invalidations when the transaction commits.
+    def setUp(self):
+        caches[settings.DRIVE_CACHE].clear()
+        cachestats.install()
+        cachestats.reset()
+        self.owner = get_user_model().objects.create_user('owner')
+        self.root = Folder.objects.get_user_root(self.owner)
+
+    def command(self, *args):
+        out = io.StringIO()
+        call_command('cachalot_stats', *args, stdout=out)
+        return out.getvalue()
+
+    def test_counters(self):
+        for attempt in range(2):
+            list(Permission.objects.filter(object_id=self.root.pk).order_by('pk'))
+        Permission.objects.create(content_type=ContentType.objects.get_for_model(Folder), object_id=self.root.pk,
+                                  user=self.owner)
+        list(Permission.objects.filter(object_id=self.root.pk).order_by('pk'))
+        stats = cachestats.get_stats()['core_permission']
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+        self.assertGreaterEqual(stats['invalidations'], 1)
+        line = next(line for line in self.command().splitlines() if line.startswith('core_permission '))
+        self.assertEqual(line.split()[1:4], ['1', '2', '33.3%'])
+        self.assertEqual(self.command('--reset'), 'Counters reset.\n')
+        self.assertNotIn('core_permission', cachestats.get_stats())
+
+    def test_disabled(self):
+        with self.settings(DRIVE_CACHALOT_STATS=False), self.assertRaises(CommandError):
+            self.command()
+
+
+@override_settings(CACHALOT_ENABLED=False)
+class BenchmarkTest(TestCase):
+    def test_run_rolls_back(self):
+        from core import benchmark
+        results = benchmark.run(repeat=1, users=2, depth=2, fanout=2, files=2)
+        self.assertIn('folder_detail_shared', results['results'])
+        self.assertIn('folder_move', results['results'])
+        self.assertFalse(get_user_model().objects.filter(username__startswith='benchmark-').exists())
+        self.assertEqual(benchmark.compare(results, results), [])
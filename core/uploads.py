@@ -0,0 +1,206 @@
+"""Resumable chunked uploads.
+
+Protocol (all JSON):
+    POST   folder/<slug>/uploads/    filename, size[, name, description]  -> token, offset
+    GET    upload/<token>/           -> offset, size
+    PUT    upload/<token>/           chunk as request body, Content-Range: bytes <start>-<end>/<size>
+    POST   upload/<token>/finalize/  -> url of the new File
+    DELETE upload/<token>/           abort
+A chunk has to start at the current offset; after a dropped connection the client asks for the
+offset and continues from there.
+"""
+import fcntl
+import hashlib
+import os
+import re
+from collections import OrderedDict
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+from django.db import transaction
+from django.utils.timezone import now
+from core import metrics
+from core.conf import settings
+from core.models import File, Upload, Quota
+from core.utils import generate_random_hex
+
+UPLOADS_DIR = 'uploads'
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+# Running checksums of uploads handled by this process, keyed by token: (offset, hasher).
+_hashers = OrderedDict()
+MAX_HASHERS = 1000
+
+
+class HashingMixin:
+    """Computes the sha256 of an uploaded file while it is received (set as `checksum`).
+
+    Only the handler that keeps the data hashes it: the memory handler passes files that are too large
+    on to the next handler without hashing them.
+    """
+
+    def new_file(self, *args, **kwargs):
+        self.hasher = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        if getattr(self, 'activated', True):
+            self.hasher.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.checksum = self.hasher.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(HashingMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingMixin, TemporaryFileUploadHandler):
+    pass
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def start_upload(folder, owner, filename, size, name='', description=None):
+    if not Quota.objects.get_for_user(owner).allows(size):
+        raise UploadError('The file does not fit into the storage quota.', status=413)
+    # Written in place by append_chunk, so never through the (content addressed) storage.
+    token = generate_random_hex(length=32)
+    path = os.path.join(UPLOADS_DIR, token + os.path.splitext(filename)[1].lower())
+    os.makedirs(os.path.dirname(default_storage.path(path)), exist_ok=True)
+    open(default_storage.path(path), 'wb').close()
+    return Upload.objects.create(
+        token=token,
+        folder=folder,
+        owner=owner,
+        filename=filename[:255],
+        name=name,
+        description=description,
+        path=path,
+        size=size,
+    )
+
+
+def _get_hasher(upload):
+    """sha256 of the first `offset` bytes; re-read from disk if another process received them."""
+    offset, hasher = _hashers.pop(upload.token, (None, None))
+    if offset != upload.offset:
+        hasher = hashlib.sha256()
+        with open(default_storage.path(upload.path), 'rb') as f:
+            remaining = upload.offset
+            while remaining > 0:
+                data = f.read(min(settings.DRIVE_UPLOAD_CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                hasher.update(data)
+        metrics.count('storage_read_bytes', upload.offset - remaining)
+    return hasher
+
+
+def _set_hasher(upload, hasher):
+    _hashers[upload.token] = (upload.offset, hasher)
+    while len(_hashers) > MAX_HASHERS:
+        _hashers.popitem(last=False)
+
+
+def append_chunk(upload, stream, content_range):
+    """Append the chunk read from `stream` at the offset given by the Content-Range header.
+
+    The chunk is received without holding a database lock (which would block every other write for as
+    long as the client takes to send it). Writers of the same upload are kept apart by a lock on its
+    file, and the new offset is only stored if nobody moved it in the meantime.
+    """
+    match = CONTENT_RANGE_RE.match(content_range or '')
+    if not match:
+        raise UploadError('Content-Range header is required.')
+    start, end, size = (int(value) for value in match.groups())
+    try:
+        f = open(default_storage.path(upload.path), 'r+b')
+    except FileNotFoundError:
+        raise UploadError('Upload was finalized or aborted.', status=409)
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadError('Another chunk of this upload is being received.', status=409)
+        upload = Upload.objects.filter(pk=upload.pk).first()
+        if upload is None:
+            raise UploadError('Upload was finalized or aborted.', status=409)
+        if size != upload.size or end < start or end >= size:
+            raise UploadError('Invalid Content-Range.')
+        if start != upload.offset:
+            raise UploadError('Chunk does not start at offset %d.' % upload.offset, status=409)
+        hasher = _get_hasher(upload)
+        remaining = end - start + 1
+        f.truncate(upload.offset)
+        f.seek(upload.offset)
+        while remaining > 0:
+            data = stream.read(min(settings.DRIVE_UPLOAD_CHUNK_SIZE, remaining))
+            if not data:
+                break
+            f.write(data)
+            hasher.update(data)
+            remaining -= len(data)
+        f.flush()
+        metrics.count('storage_written_bytes', end - start + 1 - remaining)
+        if remaining:
+            # Incomplete chunk: keep the offset so the client resends it.
+            raise UploadError('Incomplete chunk.')
+        if not Upload.objects.filter(pk=upload.pk, offset=start).update(offset=end + 1, modified=now()):
+            raise UploadError('Upload was changed while the chunk was received.', status=409)
+        upload.offset = end + 1
+        _set_hasher(upload, hasher)
+    return upload
+
+
+def finalize_upload(upload):
+    if upload.offset != upload.size:
+        raise UploadError('Upload is incomplete (%d of %d bytes).' % (upload.offset, upload.size), status=409)
+    # Checked again: other uploads may have been finished since this one started.
+    if not Quota.objects.get_for_user(upload.owner).allows(upload.size):
+        raise UploadError('The file does not fit into the storage quota.', status=413)
+    try:
+        hasher = _get_hasher(upload)
+    except FileNotFoundError:
+        raise UploadError('Upload was already finalized or aborted.', status=409)
+    with transaction.atomic():
+        # Deleting the upload first claims it: a concurrent finalize deletes nothing and creates no second file.
+        deleted, rows = Upload.objects.filter(pk=upload.pk, offset=upload.size).delete()
+        if deleted != 1:
+            raise UploadError('Upload was already finalized or aborted.', status=409)
+        path = upload.path
+        if hasattr(default_storage, 'adopt'):
+            path = default_storage.adopt(path, default_storage.blob_name(hasher.hexdigest(),
+                                                                         os.path.splitext(path)[1]))
+        file = File.objects.create(
+            folder=upload.folder,
+            file=path,
+            owner=upload.owner,
+            name=upload.name or upload.filename,
+            original_filename=upload.filename,
+            description=upload.description,
+            size=upload.size,
+            checksum=hasher.hexdigest(),
+        )
+    return file
+
+
+def abort_upload(upload):
+    """Drop an upload with its partial file."""
+    # Claimed like in finalize_upload, so a concurrent finalize keeps its file.
+    deleted, rows = Upload.objects.filter(pk=upload.pk).delete()
+    if not deleted:
+        raise UploadError('Upload was already finalized or aborted.', status=409)
+    _hashers.pop(upload.token, None)
+    try:
+        default_storage.delete(upload.path)
+    except OSError:
+        raise UploadError('The partial file could not be removed; it is left to the storage sweeper.', status=500)
@@ -1,22 +1,39 @@
 from django.conf.urls import url
 from core.views import (
-    HomeView, FolderDetailView, FolderAddView, FolderEditView, FolderDeleteView, FolderShareView,
-    FileDetailView, FileAddView, FileEditView, FileDeleteView, FileShareView, ShareDeleteView
+    HomeView, SharedView, SearchView, FolderPickerView, FolderDetailView, FolderItemsView, FolderDownloadView,
+    FolderAddView, FolderEditView, FolderDeleteView, FolderShareView,
+    FileDetailView, FilePreviewView, FileDownloadView, FileAddView, FileEditView, FileDeleteView, FileShareView,
+    ShareDeleteView, UploadStartView, UploadView, UploadFinalizeView, BulkView, MetricsView
 )
 
 urlpatterns = [
     url(r'^my/$', HomeView.as_view(), name='home'),
+    url(r'^shared/$', SharedView.as_view(), name='shared'),
+    url(r'^search/$', SearchView.as_view(), name='search'),
+    url(r'^folders/picker/$', FolderPickerView.as_view(), name='folder-picker'),
     url(r'^folder/(?P<slug>[-\w]+)/$', FolderDetailView.as_view(), name='folder-detail'),
+    url(r'^folder/(?P<slug>[-\w]+)/items/$', FolderItemsView.as_view(), name='folder-items'),
+    url(r'^folder/(?P<slug>[-\w]+)/download/$', FolderDownloadView.as_view(), name='folder-download'),
     url(r'^folder/(?P<slug>[-\w]+)/add/$', FolderAddView.as_view(), name='folder-add'),
     url(r'^folder/(?P<slug>[-\w]+)/edit/$', FolderEditView.as_view(), name='folder-edit'),
     url(r'^folder/(?P<slug>[-\w]+)/delete/$', FolderDeleteView.as_view(), name='folder-delete'),
     url(r'^folder/(?P<slug>[-\w]+)/share/$', FolderShareView.as_view(), name='folder-share'),
 
     url(r'^file/(?P<slug>[-\w]+)/$', FileDetailView.as_view(), name='file-detail'),
+    url(r'^file/(?P<slug>[-\w]+)/download/$', FileDownloadView.as_view(), name='file-download'),
+    url(r'^file/(?P<slug>[-\w]+)/preview/(?P<size>\w+)/$', FilePreviewView.as_view(), name='file-preview'),
     url(r'^file/(?P<slug>[-\w]+)/add/$', FileAddView.as_view(), name='file-add'),
     url(r'^file/(?P<slug>[-\w]+)/edit/$', FileEditView.as_view(), name='file-edit'),
     url(r'^file/(?P<slug>[-\w]+)/delete/$', FileDeleteView.as_view(), name='file-delete'),
     url(r'^file/(?P<slug>[-\w]+)/share/$', FileShareView.as_view(), name='file-share'),
 
+    url(r'^folder/(?P<slug>[-\w]+)/uploads/$', UploadStartView.as_view(), name='upload-start'),
+    url(r'^upload/(?P<token>[0-9a-f]+)/$', UploadView.as_view(), name='upload'),
+    url(r'^upload/(?P<token>[0-9a-f]+)/finalize/$', UploadFinalizeView.as_view(), name='upload-finalize'),
+
+    url(r'^bulk/(?P<action>move|copy|delete|share)/$', BulkView.as_view(), name='bulk'),
+
     url(r'^permission/(?P<pk>[-\w]+)/delete/$', ShareDeleteView.as_view(), name='permission-delete'),
+
+    url(r'^metrics/$', MetricsView.as_view(), name='metrics'),
 ]
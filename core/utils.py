@@ -1,8 +1,78 @@
 import binascii
+import hashlib
 import math
 import os
+import re
+from itertools import islice
+from urllib.parse import quote
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+SLUG_LENGTH = 20
+# Parameters of a single query stay below SQLite's limit of 999.
+QUERY_CHUNK_SIZE = 500
 
 
 def generate_random_hex(length=10):
     half_length = math.ceil(length / 2)
     return binascii.hexlify(os.urandom(half_length)).decode()[:length]
+
+
+def chunks(items, size=QUERY_CHUNK_SIZE):
+    """Consecutive lists of up to `size` items of an iterable, e.g. for `__in` lookups on many values."""
+    iterator = iter(items)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def generate_slug():
+    """Random slug; with 80 random bits collisions are left to the unique constraint."""
+    return generate_random_hex(length=SLUG_LENGTH)
+
+
+def assign_slugs(objects):
+    """Set distinct random slugs on objects without one, without any queries (for bulk_create)."""
+    slugs = set()
+    for obj in objects:
+        if not obj.slug:
+            slug = generate_slug()
+            while slug in slugs:
+                slug = generate_slug()
+            slugs.add(slug)
+            obj.slug = slug
+
+
+def parse_range_header(header, size):
+    """Inclusive (start, end) of a single byte range; None when the header is missing or not supported.
+
+    Raises ValueError when the range cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if not start:
+        # Suffix range: the last `end` bytes.
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        raise ValueError('Range not satisfiable.')
+    return start, end
+
+
+def content_disposition(filename, inline=False):
+    """Content-Disposition header value with an RFC 5987 encoded filename."""
+    ascii_filename = filename.encode('ascii', 'ignore').decode().replace('"', '').replace('\\', '')
+    return '%s; filename="%s"; filename*=UTF-8\'\'%s' % (
+        'inline' if inline else 'attachment', ascii_filename, quote(filename))
+
+
+def file_checksum(content):
+    """sha256 hex digest of a django File, read in chunks; the file is rewound afterwards."""
+    hasher = hashlib.sha256()
+    for chunk in content.chunks():
+        hasher.update(chunk)
+    content.seek(0)
+    return hasher.hexdigest()
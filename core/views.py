@@ -1,14 +1,33 @@
+import base64
+import hmac
 import logging
+import mimetypes
+import os
+from urllib.parse import quote
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse, reverse_lazy
+from django.contrib.auth import get_user_model
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.contenttypes.models import ContentType
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect
-from django.views.generic import View
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.views.generic import View, TemplateView
 from django.views.generic.detail import DetailView, SingleObjectMixin
 from django.views.generic.edit import FormView, UpdateView, DeleteView
-from core.models import Folder, File, Permission
+from core.conf import settings
+from core.models import Folder, File, Permission, Access, Upload, Quota
+from core import bulk, metrics
+from core.archive import folder_entries, stream_zip
+from core.cache import get_ancestor_chain
 from core.forms import FolderForm, FileForm, PermissionForm
+from core.pagination import KeysetPaginator
+from core.previews import CONTENT_TYPES, get_preview_path, schedule as schedule_previews
+from core.search import search
+from core.uploads import UploadError, start_upload, append_chunk, finalize_upload, abort_upload
+from core.utils import content_disposition, parse_range_header
+from core.permissions import get_permission_cache
 
 logger = logging.getLogger(__name__)
 
@@ -26,7 +45,8 @@ class PermissionMixin(SingleObjectMixin):
         return True
 
     def _has_permission(self, user, obj):
-        _permissions = [obj.has_permission(user, p) for p in self.permissions] + [self.extra_permission(obj)]
+        cache = get_permission_cache(self.request)
+        _permissions = [cache.has_permission(user, obj, p) for p in self.permissions] + [self.extra_permission(obj)]
         return all(_permissions)
 
     def dispatch(self, request, *args, **kwargs):
@@ -47,10 +67,37 @@ class DenyRootFolderMixin:
         return super().dispatch(request, *args, **kwargs)
 
 
-class FolderDetailView(DenyRootFolderMixin, PermissionMixin, DetailView):
+class FolderItemsMixin:
+    def get_items_page(self, folder):
+        """One keyset page of the folder's children and files."""
+        try:
+            per_page = min(int(self.request.GET.get('limit', settings.DRIVE_PAGE_SIZE)), settings.DRIVE_MAX_PAGE_SIZE)
+        except ValueError:
+            per_page = settings.DRIVE_PAGE_SIZE
+        paginator = KeysetPaginator([
+            ('children', folder.children.only('id', 'name', 'slug', 'parent'), ('name', 'id')),
+            ('files', folder.files.only('id', 'name', 'original_filename', 'slug', 'file', 'folder'),
+             ('name', 'original_filename', 'id')),
+        ], max(per_page, 1))
+        return paginator.page(self.request.GET.get('cursor'))
+
+
+class FolderDetailView(DenyRootFolderMixin, PermissionMixin, FolderItemsMixin, DetailView):
     model = Folder
+    queryset = Folder.objects.select_related('owner')
     template_name = 'core/folder_detail.html'
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        items, next_cursor = self.get_items_page(self.object)
+        context.update(items)
+        context.update({
+            'cursor': self.request.GET.get('cursor'),
+            'next_cursor': next_cursor,
+            'permissions': list(self.object.permissions.select_related('user')),
+        })
+        return context
+
 
 class HomeView(LoginRequiredMixin, FolderDetailView):
     template_name = 'core/home.html'
@@ -59,6 +106,102 @@ class HomeView(LoginRequiredMixin, FolderDetailView):
         return Folder.objects.get_user_root(self.request.user)
 
 
+class FolderItemsView(PermissionMixin, FolderItemsMixin, View):
+    model = Folder
+
+    def get(self, request, *args, **kwargs):
+        items, next_cursor = self.get_items_page(self.get_object())
+        return JsonResponse({
+            'folders': [{
+                'name': folder.name,
+                'slug': folder.slug,
+                'url': folder.get_absolute_url(),
+            } for folder in items['children']],
+            'files': [{
+                'name': file.name,
+                'original_filename': file.original_filename,
+                'extension': file.extension,
+                'slug': file.slug,
+                'url': file.get_absolute_url(),
+            } for file in items['files']],
+            'next': next_cursor,
+        })
+
+
+class SharedView(LoginRequiredMixin, TemplateView):
+    template_name = 'core/shared.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        shared = Access.objects.shared_with(self.request.user)
+        context.update({
+            'children': list(Folder.objects.filter(id__in=shared.values('folder')).only('id', 'name', 'slug')),
+            'files': list(File.objects.filter(id__in=shared.values('file')).only('id', 'name', 'slug', 'file')),
+        })
+        return context
+
+
+class SearchView(LoginRequiredMixin, TemplateView):
+    template_name = 'core/search.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query = self.request.GET.get('q', '').strip()
+        results = search(self.request.user, query, limit=settings.DRIVE_PAGE_SIZE,
+                         permission_cache=get_permission_cache(self.request)) if query else []
+        context.update({
+            'query': query,
+            'children': [obj for obj in results if isinstance(obj, Folder)],
+            'files': [obj for obj in results if isinstance(obj, File)],
+        })
+        return context
+
+
+class FolderPickerView(LoginRequiredMixin, View):
+    """Folders of the user's drive for the folder picker (see core.forms.FolderPickerWidget): the children of the
+    folder id `parent` (default: the root), or with `q` the folders whose name starts with it. The subtree of the
+    folder id `exclude` is left out. Pages of DRIVE_PAGE_SIZE folders continue with the `next` cursor."""
+
+    def get(self, request, *args, **kwargs):
+        root = Folder.objects.get_user_root(request.user)
+        folders = Folder.objects.filter(tree_id=root.tree_id, lft__gte=root.lft, rght__lte=root.rght)
+        try:
+            parent_id = int(request.GET.get('parent', root.pk))
+            exclude_id = int(request.GET['exclude']) if request.GET.get('exclude') else None
+        except ValueError:
+            return JsonResponse({'error': 'Invalid folder id.'}, status=400)
+        excluded = folders.filter(pk=exclude_id).values_list('lft', 'rght').first() if exclude_id else None
+        if excluded:
+            folders = folders.exclude(lft__gte=excluded[0], rght__lte=excluded[1])
+        query = request.GET.get('q', '').strip()
+        if query:
+            folders = folders.filter(name__istartswith=query, level__gt=root.level)
+        else:
+            folders = folders.filter(parent_id=parent_id)
+        folders = folders.only('id', 'name', 'parent_id', 'tree_id', 'lft', 'rght', 'level')
+        paginator = KeysetPaginator([('folders', folders, ('name', 'id'))], settings.DRIVE_PAGE_SIZE)
+        items, next_cursor = paginator.page(request.GET.get('cursor'))
+        results = []
+        for folder in items['folders']:
+            result = {'id': folder.pk, 'name': folder.name, 'has_children': folder.rght - folder.lft > 1}
+            if query:
+                chain = get_ancestor_chain(folder)
+                result['path'] = '/'.join(name for ancestor_id, slug, name in chain[root.level + 1:])
+            results.append(result)
+        return JsonResponse({'folders': results, 'more': next_cursor is not None, 'next': next_cursor})
+
+
+class FolderDownloadView(PermissionMixin, View):
+    """The folder with everything below it as a streamed ZIP archive."""
+    model = Folder
+
+    def get(self, request, *args, **kwargs):
+        folder = self.get_object()
+        response = StreamingHttpResponse(stream_zip(folder_entries(folder)), content_type='application/zip')
+        response['Content-Disposition'] = content_disposition(folder.name + '.zip')
+        return response
+
+
 class FolderAddView(PermissionMixin, LoginRequiredMixin, FormView):
     model = Folder
     form_class = FolderForm
@@ -69,6 +212,7 @@ class FolderAddView(PermissionMixin, LoginRequiredMixin, FormView):
         kwargs = super().get_form_kwargs()
         kwargs.update({
             'user': self.request.user,
+            'permission_cache': get_permission_cache(self.request),
             'initial': {'parent': self.get_object()},
         })
         return kwargs
@@ -90,6 +234,7 @@ class FolderEditView(DenyRootFolderMixin, PermissionMixin, LoginRequiredMixin, U
         kwargs = super().get_form_kwargs()
         kwargs.update({
             'user': self.request.user,
+            'permission_cache': get_permission_cache(self.request),
         })
         return kwargs
 
@@ -105,6 +250,12 @@ class FolderDeleteView(DenyRootFolderMixin, PermissionMixin, LoginRequiredMixin,
         except Exception:
             return reverse('core:home')
 
+    def delete(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        success_url = self.get_success_url()
+        bulk.delete_subtrees([self.object])
+        return redirect(success_url)
+
 
 class FolderShareView(PermissionMixin, LoginRequiredMixin, FormView):
     model = Permission
@@ -137,8 +288,102 @@ class FolderShareView(PermissionMixin, LoginRequiredMixin, FormView):
 
 class FileDetailView(PermissionMixin, DetailView):
     model = File
+    queryset = File.objects.select_related('owner', 'folder')
     template_name = 'core/file_detail.html'
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['permissions'] = list(self.object.permissions.select_related('user'))
+        context['preview'] = get_preview_path(self.object, 'large')
+        context['preview_pdf'] = get_preview_path(self.object, 'pdf')
+        return context
+
+
+class FilePreviewView(PermissionMixin, View):
+    """Thumbnail or document preview of a file; 404 (and queued for generation) until it exists."""
+    model = File
+
+    def get(self, request, *args, **kwargs):
+        file = self.get_object()
+        path = get_preview_path(file, kwargs['size'])
+        if path is None:
+            schedule_previews(file)
+            raise Http404
+        # Derivatives only change with the content.
+        etag = quote_etag('%s-%s' % (file.checksum, kwargs['size']))
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = FileResponse(open(path, 'rb'), content_type=CONTENT_TYPES[os.path.splitext(path)[1]])
+            response['Content-Length'] = os.path.getsize(path)
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, max-age=%d' % (60 * 60 * 24)
+        return response
+
+
+class FileDownloadView(PermissionMixin, View):
+    model = File
+
+    def get_etag(self, file):
+        # The checksum identifies the content, so the ETag survives renames and moves.
+        if file.checksum:
+            return quote_etag(file.checksum)
+        return quote_etag('%x-%x' % (file.size, int(file.modified.timestamp() * 1000000)))
+
+    def stream(self, file, start, length):
+        with file.file.storage.open(file.file.name, 'rb') as f:
+            f.seek(start)
+            while length > 0:
+                data = f.read(min(settings.DRIVE_DOWNLOAD_CHUNK_SIZE, length))
+                if not data:
+                    break
+                length -= len(data)
+                yield data
+
+    def get(self, request, *args, **kwargs):
+        file = self.get_object()
+        etag, last_modified = self.get_etag(file), int(file.modified.timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return response
+
+        if settings.DRIVE_SENDFILE == 'x-accel-redirect':
+            response = HttpResponse()
+            response['X-Accel-Redirect'] = quote(settings.DRIVE_SENDFILE_URL + file.file.name)
+        elif settings.DRIVE_SENDFILE == 'x-sendfile':
+            response = HttpResponse()
+            response['X-Sendfile'] = file.file.path
+        else:
+            start, end = 0, file.size - 1
+            byte_range = None
+            if request.META.get('HTTP_IF_RANGE', etag) in (etag, http_date(last_modified)):
+                try:
+                    byte_range = parse_range_header(request.META.get('HTTP_RANGE'), file.size)
+                except ValueError:
+                    response = HttpResponse(status=416)
+                    response['Content-Range'] = 'bytes */%d' % file.size
+                    return response
+            if byte_range:
+                start, end = byte_range
+            response = StreamingHttpResponse(self.stream(file, start, end - start + 1),
+                                             status=206 if byte_range else 200)
+            response['Content-Length'] = end - start + 1
+            if byte_range:
+                response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, file.size)
+            response['Accept-Ranges'] = 'bytes'
+
+        content_type, encoding = mimetypes.guess_type(file.original_filename or file.file.name)
+        response['Content-Type'] = content_type or 'application/octet-stream'
+        response['X-Content-Type-Options'] = 'nosniff'
+        response['Content-Disposition'] = content_disposition(
+            file.original_filename or file.name,
+            inline='inline' in request.GET and content_type in settings.DRIVE_INLINE_TYPES)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        if file.checksum:
+            # Digest of the whole file (RFC 3230), for clients to verify downloads.
+            response['Digest'] = 'SHA-256=%s' % base64.b64encode(bytes.fromhex(file.checksum)).decode()
+        return response
+
 
 class FileAddView(PermissionMixin, LoginRequiredMixin, FormView):
     model = File
@@ -147,15 +392,32 @@ class FileAddView(PermissionMixin, LoginRequiredMixin, FormView):
     context_object_name = 'folder'
     permissions = (Permission.CATEGORIES.edit,)
     template_name = 'core/file_add.html'
+    FORM_OVERHEAD = 64 * 1024
 
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
         kwargs.update({
             'user': self.request.user,
+            'permission_cache': get_permission_cache(self.request),
             'initial': {'folder': self.get_object()},
         })
         return kwargs
 
+    def get_context_data(self, **kwargs):
+        kwargs.setdefault('quota', Quota.objects.get_for_user(self.request.user))
+        return super().get_context_data(**kwargs)
+
+    def post(self, request, *args, **kwargs):
+        # The request size is checked before the body is read, so an upload far over quota is never stored.
+        # Form fields around the file get some room; the form checks the exact file size.
+        quota = Quota.objects.get_for_user(request.user)
+        if not quota.allows(int(request.META.get('CONTENT_LENGTH') or 0) - self.FORM_OVERHEAD):
+            form = self.form_class(request.user, permission_cache=get_permission_cache(request),
+                                   initial={'folder': self.get_object()})
+            return self.render_to_response(self.get_context_data(form=form, quota=quota, quota_exceeded=True),
+                                           status=413)
+        return super().post(request, *args, **kwargs)
+
     def form_valid(self, form):
         file = form.save(commit=False)
         file.owner = self.request.user
@@ -163,6 +425,134 @@ class FileAddView(PermissionMixin, LoginRequiredMixin, FormView):
         return redirect(file.get_absolute_url())
 
 
+class MetricsView(View):
+    """Request metrics of all views in the Prometheus text format (see core.metrics).
+
+    For staff users, DRIVE_METRICS_TOKEN as bearer token and DRIVE_METRICS_IPS only.
+    """
+
+    def is_allowed(self, request):
+        token = settings.DRIVE_METRICS_TOKEN
+        if token and hmac.compare_digest(
+                request.META.get('HTTP_AUTHORIZATION', '').encode(), ('Bearer ' + token).encode()):
+            return True
+        return request.user.is_staff or request.META.get('REMOTE_ADDR') in settings.DRIVE_METRICS_IPS
+
+    def get(self, request, *args, **kwargs):
+        if not self.is_allowed(request):
+            raise PermissionDenied
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class UploadStartView(PermissionMixin, LoginRequiredMixin, View):
+    model = Folder
+    permissions = (Permission.CATEGORIES.edit,)
+
+    def post(self, request, *args, **kwargs):
+        try:
+            filename = request.POST['filename']
+            size = int(request.POST['size'])
+        except (KeyError, ValueError):
+            return JsonResponse({'error': 'filename and size are required.'}, status=400)
+        if not filename or size < 0:
+            return JsonResponse({'error': 'Invalid filename or size.'}, status=400)
+        try:
+            upload = start_upload(self.get_object(), request.user, filename, size,
+                                  name=request.POST.get('name', ''), description=request.POST.get('description'))
+        except UploadError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+        return JsonResponse({
+            'token': upload.token,
+            'offset': upload.offset,
+            'url': reverse('core:upload', args=[upload.token]),
+        }, status=201)
+
+
+class UploadMixin(LoginRequiredMixin):
+    def get_upload(self):
+        try:
+            upload = Upload.objects.select_related('folder').get(token=self.kwargs['token'], owner=self.request.user)
+        except Upload.DoesNotExist:
+            raise Http404
+        # Checked on every request, so an upload stops as soon as the folder is no longer shared for editing.
+        cache = get_permission_cache(self.request)
+        if not cache.has_permission(self.request.user, upload.folder, Permission.CATEGORIES.edit):
+            raise PermissionDenied
+        return upload
+
+    def error_response(self, error, upload=None):
+        data = {'error': str(error)}
+        offset = Upload.objects.filter(pk=upload.pk).values_list('offset', flat=True).first() if upload else None
+        if offset is not None:
+            data['offset'] = offset
+        return JsonResponse(data, status=error.status)
+
+
+class UploadView(UploadMixin, View):
+    def get(self, request, *args, **kwargs):
+        upload = self.get_upload()
+        return JsonResponse({'offset': upload.offset, 'size': upload.size})
+
+    def put(self, request, *args, **kwargs):
+        upload = self.get_upload()
+        try:
+            upload = append_chunk(upload, request, request.META.get('HTTP_CONTENT_RANGE'))
+        except UploadError as e:
+            return self.error_response(e, upload)
+        return JsonResponse({'offset': upload.offset, 'size': upload.size})
+
+    def delete(self, request, *args, **kwargs):
+        upload = self.get_upload()
+        try:
+            abort_upload(upload)
+        except UploadError as e:
+            return self.error_response(e, upload)
+        return JsonResponse({})
+
+
+class UploadFinalizeView(UploadMixin, View):
+    def post(self, request, *args, **kwargs):
+        upload = self.get_upload()
+        try:
+            file = finalize_upload(upload)
+        except UploadError as e:
+            return self.error_response(e, upload)
+        return JsonResponse({'url': file.get_absolute_url()}, status=201)
+
+
+class BulkView(LoginRequiredMixin, View):
+    """POST lists of `folders` and `files` slugs to move or copy them to a `target` folder, to delete them, or to
+    share them with a `user` id or `everybody` as `category`."""
+
+    def post(self, request, *args, **kwargs):
+        action = kwargs['action']
+        try:
+            selection = bulk.Selection(request.user, request.POST.getlist('folders'), request.POST.getlist('files'),
+                                       permission_cache=get_permission_cache(request))
+            if action in ('move', 'copy'):
+                target = Folder.objects.filter(slug=request.POST.get('target')).first()
+                if target is None:
+                    raise bulk.BulkError('Target folder not found.', status=404)
+                folders, files = getattr(bulk, action)(selection, target)
+                return JsonResponse({'folders': folders, 'files': files})
+            if action == 'delete':
+                folders, files = bulk.delete(selection)
+                return JsonResponse({'folders': folders, 'files': files})
+            category = request.POST.get('category', Permission.CATEGORIES.view)
+            if category not in Permission.CATEGORIES:
+                raise bulk.BulkError('Invalid category.')
+            user = None
+            if request.POST.get('user'):
+                try:
+                    user = get_user_model().objects.filter(pk=int(request.POST['user'])).first()
+                except (ValueError, OverflowError):
+                    raise bulk.BulkError('Invalid user id.')
+            created = bulk.share(selection, category, user=user, everybody='everybody' in request.POST)
+            return JsonResponse({'permissions': created})
+        except bulk.BulkError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+
+
 class FileEditView(PermissionMixin, LoginRequiredMixin, UpdateView):
     model = File
     form_class = FileForm
@@ -173,6 +563,7 @@ class FileEditView(PermissionMixin, LoginRequiredMixin, UpdateView):
         kwargs = super().get_form_kwargs()
         kwargs.update({
             'user': self.request.user,
+            'permission_cache': get_permission_cache(self.request),
         })
         return kwargs
 
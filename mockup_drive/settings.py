@@ -20,6 +20,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.forms',
     # third party apps
     'bootstrapform',
     'cachalot',
@@ -32,6 +33,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,6 +59,9 @@ TEMPLATES = [
     },
 ]
 
+# Widgets are rendered with the templates above, so widgets can have templates in templates/
+FORM_RENDERER = 'django.forms.renderers.TemplatesSetting'
+
 STATICFILES_FINDERS += (
     'compressor.finders.CompressorFinder',
 )
@@ -72,6 +77,49 @@ DATABASES = {
     }
 }
 
+# Cache: Redis (django-redis) when REDIS_URL is set, process-local memory otherwise
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': REDIS_URL,
+            'OPTIONS': {'CLIENT_CLASS': 'django_redis.client.DefaultClient'},
+        }
+    }
+    # Query cache in its own keyspace (and optionally its own Redis), so it can be flushed separately.
+    CACHES['cachalot'] = {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.environ.get('CACHALOT_REDIS_URL', REDIS_URL),
+        'KEY_PREFIX': 'cachalot',
+        'OPTIONS': {'CLIENT_CLASS': 'django_redis.client.DefaultClient'},
+    }
+    CACHALOT_CACHE = 'cachalot'
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Query cache (cachalot): any write to a table invalidates every cached query that reads it, so only
+# read-mostly tables are cached. Files, folders (whose counters change with every upload), uploads
+# and quotas change all the time; folder listings and breadcrumbs have per-tree caches instead
+# (see core.cache). auth_user is left out too: logging in writes last_login. Check the effect with
+# DRIVE_CACHALOT_STATS and the cachalot_stats command.
+CACHALOT_ONLY_CACHABLE_TABLES = frozenset((
+    'auth_group',
+    'auth_group_permissions',
+    'auth_permission',
+    'auth_user_groups',
+    'auth_user_user_permissions',
+    'core_access',
+    'core_permission',
+    'django_content_type',
+))
+CACHALOT_TIMEOUT = 60 * 60 * 24
+DRIVE_CACHALOT_STATS = os.environ.get('DRIVE_CACHALOT_STATS') == '1'
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
@@ -94,6 +142,13 @@ STATIC_URL = '/static/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
+# Uploaded files: hashed while received and stored once per distinct content
+DEFAULT_FILE_STORAGE = 'core.storage.ContentAddressedStorage'
+FILE_UPLOAD_HANDLERS = [
+    'core.uploads.HashingMemoryFileUploadHandler',
+    'core.uploads.HashingTemporaryFileUploadHandler',
+]
+
 LOGIN_URL = reverse_lazy('users:login')
 LOGOUT_URL = reverse_lazy('users:logout')
 LOGIN_REDIRECT_URL = '/'